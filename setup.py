@@ -6,7 +6,7 @@ setup(
     setup_requires="setupmeta",
     versioning="branch(main):dev",
     author="Zoran Simic zoran@simicweb.com",
-    python_requires='>=3.6',
+    python_requires='>=3.7',
     url="https://github.com/zsimic/gdot",
     entry_points={
        "console_scripts": [
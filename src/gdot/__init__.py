@@ -1,16 +1,588 @@
+import difflib
+import filecmp
+import functools
+import io
+import json
+import os
+import re
+import shutil
+import stat
+import subprocess  # nosec B404
+import sys
+
+import runez
+
+from .chunks import ChunkManifest, ChunkStore, MANIFEST_SUFFIX, merged_appends
 from .env import GDEnv
+from .hooks import Hook
+from .lock import StoreLock
+from .remotes import DEFAULT_TIMEOUT, expanded_url, GitRemotes, remote_name
+from .srv import DEFAULT_JOBS, ServiceScheduler
+from .templates import TemplateEngine
+from .transaction import applied_mode, ApplyTransaction
 
 
 __version__ = "0.0.2"
 
 
+def locked(func):
+    """Decorated GDotXBase method holds the store lock while it runs, so that concurrent gdot invocations never run git together"""
+
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return func(self, *args, **kwargs)
+
+    return wrapper
+
+
 class GDotXBase:
     """Handling of the gdot store"""
 
     gv = GDEnv
+    branch = "main"
 
     def __init__(self):
         pass
 
-    def attach(self, url):
-        pass
+    @property
+    def store(self):
+        return self.gv.base_folder.full_path()
+
+    def store_path(self, *relative_path):
+        return self.gv.base_folder.full_path(*relative_path)
+
+    @runez.cached_property
+    def lock(self):
+        return StoreLock(self.store + ".lock")  # Next to the store, as the store itself may not exist yet
+
+    @runez.cached_property
+    def chunk_store(self):
+        return ChunkStore(self.store_path("chunks"))
+
+    def git(self, *args, **kwargs):
+        return runez.run("git", "-C", self.store, *args, **kwargs)
+
+    @property
+    def is_attached(self):
+        return os.path.isdir(self.gv.base_folder.full_path(".git"))
+
+    def remote_names(self):
+        """Configured remotes, primary 'origin' first"""
+        if not self.is_attached:
+            return []
+
+        r = self.git("remote", dryrun=False, logger=None)
+        names = r.output.split()
+        if "origin" in names:
+            names.remove("origin")
+            names.insert(0, "origin")
+
+        return names
+
+    def remotes(self, timeout=None):
+        names = self.remote_names()
+        if not names:
+            runez.abort("gdot is not attached to any remote, please run: %s" % runez.bold("gdot attach URL"))
+
+        return GitRemotes(self.store, names, timeout=timeout or DEFAULT_TIMEOUT)
+
+    @property
+    def is_sparse(self):
+        return os.path.isfile(self.store_path(".git", "info", "sparse-checkout"))
+
+    @locked
+    def attach(self, *urls, full=False):
+        """
+        Args:
+            *urls (str): Remote git url(s) to attach with
+            full (bool): If True, fetch full history and check out everything
+                         (default: blobless partial clone, with a sparse checkout limited to what this host uses)
+        """
+        if not self.is_attached:
+            runez.ensure_folder(self.store, logger=None)
+            self.git("init", "-q")
+            self.git("symbolic-ref", "HEAD", "refs/heads/%s" % self.branch)
+            self.git("config", "gc.auto", "0")  # Maintenance is done by 'gdot gc', in the background
+            if not full:
+                self.update_sparse_checkout([])
+
+        existing = self.remote_names()
+        for url in urls:
+            url = expanded_url(url)
+            name = remote_name(url, existing)
+            self.git("remote", "add", name, url)
+            if self.is_sparse:
+                # File contents are fetched lazily, only for the revisions and paths that get checked out
+                self.git("config", "remote.%s.promisor" % name, "true")
+                self.git("config", "remote.%s.partialclonefilter" % name, "blob:none")
+
+            existing.append(name)
+
+        self.pull()
+
+    def sparse_patterns(self, tracked):
+        """
+        Args:
+            tracked (list[str]): Tracked entries
+
+        Returns:
+            (list[str]): Sparse checkout patterns for this host: its profile (vars, templates), and the files it tracks
+        """
+        patterns = ["/tracked.json", "/hooks.json", "/chunks/", "/templates/", "/vars/default.json", "/vars/%s.json" % self.gv.hostname]
+        for entry in tracked:
+            entry = re.sub(r"([\\*?\[])", r"\\\1", entry)
+            patterns.append("/home/%s" % entry)
+            if not entry.endswith("/"):
+                patterns.append("/home/%s%s" % (entry, MANIFEST_SUFFIX))
+
+        return patterns
+
+    def update_sparse_checkout(self, tracked):
+        """Widen (or narrow) sparse checkout to match given 'tracked' entries, if needed"""
+        patterns = self.sparse_patterns(tracked)
+        current = list(runez.readlines(self.store_path(".git", "info", "sparse-checkout"))) if self.is_sparse else None
+        if patterns != current:
+            self.git("sparse-checkout", "set", "--no-cone", *patterns, logger=None)
+
+    @locked
+    def pull(self, timeout=None):
+        """
+        Local edits that were not captured yet get committed first, so that they're merged with incoming changes
+        (instead of being overwritten), then only the files that changed in the store are applied to ~
+
+        Args:
+            timeout (float | None): Timeout in seconds, per remote
+
+        Returns:
+            (list[gdot.remotes.RemoteResult]): Fetch result per remote
+        """
+        remotes = self.remotes(timeout=timeout)
+        if not runez.DRYRUN:
+            # Files added via 'gdot add' are committed as well, so that merging never runs with uncommitted changes
+            self.capture()
+            self.commit(message="Local edits from %s, captured before pull" % self.gv.hostname)
+
+        old_head = self.commit_id()
+        results = remotes.run("fetch", "--quiet", "{remote}")
+        print(remotes.summary(results))
+        if not any(r.succeeded for r in results):
+            runez.abort("Could not fetch from any remote")
+
+        for result in results:
+            ref = self._ref(result.remote)
+            if result.succeeded and self.has_ref(ref):
+                if self.is_sparse:
+                    theirs = self._tracked_as_of(ref)
+                    self.update_sparse_checkout(sorted(set(self.tracked()) | set(theirs)))
+
+                self.validate_hooks(ref)
+                self.merge(ref)
+                break
+
+        paths = None if old_head is None else self.changed_paths(old_head, self.commit_id())
+        changed = self.apply(paths=paths)
+        self.run_hooks(self.hooks(), changed)
+        return results
+
+    def merge(self, ref):
+        """
+        Merge 'ref' into HEAD, conflicts are resolved:
+        - on chunked files: by keeping what was appended on both sides
+        - on tracked.json: by tracking what either side tracks
+        """
+        r = self.git("merge", "--ff", "--no-edit", "-q", ref, fatal=False, logger=None)
+        if r.failed:
+            conflicts = self.git("diff", "--name-only", "--diff-filter=U", dryrun=False, logger=None).output.splitlines()
+            unresolved = [x for x in conflicts if not self._merged_tracked(x, ref) and not self._merged_chunked_file(x, ref)]
+            if unresolved or not conflicts:
+                self.git("merge", "--abort", fatal=False, logger=None)
+                runez.abort("Could not merge %s: %s" % (ref, ", ".join(unresolved) or r.full_output))
+
+            self.git("commit", "--no-edit", "-q")
+
+    def _tracked_as_of(self, rev):
+        """Entries tracked as of 'rev'"""
+        blob = self._blobs(rev, ["tracked.json"])[0]
+        return json.loads(blob.decode()) if blob else []
+
+    def _merged_tracked(self, path, ref):
+        """
+        Args:
+            path (str): Conflicting path, relative to store
+            ref (str): Ref being merged
+
+        Returns:
+            (bool): True if 'path' is tracked.json, and its conflict was resolved
+        """
+        if path != "tracked.json":
+            return False
+
+        merged = sorted(set(self._tracked_as_of("HEAD")) | set(self._tracked_as_of(ref)))
+        runez.save_json(merged, self.store_path(path), logger=None)
+        self.git("add", path, logger=None)
+        return True
+
+    def _merged_chunked_file(self, path, ref):
+        """
+        Args:
+            path (str): Conflicting path, relative to store
+            ref (str): Ref being merged
+
+        Returns:
+            (bool): True if 'path' is a chunked file whose conflict could be resolved
+        """
+        if not path.endswith(MANIFEST_SUFFIX):
+            return False
+
+        base = self.git("merge-base", "HEAD", ref, dryrun=False, logger=None).output
+        base, ours, theirs = (self._chunked_content(rev, path) for rev in (base, "HEAD", ref))
+        merged = merged_appends(base or b"", ours, theirs) if ours is not None and theirs is not None else None
+        if merged is None:
+            return False
+
+        self.chunk_store.store_stream(io.BytesIO(merged)).save(self.store_path(path))
+        self.git("add", path, self.chunk_store.folder, logger=None)
+        return True
+
+    def _chunked_content(self, rev, path):
+        """Content of chunked file with manifest 'path' (relative to store) as of 'rev', None if not available"""
+        blobs = self._blobs(rev, [path])
+        manifest = blobs[0] and ChunkManifest.from_text(blobs[0].decode())
+        if not manifest:
+            return None
+
+        chunks = self._blobs(rev, [os.path.relpath(self.chunk_store.chunk_path(x), self.store) for x in manifest.chunks])
+        if any(x is None for x in chunks):
+            return None
+
+        return b"".join(chunks)
+
+    def _blobs(self, rev, paths):
+        """
+        Returns:
+            (list[bytes | None]): Content of each of 'paths' (relative to store) as of 'rev', in one 'git cat-file' call
+        """
+        specs = "".join("%s:%s\n" % (rev, x) for x in paths).encode()
+        p = subprocess.run(["git", "-C", self.store, "cat-file", "--batch"], input=specs, stdout=subprocess.PIPE)  # nosec B603
+        output = p.stdout
+        blobs = []
+        offset = 0
+        for _ in paths:
+            end = output.index(b"\n", offset)
+            header = output[offset:end].split()
+            offset = end + 1
+            if len(header) != 3 or header[1] != b"blob":
+                blobs.append(None)
+                continue
+
+            size = int(header[2])
+            blobs.append(output[offset:offset + size])
+            offset += size + 1
+
+        return blobs
+
+    def changed_paths(self, old, new):
+        """
+        Returns:
+            (list[str]): Paths relative to the store's 'home/' folder, that changed between commits 'old' and 'new'
+        """
+        if old == new:
+            return []
+
+        r = self.git("diff", "--name-only", "--no-renames", old, new, "--", "home/", dryrun=False, logger=None)
+        return [x[5:] for x in r.output.splitlines()]
+
+    def validate_hooks(self, ref):
+        """Abort if hooks.json is not valid as of 'ref' (checked before merging, so that nothing gets applied)"""
+        blob = self._blobs(ref, ["hooks.json"])[0]
+        origin = "hooks.json of %s" % ref
+        try:
+            specs = json.loads(blob.decode()) if blob else {}
+
+        except ValueError as e:
+            runez.abort("Invalid %s: %s" % (origin, e))
+
+        Hook.from_specs(specs, origin, None)
+
+    def hooks(self):
+        """
+        Returns:
+            (list[Hook]): Hooks declared in the store's hooks.json
+        """
+        return Hook.loaded(self.store_path("hooks.json"), self.gv.home_path())
+
+    def run_hooks(self, hooks, changed, jobs=DEFAULT_JOBS):
+        """
+        Args:
+            hooks (list[Hook]): Declared hooks
+            changed (list[str]): Paths relative to ~ that were changed
+            jobs (int): Max number of hooks to run concurrently
+
+        Returns:
+            (list[gdot.srv.ServiceOutcome]): Outcome of each hook triggered by 'changed'
+        """
+        hooks = [h for h in hooks if h.triggered_by(changed)]
+        if not hooks:
+            return []
+
+        outcomes = ServiceScheduler(hooks, jobs=jobs, kind="hook").run("execute")
+        runez.log.progress.stop()
+        print("\n".join("hook %s" % x for x in outcomes))
+        return outcomes
+
+    def apply(self, paths=None):
+        """
+        Apply current store state to ~, in one atomic transaction
+
+        Args:
+            paths (list[str] | None): Paths relative to the store's 'home/' folder to apply (default: all stored files)
+
+        Returns:
+            (list[str]): Paths relative to ~ of files that were changed
+        """
+        changed = []
+        engine = self.template_engine()
+        with ApplyTransaction(self.gv.cache_path("apply-journal")) as tx:
+            for relative_path in self.stored_files() if paths is None else paths:
+                source = self.store_path("home", relative_path)
+                if not os.path.isfile(source):
+                    continue  # Deleted from store (or outside of sparse checkout): left as-is in ~
+
+                if relative_path.endswith(MANIFEST_SUFFIX):
+                    relative_path = relative_path[:-len(MANIFEST_SUFFIX)]
+                    target = self.gv.home_path(relative_path)
+                    manifest = ChunkManifest.from_file(source)
+                    if not self._matches_manifest(target, manifest):
+                        with tx.staged(target) as fh:
+                            self.chunk_store.restore(manifest, fh)
+
+                        changed.append(relative_path)
+
+                else:
+                    target = self.gv.home_path(relative_path)
+                    mode = os.stat(source).st_mode
+                    if not os.path.isfile(target) or not filecmp.cmp(source, target, shallow=False):
+                        with tx.staged(target, mode=mode) as fh, open(source, "rb") as src:
+                            shutil.copyfileobj(src, fh)
+
+                        changed.append(relative_path)
+
+                    elif self._mode_applied(target, mode):
+                        changed.append(relative_path)
+
+            rendered = engine.render_all(tx)
+
+        engine.save_records()
+        if changed:
+            print("Updated %s" % runez.plural(changed, "file"))
+
+        if rendered:
+            print("Rendered %s" % runez.plural(rendered, "template"))
+
+        return changed + rendered
+
+    @staticmethod
+    def _mode_applied(target, mode):
+        """Apply 'mode' to 'target' whose content is already up to date (eg: file was made executable in store)"""
+        existing = stat.S_IMODE(os.stat(target).st_mode)
+        mode = applied_mode(mode, existing)
+        if mode != existing:
+            if runez.DRYRUN:
+                runez.log.trace("Would chmod %s" % runez.short(target))
+
+            else:
+                os.chmod(target, mode)
+
+            return True
+
+    @staticmethod
+    def _matches_manifest(path, manifest):
+        return os.path.isfile(path) and os.path.getsize(path) == manifest.size and runez.checksum(path) == manifest.digest
+
+    def tracked(self):
+        """Paths tracked by gdot, relative to ~ (folders end with a '/')"""
+        return runez.read_json(self.store_path("tracked.json"), default=[])
+
+    def home_relative(self, path):
+        """Path relative to ~ (abort if not under ~)"""
+        home = self.gv.home_path()
+        if path == "~" or path.startswith("~/"):
+            path = home + path[1:]
+
+        path = os.path.abspath(path)
+        if not path.startswith(home + os.sep):
+            runez.abort("Only files under %s can be tracked, %s is not" % (runez.short(home), runez.short(path)))
+
+        relative = os.path.relpath(path, home)
+        if os.path.isdir(path):
+            relative += "/"
+
+        return relative
+
+    @locked
+    def add(self, path):
+        if not self.is_attached:
+            runez.abort("gdot is not attached, please run: %s" % runez.bold("gdot attach URL"))
+
+        relative = self.home_relative(path)
+        if not os.path.exists(self.gv.home_path(relative)):
+            runez.abort("%s does not exist" % runez.short(path))
+
+        tracked = self.tracked()
+        if relative not in tracked:
+            tracked.append(relative)
+            if self.is_sparse:
+                self.update_sparse_checkout(sorted(tracked))
+
+            runez.save_json(sorted(tracked), self.store_path("tracked.json"), logger=None)
+
+        self.capture(entries=[relative])
+        print("Tracking %s" % runez.short(self.gv.home_path(relative)))
+
+    def tracked_files(self, entries=None):
+        """
+        Args:
+            entries (list[str] | None): Tracked entries to look at (default: all)
+
+        Yields:
+            (str): Relative path of each tracked file currently present in ~
+        """
+        home = self.gv.home_path()
+        for entry in entries or self.tracked():
+            path = self.gv.home_path(entry)
+            if os.path.isdir(path):
+                for root, dirs, files in os.walk(path):
+                    for name in files:
+                        yield os.path.relpath(os.path.join(root, name), home)
+
+            elif os.path.isfile(path):
+                yield entry
+
+    def stored_files(self):
+        """Relative paths of files in the store's 'home/' folder (chunked files appear with their manifest suffix)"""
+        folder = self.store_path("home")
+        for root, dirs, files in os.walk(folder):
+            for name in files:
+                yield os.path.relpath(os.path.join(root, name), folder)
+
+    def changes(self):
+        """
+        Yields:
+            (str, str): Change ('added', 'modified' or 'deleted') and path relative to ~,
+                        for each tracked file that differs from its last captured state in the store
+        """
+        stored = set(self.stored_files())
+        for relative_path in self.tracked_files():
+            source = self.gv.home_path(relative_path)
+            target = self.store_path("home", relative_path)
+            if relative_path + MANIFEST_SUFFIX in stored:
+                stored.discard(relative_path + MANIFEST_SUFFIX)
+                if not self._matches_manifest(source, ChunkManifest.from_file(target + MANIFEST_SUFFIX)):
+                    yield "modified", relative_path
+
+            elif relative_path in stored:
+                stored.discard(relative_path)
+                if not filecmp.cmp(source, target):
+                    yield "modified", relative_path
+
+            else:
+                yield "added", relative_path
+
+        for relative_path in sorted(stored):
+            if relative_path.endswith(MANIFEST_SUFFIX):
+                relative_path = relative_path[:-len(MANIFEST_SUFFIX)]
+
+            yield "deleted", relative_path
+
+    def diff(self):
+        """
+        Yields:
+            (str): Lines of unified diff between last captured state in the store, and current files in ~
+        """
+        for change, relative_path in self.changes():
+            old = [] if change == "added" else self._text_lines(self.store_path("home", relative_path))
+            new = [] if change == "deleted" else self._text_lines(self.gv.home_path(relative_path))
+            if old is None or new is None:
+                yield "Binary files a/%s and b/%s differ" % (relative_path, relative_path)
+
+            else:
+                yield from difflib.unified_diff(old, new, "a/%s" % relative_path, "b/%s" % relative_path, lineterm="")
+
+    @staticmethod
+    def _text_lines(path):
+        """Lines of text file 'path', None if it is not a text file (chunked files are not diffed)"""
+        try:
+            with open(path) as fh:
+                return fh.read().splitlines()
+
+        except (OSError, UnicodeDecodeError):
+            return None
+
+    def capture(self, entries=None):
+        """Capture current state of tracked files from ~ into the store"""
+        expected = set()
+        referenced = set()
+        for relative_path in self.tracked_files(entries=entries):
+            source = self.gv.home_path(relative_path)
+            target = self.store_path("home", relative_path)
+            if os.path.getsize(source) > self.gv.chunk_threshold:
+                manifest = self.chunk_store.store(source)
+                referenced.update(manifest.chunks)
+                target += MANIFEST_SUFFIX
+                if not os.path.isfile(target) or ChunkManifest.from_file(target) != manifest:
+                    manifest.save(target)
+
+            elif not os.path.isfile(target) or not filecmp.cmp(source, target, shallow=False):
+                runez.ensure_folder(os.path.dirname(target), logger=None)
+                shutil.copy2(source, target)
+
+            expected.add(os.path.relpath(target, self.store_path("home")))
+
+        if entries is None:
+            for relative_path in list(self.stored_files()):
+                if relative_path not in expected:
+                    runez.delete(self.store_path("home", relative_path), logger=None)
+
+            self.chunk_store.prune(referenced)
+
+    def commit(self, message=None):
+        """Commit pending changes in store, if any"""
+        self.git("add", "-A", logger=None)
+        if self.git("status", "--porcelain", dryrun=False, logger=None).output:
+            self.git("commit", "-q", "-m", message or "Updated from %s" % self.gv.hostname)
+            return True
+
+    @locked
+    def push(self, timeout=None):
+        remotes = self.remotes(timeout=timeout)
+        self.capture()
+        self.commit()
+        results = remotes.run("push", "--quiet", "{remote}", "HEAD:%s" % self.branch)
+        print(remotes.summary(results))
+        if not any(r.succeeded for r in results):
+            runez.abort("Could not push to any remote")
+
+        return results
+
+    def template_variables(self):
+        """Variables available to templates, 'vars/<hostname>.json' in store overrides 'vars/default.json'"""
+        variables = dict(hostname=self.gv.hostname, userid=self.gv.userid, home=self.gv.home_path(), platform=sys.platform)
+        for name in ("default", self.gv.hostname):
+            variables.update(runez.read_json(self.gv.base_folder.full_path("vars", "%s.json" % name), default={}))
+
+        return variables
+
+    def template_engine(self):
+        source = self.gv.base_folder.full_path("templates")
+        return TemplateEngine(source, self.gv.home_path(), self.gv.cache_path("templates"), self.template_variables())
+
+    def commit_id(self, ref="HEAD"):
+        """Commit id 'ref' points to, if it exists"""
+        return self.git("rev-parse", "-q", "--verify", ref, fatal=False, logger=None, dryrun=False).output or None
+
+    def has_ref(self, ref):
+        return bool(self.git("rev-parse", "--verify", "-q", ref, fatal=False, logger=None, dryrun=False))
+
+    def _ref(self, remote):
+        return "%s/%s" % (remote, self.branch)
@@ -0,0 +1,204 @@
+"""
+Background auto-sync: edits to tracked files get committed once they settle down, and the store is kept in sync with its remotes
+
+Run via 'gdot autosync' (a loop), or periodically via 'gdot autosync --once' (from cron, or a shell prompt hook):
+- edits are coalesced: they're committed together, once no new edit was seen for 'debounce' seconds
+  (or after 'max_delay' seconds for files that keep changing)
+- remotes are synced (pull and merge, then push if needed) every 'interval' seconds, the interval doubles while there is
+  nothing to sync (up to 'max_interval'), and goes back to 'min_interval' as soon as something was synced
+- failed syncs are retried with exponential backoff
+
+State is kept in the store's local cache, so that successive '--once' invocations debounce correctly.
+All git operations hold the store lock, concurrent gdot invocations wait for each other (autosync never waits).
+"""
+
+import os
+import time
+
+import runez
+
+
+DEFAULT_DEBOUNCE = 30  # Seconds without new edits before committing them
+DEFAULT_MAX_DELAY = 600  # Max seconds to hold off committing files that keep changing
+DEFAULT_MIN_INTERVAL = 60  # Seconds between syncs with remotes, while there is activity
+DEFAULT_MAX_INTERVAL = 3600  # Max seconds between syncs (when idle), and max backoff after failures
+
+
+class AutoSync:
+    """Debounced commits of local edits, and adaptive syncing with remotes"""
+
+    def __init__(self, gdotx, debounce=DEFAULT_DEBOUNCE, max_delay=DEFAULT_MAX_DELAY, min_interval=DEFAULT_MIN_INTERVAL,
+                 max_interval=DEFAULT_MAX_INTERVAL):
+        """
+        Args:
+            gdotx (gdot.GDotXBase): Store to keep in sync
+            debounce (float): Seconds without new edits before committing them
+            max_delay (float): Max seconds to hold off committing files that keep changing
+            min_interval (float): Seconds between syncs with remotes, while there is activity
+            max_interval (float): Max seconds between syncs when idle, and max backoff after failures
+        """
+        self.gdotx = gdotx
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.state_path = gdotx.gv.cache_path("autosync.json")
+        self.state = runez.read_json(self.state_path, default={})  # type: dict
+
+    def __repr__(self):
+        return "autosync %s" % runez.short(self.gdotx.store)
+
+    def save_state(self):
+        runez.save_json(self.state, self.state_path, logger=None)
+
+    @property
+    def next_sync(self):
+        return self.state.get("next_sync") or 0
+
+    def fingerprint(self, changes):
+        """
+        Args:
+            changes (list[tuple[str, str]]): Pending changes, as yielded by GDotXBase.changes()
+
+        Returns:
+            (list[list]): Identifies current state of changed files: any new edit yields a different fingerprint
+        """
+        result = []
+        for change, relative_path in changes:
+            try:
+                st = os.stat(self.gdotx.gv.home_path(relative_path))
+                result.append([change, relative_path, st.st_size, st.st_mtime_ns])
+
+            except OSError:
+                result.append([change, relative_path, None, None])
+
+        return result
+
+    def settled(self, changes, now):
+        """
+        Args:
+            changes (list[tuple[str, str]]): Pending changes
+            now (float): Current time
+
+        Returns:
+            (bool): True if pending changes can be committed now
+        """
+        if not changes:
+            self.state.pop("pending", None)
+            self.state.pop("pending_since", None)
+            self.state.pop("edited_at", None)
+            return False
+
+        fingerprint = self.fingerprint(changes)
+        if fingerprint != self.state.get("pending"):
+            self.state["pending"] = fingerprint
+            self.state["edited_at"] = now
+            self.state.setdefault("pending_since", now)
+
+        return now - self.state["edited_at"] >= self.debounce or now - self.state["pending_since"] >= self.max_delay
+
+    def unpushed(self):
+        """
+        Returns:
+            (bool): True if local HEAD is not yet on all remotes
+        """
+        head = self.gdotx.commit_id()
+        if not head:
+            return False
+
+        for name in self.gdotx.remote_names():
+            if self.gdotx.commit_id(self.gdotx._ref(name)) != head:
+                return True
+
+        return False
+
+    def sync(self, timeout=None):
+        """
+        Returns:
+            (bool): True if anything came in or went out
+        """
+        head = self.gdotx.commit_id()
+        self.gdotx.pull(timeout=timeout)
+        pushed = self.unpushed()
+        if pushed:
+            self.gdotx.push(timeout=timeout)
+
+        new_head = self.gdotx.commit_id()
+        return pushed or head != new_head
+
+    def tick(self, now=None, timeout=None):
+        """
+        Args:
+            now (float | None): Current time (default: time.time())
+            timeout (float | None): Timeout in seconds, per remote
+
+        Returns:
+            (str | None): Outcome of this tick, for reporting (None if there was nothing to do)
+        """
+        now = time.time() if now is None else now
+        if not self.gdotx.lock.acquire(timeout=0):
+            return "busy: another gdot process (pid %s) is running" % self.gdotx.lock.holder
+
+        try:
+            self.state = runez.read_json(self.state_path, default={})
+            return self._tick(now, timeout)
+
+        finally:
+            self.save_state()
+            self.gdotx.lock.release()
+
+    def _tick(self, now, timeout):
+        changes = list(self.gdotx.changes())
+        committed = False
+        if changes:
+            if not self.settled(changes, now):
+                # Don't sync while edits are in flight: pulling would overwrite them
+                return "waiting for %s to settle" % runez.plural(changes, "pending change")
+
+            self.gdotx.capture()
+            committed = self.gdotx.commit(message="Auto-sync from %s: %s" % (self.gdotx.gv.hostname, runez.plural(changes, "file")))
+            self.settled([], now)
+
+        if not committed and now < self.next_sync:
+            return None
+
+        try:
+            active = self.sync(timeout=timeout) or committed
+            interval = self.min_interval if active else min(self.max_interval, 2 * self.state.get("interval", self.min_interval))
+            self.state["interval"] = interval
+            self.state["next_sync"] = now + interval
+            self.state.pop("failures", None)
+            self.state.pop("error", None)
+            return "synced" if active else "up to date"
+
+        except (Exception, SystemExit) as e:  # runez.abort() raises SystemExit when running from the CLI
+            return self.failed(now, e)
+
+    def failed(self, now, error):
+        failures = self.state.get("failures", 0) + 1
+        delay = min(self.max_interval, self.min_interval * 2 ** (failures - 1))
+        self.state["failures"] = failures
+        self.state["error"] = str(error) or error.__class__.__name__
+        self.state["next_sync"] = now + delay
+        return "sync failed (%s in a row), retrying in %s" % (failures, runez.represented_duration(delay))
+
+    def run(self, poll=5, timeout=None, maintenance=None):
+        """
+        Keep ticking forever, every 'poll' seconds
+
+        Args:
+            poll (float): Seconds between ticks
+            timeout (float | None): Timeout in seconds, per remote
+            maintenance (gdot.maintenance.Maintenance | None): Store maintenance to run when due (this loop runs in the background)
+        """
+        last = None
+        while True:
+            outcome = self.tick(timeout=timeout)
+            if outcome and outcome != last:
+                print("%s %s" % (time.strftime("%H:%M:%S"), outcome))
+
+            last = outcome
+            if maintenance is not None and maintenance.is_due():
+                maintenance.auto()
+
+            time.sleep(poll)
@@ -0,0 +1,40 @@
+"""
+Precompiled shrinky: a single .pyc file that system python runs directly, without compiling shrinky.py on every start
+
+Bytecode is specific to the python version that produced it, so the bundle is compiled by the target python itself,
+and must be rebuilt when that python gets upgraded.
+"""
+
+import os
+
+import runez
+
+
+DEFAULT_PYTHON = "/usr/bin/python3"
+DEFAULT_TARGET = "~/.local/share/gdot/shrinky.pyc"
+
+COMPILE_SCRIPT = "import py_compile, sys; py_compile.compile(sys.argv[1], cfile=sys.argv[2], dfile='shrinky.py', doraise=True)"
+
+
+def shrinky_source():
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), "shrinky.py")
+
+
+def build_shrinky(target=DEFAULT_TARGET, python=DEFAULT_PYTHON):
+    """
+    Args:
+        target (str): Path of .pyc file to produce
+        python (str): Python interpreter that will run the bundle
+
+    Returns:
+        (str): Full path to produced bundle
+    """
+    target = runez.resolved_path(target)
+    runez.ensure_folder(os.path.dirname(target), logger=None)
+    runez.run(python, "-c", COMPILE_SCRIPT, shrinky_source(), target, logger=None)  # py_compile writes atomically
+    if not runez.DRYRUN:
+        r = runez.run(python, "-S", target, "clean_path", "-p/", fatal=False, logger=None)
+        if r.failed or r.output != "/":
+            runez.abort("Compiled %s does not work: %s" % (runez.short(target), r.full_output))
+
+    return target
@@ -0,0 +1,217 @@
+"""
+Chunked storage for large, append-mostly files (such as shell histories)
+
+Content is split in content-defined chunks: a chunk boundary is placed after any line whose crc32 matches a mask,
+so appending to a file only ever changes its last chunk, all previous chunks keep the same digest and are stored only once.
+Chunks and manifests are plain files committed to the store, git remains the only transport.
+
+When two hosts appended to the same file, their manifests conflict: the merged file is what was appended
+on both sides (see merged_appends()), which also allows for one side to have trimmed lines from the start (like
+shells do with their history), chunks of the merged content are then stored like for any other captured file.
+"""
+
+import hashlib
+import os
+import zlib
+
+import runez
+
+
+MANIFEST_SUFFIX = ".gdot-chunks"
+MANIFEST_HEADER = "gdot-chunks v1"
+MIN_CHUNK = 16 * 1024
+MAX_CHUNK = 256 * 1024
+BOUNDARY_MASK = 1023  # On average, one boundary every ~1k lines (past MIN_CHUNK)
+
+
+def chunked(fh):
+    """
+    Args:
+        fh: File object opened in binary mode
+
+    Yields:
+        (bytes): Content-defined chunks, never larger than MAX_CHUNK
+    """
+    buffer = []
+    size = 0
+    while True:
+        line = fh.readline(MAX_CHUNK - size)
+        if not line:
+            break
+
+        buffer.append(line)
+        size += len(line)
+        if size >= MAX_CHUNK or (size >= MIN_CHUNK and zlib.crc32(line) & BOUNDARY_MASK == 0):
+            yield b"".join(buffer)
+            buffer = []
+            size = 0
+
+    if buffer:
+        yield b"".join(buffer)
+
+
+def appended(base, content):
+    """
+    Args:
+        base (bytes): Original content
+        content (bytes): Content that may have had lines appended to 'base' (and lines trimmed from its start)
+
+    Returns:
+        (bytes | None): What was appended to 'base', None if 'content' is not an append to 'base'
+    """
+    if content.startswith(base):
+        return content[len(base):]
+
+    if not base or not content:
+        return None
+
+    # Lines may have been trimmed from start: look for a line start in 'base' from which 'content' continues it
+    first_line = content.partition(b"\n")[0] + b"\n"
+    i = base.find(b"\n" + first_line)
+    while i >= 0:
+        tail = base[i + 1:]
+        if content.startswith(tail):
+            return content[len(tail):]
+
+        i = base.find(b"\n" + first_line, i + 1)
+
+    return None
+
+
+def merged_appends(base, ours, theirs):
+    """
+    Args:
+        base (bytes): Content as of common ancestor
+        ours (bytes): Our content
+        theirs (bytes): Their content
+
+    Returns:
+        (bytes | None): 'ours' followed by what 'theirs' appended to 'base', None if either side did more than append
+    """
+    added = appended(base, theirs)
+    if added is None or appended(base, ours) is None:
+        return None
+
+    return ours + added
+
+
+class ChunkManifest:
+    """List of chunk digests making up one file, along with overall size and digest"""
+
+    def __init__(self, size=0, digest=None, chunks=None):
+        self.size = size
+        self.digest = digest
+        self.chunks = chunks or []  # type: list[str]
+
+    def __repr__(self):
+        return "%s size=%s sha256=%s" % (MANIFEST_HEADER, self.size, self.digest)
+
+    def __eq__(self, other):
+        return isinstance(other, ChunkManifest) and str(self) == str(other) and self.chunks == other.chunks
+
+    @classmethod
+    def from_file(cls, path):
+        return cls.from_text("\n".join(runez.readlines(path)))
+
+    @classmethod
+    def from_text(cls, text):
+        lines = text.splitlines()
+        if not lines or not lines[0].startswith(MANIFEST_HEADER):
+            return None
+
+        info = dict(x.partition("=")[::2] for x in lines[0].split()[2:])
+        return cls(size=int(info["size"]), digest=info["sha256"], chunks=lines[1:])
+
+    def save(self, path):
+        runez.write(path, "%s\n" % "\n".join([str(self)] + self.chunks), logger=None)
+
+
+class ChunkStore:
+    """Content-addressed chunks, stored as '<folder>/ab/cdef...'"""
+
+    def __init__(self, folder):
+        self.folder = folder
+
+    def __repr__(self):
+        return runez.short(self.folder)
+
+    def chunk_path(self, digest):
+        return os.path.join(self.folder, digest[:2], digest[2:])
+
+    def all_digests(self):
+        if os.path.isdir(self.folder):
+            for prefix in os.listdir(self.folder):
+                for rest in os.listdir(os.path.join(self.folder, prefix)):
+                    if "." not in rest:  # Skip temp files left behind by interrupted writes
+                        yield prefix + rest
+
+    def write_chunk(self, digest, chunk):
+        """
+        Store 'chunk' with given 'digest', unless already stored with the expected size
+
+        Chunks are written to a temp file first, then moved into place: an interrupted write never leaves a truncated chunk
+        """
+        path = self.chunk_path(digest)
+        try:
+            if os.path.getsize(path) == len(chunk):
+                return
+
+        except OSError:
+            pass
+
+        runez.ensure_folder(os.path.dirname(path), logger=None)
+        tmp = "%s.%s.tmp" % (path, os.getpid())
+        try:
+            with open(tmp, "wb") as fh:
+                fh.write(chunk)
+
+            os.replace(tmp, path)
+
+        finally:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+
+    def store(self, path):
+        """
+        Args:
+            path (str): File to store, streamed chunk by chunk
+
+        Returns:
+            (ChunkManifest): Manifest allowing to restore the file later
+        """
+        with open(path, "rb") as fh:
+            return self.store_stream(fh)
+
+    def store_stream(self, fh):
+        """
+        Args:
+            fh: File object opened in binary mode
+
+        Returns:
+            (ChunkManifest): Manifest allowing to restore content of 'fh' later
+        """
+        manifest = ChunkManifest()
+        overall = hashlib.sha256()
+        for chunk in chunked(fh):
+            digest = hashlib.sha256(chunk).hexdigest()
+            overall.update(chunk)
+            manifest.size += len(chunk)
+            manifest.chunks.append(digest)
+            self.write_chunk(digest, chunk)
+
+        manifest.digest = overall.hexdigest()
+        return manifest
+
+    def restore(self, manifest, fh):
+        """Stream all chunks of 'manifest' to file object 'fh' (opened in binary mode)"""
+        for digest in manifest.chunks:
+            with open(self.chunk_path(digest), "rb") as chunk:
+                fh.write(chunk.read())
+
+    def prune(self, referenced):
+        """Delete chunks not in 'referenced' (they remain reachable via git history), and temp files of interrupted writes"""
+        if os.path.isdir(self.folder):
+            for prefix in os.listdir(self.folder):
+                for rest in os.listdir(os.path.join(self.folder, prefix)):
+                    if "." in rest or prefix + rest not in referenced:
+                        runez.delete(os.path.join(self.folder, prefix, rest), logger=None)
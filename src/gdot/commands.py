@@ -9,15 +9,21 @@ For more info see http://gdot.dev
 
 import os
 import sys
+import time
 
 import click
 import runez
+from runez.render import PrettyTable
 
 from gdot import GDEnv, GDotXBase
-from gdot.srv import DCService
+from gdot.autosync import AutoSync, DEFAULT_DEBOUNCE, DEFAULT_MAX_INTERVAL, DEFAULT_MIN_INTERVAL
+from gdot.bundle import build_shrinky, DEFAULT_PYTHON, DEFAULT_TARGET
+from gdot.maintenance import Maintenance
+from gdot.srv import ContainerStates, DCService, DEFAULT_JOBS, DEFAULT_STATUS_TTL, ServiceScheduler, step_trends
 
 
 GDOTX = None  # type: GDotXBase
+STORE_COMMANDS = {"add", "attach", "autosync", "pull", "push"}  # Commands that add objects to the store
 
 
 def not_implemented():
@@ -49,6 +55,13 @@ def main(debug):
     runez.log.setup(debug=debug, console_format="%(levelname)s %(message)s", locations=None, greetings=":: {argv}")
 
 
+@main.result_callback()
+def after_command(*_, **__):
+    """Check store health in the background, after commands that added objects to it"""
+    if click.get_current_context().invoked_subcommand in STORE_COMMANDS and GDOTX.is_attached:
+        Maintenance(GDOTX).spawn_if_due()
+
+
 @main.command()
 @click.argument("file")
 def add(file):
@@ -58,26 +71,64 @@ def add(file):
     Example:
         gdot add .bashrc
         gdot add ~/.config/htop/
+    \b
+    Files larger than 1MB (such as shell histories) are stored in content-defined chunks,
+    so that appending to them only adds new chunks to the store.
     """
-    not_implemented()
+    GDOTX.add(file)
 
 
 @main.command()
-@click.argument("url")
-def attach(url):
+@click.option("--full", is_flag=True, help="Fetch full history and check out everything")
+@click.argument("urls", nargs=-1, required=True)
+def attach(full, urls):
     """
-    Attach with remote git url
+    Attach with remote git url(s)
 
     Examples:
         gdot attach github:{userid}
         gdot attach git@github.com:{userid}/dotfiles.git
+        gdot attach github:{userid} gitlab:{userid}
     \b
     Accepted URL formats:
     - handy shortcuts such as 'github:{userid}' or 'gitlab:{userid}'
     - full url to a git repo such as 'git@github.com:{userid}/dotfiles.git'
+    \b
+    When several urls are given, the first one is the primary remote,
+    the others are kept as mirrors, push/pull talk to all of them concurrently.
+    \b
+    By default, only the files this host uses are fetched and checked out (blobless partial clone + sparse checkout),
+    checkout widens automatically as files get added via 'gdot add'.
     """
     require_userid()
-    GDOTX.attach(url)
+    GDOTX.attach(*urls, full=full)
+
+
+@main.command()
+@click.option("--once", is_flag=True, help="Run one round only (for cron, or shell prompt hooks)")
+@click.option("--debounce", type=float, default=DEFAULT_DEBOUNCE, show_default=True, help="Seconds without edits before committing")
+@click.option("--min-interval", type=float, default=DEFAULT_MIN_INTERVAL, show_default=True, help="Seconds between syncs when active")
+@click.option("--max-interval", type=float, default=DEFAULT_MAX_INTERVAL, show_default=True, help="Max seconds between syncs")
+@click.option("--poll", type=float, default=5, show_default=True, help="Seconds between checks for edits")
+@click.option("--timeout", type=float, help="Timeout in seconds, per remote")
+def autosync(once, debounce, min_interval, max_interval, poll, timeout):
+    """
+    Automatically commit edits, and sync with remote git repo(s)
+
+    Edits are committed together once they settle down, syncing with remotes happens
+    more often when there is activity, and backs off exponentially on failures.
+    \b
+    Example:
+        gdot autosync --once  # From a shell prompt hook, or cron
+    """
+    GDOTX.remotes()  # Fail early if not attached
+    syncer = AutoSync(GDOTX, debounce=debounce, min_interval=min_interval, max_interval=max_interval)
+    if once:
+        outcome = syncer.tick(timeout=timeout)
+        print(outcome or "Nothing to do, next sync in %s" % runez.represented_duration(syncer.next_sync - time.time()))
+
+    else:
+        syncer.run(poll=poll, timeout=timeout, maintenance=Maintenance(GDOTX))  # Runs until interrupted
 
 
 @main.command()
@@ -99,7 +150,35 @@ def diagnostics():
 @main.command()
 def diff():
     """Show what's changed since last pull/push/sync"""
-    not_implemented()
+    for line in GDOTX.diff():
+        print(line)
+
+
+@main.command()
+@click.option("--auto", is_flag=True, help="Run only if store health calls for it (used for background maintenance)")
+def gc(auto):
+    """
+    Incremental maintenance of the git store, to keep git operations fast
+
+    Loose objects and small packs get rolled up via a geometric repack,
+    and multi-pack-index and commit-graph are updated.
+    \b
+    This runs automatically in the background (at most once an hour) after commands
+    that added objects to the store, when too many loose objects or packs piled up.
+    """
+    if not GDOTX.is_attached:
+        runez.abort("gdot is not attached, please run: %s" % runez.bold("gdot attach URL"))
+
+    maintenance = Maintenance(GDOTX)
+    if auto:
+        maintenance.auto()
+        return
+
+    health = maintenance.health()
+    print(PrettyTable.two_column_diagnostics(health.diagnostics()))
+    reasons = health.reasons()
+    steps = maintenance.run(health=health)
+    print("\nRan %s%s, now: %s" % (", ".join(steps), " (%s)" % ", ".join(reasons) if reasons else "", maintenance.health()))
 
 
 @main.command()
@@ -117,25 +196,55 @@ def git():
 @main.command()
 def list():
     """List currently tracked files/folders"""
-    not_implemented()
+    for entry in GDOTX.tracked():
+        print(entry)
 
 
 @main.command()
-def pull():
-    """Pull state from remote git repo"""
-    not_implemented()
+@click.option("--timeout", type=float, help="Timeout in seconds, per remote")
+def pull(timeout):
+    """
+    Pull state from remote git repo(s)
+
+    Local edits not pushed yet are committed first, and merged with incoming changes.
+    Hooks declared in the store's hooks.json then run, if the files they watch changed.
+    """
+    GDOTX.pull(timeout=timeout)
 
 
 @main.command()
-def push():
-    """Push state to remote git repo"""
-    not_implemented()
+@click.option("--timeout", type=float, help="Timeout in seconds, per remote")
+def push(timeout):
+    """Push state to remote git repo(s)"""
+    GDOTX.push(timeout=timeout)
+
+
+@main.command()
+@click.option("--python", default=DEFAULT_PYTHON, show_default=True, help="Python interpreter that will run shrinky")
+@click.option("--target", default=DEFAULT_TARGET, show_default=True, help="Where to install precompiled shrinky")
+def shrinky(python, target):
+    """
+    Install precompiled shrinky, for use in shell prompts and tmux
+
+    Starts faster than running shrinky.py (no compilation, heavy std libs imported only when needed), example:
+        /usr/bin/python3 -S ~/.local/share/gdot/shrinky.pyc tmux_short -p~/dev
+    \b
+    Run this again after upgrading python, as precompiled files are specific to a python version.
+    """
+    target = build_shrinky(target=target, python=python)
+    print("Installed %s, run it via: %s -S %s COMMAND" % (runez.short(target), python, target))
 
 
 @main.command()
 def status():
-    """Show status"""
-    not_implemented()
+    """Show tracked files that changed since last pull/push/sync"""
+    colors = dict(added=runez.green, modified=runez.orange, deleted=runez.red)
+    changes = [x for x in GDOTX.changes()]  # Note: list() is shadowed by the "list" command in this module
+    for change, relative_path in changes:
+        print("%s %s" % (colors[change]("%-9s" % change), relative_path))
+
+    if not changes:
+        print("No changes")
 
 
 @main.command()
@@ -165,6 +274,39 @@ def srv():
     runez.log.progress.start()
 
 
+@srv.command()
+@click.option("--json", "as_json", is_flag=True, help="Output as json")
+@click.option("--limit", "-l", type=int, default=10, show_default=True, help="Number of past runs to show")
+@click.argument("name")
+def history(as_json, limit, name):
+    """Show timings of past operations on a service"""
+    reports = DCService(name).history()
+    runez.log.progress.stop()
+    if as_json:
+        print(runez.represented_json(reports[-limit:]))
+        return
+
+    if not reports:
+        print("No history for %s" % name)
+        return
+
+    table = PrettyTable(["When", "Operation", "Total", "Slowest step", "Problem"])
+    for report in reports[-limit:]:
+        slowest = max(report["steps"], key=lambda x: x["elapsed"], default=None)
+        if slowest:
+            slowest = "%s (%s)" % (slowest["command"], runez.represented_duration(slowest["elapsed"]))
+
+        when = time.strftime("%Y-%m-%d %H:%M", time.localtime(report["timestamp"]))
+        table.add_row([when, report["operation"], runez.represented_duration(report["elapsed"]), slowest, report.get("problem")])
+
+    print(table)
+    table = PrettyTable(["Step", "Runs", "Average", "Fastest", "Slowest", "Last"])
+    for row in step_trends(reports):
+        table.add_row(row[:2] + [runez.represented_duration(x) for x in row[2:]])
+
+    print("\n%s" % table)
+
+
 @srv.command()
 @click.argument("name")
 def install(name):
@@ -172,18 +314,66 @@ def install(name):
     DCService(name).install()
 
 
+def services_option(func):
+    func = click.option("--jobs", "-j", type=int, default=DEFAULT_JOBS, show_default=True, help="Max services to operate on at once")(func)
+    func = click.option("--all", "all_services", is_flag=True, help="Operate on all services in current folder")(func)
+    func = click.argument("names", nargs=-1)(func)
+    return func
+
+
+def run_scheduled(names, all_services, jobs, operation, reverse=False):
+    if all_services:
+        services = DCService.discover()
+
+    elif names:
+        services = [DCService(name) for name in names]
+
+    else:
+        runez.abort("Specify service name(s), or --all")
+
+    outcomes = ServiceScheduler(services, jobs=jobs).run(operation, reverse=reverse)
+    runez.log.progress.stop()
+    print("\n".join(str(x) for x in outcomes))
+    if not all(x.succeeded for x in outcomes):
+        sys.exit(1)
+
+
 @srv.command()
-@click.argument("name")
-def start(name):
-    """Start service"""
-    DCService(name).start()
+@services_option
+def start(names, all_services, jobs):
+    """Start service(s), dependencies first"""
+    run_scheduled(names, all_services, jobs, "start")
 
 
 @srv.command()
-@click.argument("name")
-def stop(name):
-    """Start service"""
-    DCService(name).stop()
+@services_option
+def stop(names, all_services, jobs):
+    """Stop service(s), dependents first"""
+    run_scheduled(names, all_services, jobs, "stop", reverse=True)
+
+
+@srv.command(name="status")
+@click.option("--json", "as_json", is_flag=True, help="Output as json")
+@click.option("--ttl", type=float, default=DEFAULT_STATUS_TTL, show_default=True, help="Reuse container states if younger than N seconds")
+def srv_status(as_json, ttl):
+    """Show status of all services in current folder"""
+    states = ContainerStates(os.path.join(os.path.expanduser(DCService.state_folder), "containers.json"), ttl=ttl)
+    statuses = [s.status(states) for s in DCService.discover()]
+    runez.log.progress.stop()
+    if as_json:
+        print(runez.represented_json(statuses))
+        return
+
+    table = PrettyTable(["Service", "Installed", "State", "Containers", "Problem"])
+    for s in statuses:
+        containers = s["containers"]
+        if containers:
+            running = sum(1 for c in containers if c["state"] == "running")
+            containers = "%s/%s running" % (running, len(containers))
+
+        table.add_row([s["name"], "yes" if s["installed"] else "no", s["state"], containers, s["problem"]])
+
+    print(table)
 
 
 @srv.command()
@@ -194,10 +384,10 @@ def sync(name):
 
 
 @srv.command()
-@click.argument("name")
-def upgrade(name):
-    """Upgrade service"""
-    DCService(name).upgrade()
+@services_option
+def upgrade(names, all_services, jobs):
+    """Upgrade service(s), dependencies first"""
+    run_scheduled(names, all_services, jobs, "upgrade")
 
 
 runez.click.prettify_epilogs(main, formatter=GDEnv.formatted)
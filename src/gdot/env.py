@@ -1,6 +1,7 @@
 # -*- encoding: utf-8 -*-
 
 import os
+import platform
 import sys
 
 import runez
@@ -39,16 +40,28 @@ class GDEnvBase:
     """Environment related stuff"""
 
     default_store = "~/.config/gdot-git-store"
+    chunk_threshold = 1024 * 1024  # Files larger than this are stored in content-defined chunks
+    maintenance_interval = 3600  # Min seconds between background store health checks (0: disabled)
     issues_url = "https://github.com/zsimic/gdot/issues"
 
     user_home = None  # type: str # User ~ folder (unless running in test mode)
     store_home = None  # type: str # Store base folder
 
-    def home_path(self, path):
-        pass
+    def home_path(self, *relative_path):
+        """Path to given file, relative to user ~ folder"""
+        return os.path.join(self.user_home or os.path.expanduser("~"), *relative_path)
 
-    def cache_path(self):
-        pass
+    def cache_path(self, *relative_path):
+        """Path to local (non-roaming) state, kept alongside the store's .git folder"""
+        return self.base_folder.full_path(".git", "gdot", *relative_path)
+
+    @cached_property
+    def userid(self):
+        return runez.SYS_INFO.userid
+
+    @cached_property
+    def hostname(self):
+        return platform.node().partition(".")[0]
 
     @cached_property
     def base_folder(self):
@@ -0,0 +1,130 @@
+"""
+Post-pull hooks, declared in the store's 'hooks.json', for example:
+
+    {
+        "tmux": {"paths": [".tmux.conf", ".config/tmux/*"], "run": "tmux source-file ~/.tmux.conf"},
+        "fonts": {"paths": [".local/share/fonts/*"], "run": "fc-cache -f", "timeout": 120},
+        "completions": {"paths": [".config/zsh/completions/*"], "run": "rm -f ~/.zcompdump", "after": ["fonts"]}
+    }
+
+A hook runs only when at least one file matching its 'paths' globs (relative to ~) was changed by a pull.
+Triggered hooks run concurrently, except for the ones that must run 'after' other hooks.
+"""
+
+import fnmatch
+import os
+import signal
+import subprocess  # nosec B404
+
+import runez
+
+
+DEFAULT_TIMEOUT = 30  # Seconds a hook is allowed to run for
+SPEC_KEYS = {"after", "paths", "run", "timeout"}  # Keys allowed in the spec of a hook
+
+
+class Hook:
+    def __init__(self, name, paths=None, run=None, timeout=None, after=None):
+        """
+        Args:
+            name (str): Name of the hook
+            paths (list[str] | None): Globs of paths relative to ~ that trigger this hook
+            run (str | None): Shell command to run (from ~)
+            timeout (float | None): Max number of seconds to let 'run' go for
+            after (list[str] | None): Names of hooks that must run before this one, when they're triggered as well
+        """
+        self.name = name
+        self.paths = paths or []
+        self.command = run
+        self.timeout = timeout or DEFAULT_TIMEOUT
+        self.dependencies = after or []
+        self.folder = None  # type: str # Folder to run command from
+
+    def __repr__(self):
+        return self.name
+
+    @classmethod
+    def loaded(cls, path, folder):
+        """
+        Args:
+            path (str): Path to json file declaring hooks
+            folder (str): Folder to run hook commands from (typically ~)
+
+        Returns:
+            (list[Hook]): Declared hooks
+        """
+        return cls.from_specs(runez.read_json(path, default={}), runez.short(path), folder)
+
+    @classmethod
+    def from_specs(cls, specs, origin, folder):
+        """
+        Args:
+            specs (dict): Hook specs, by hook name (as read from a hooks.json file)
+            origin (str): Where 'specs' come from, for error messages
+            folder (str): Folder to run hook commands from (typically ~)
+
+        Returns:
+            (list[Hook]): Declared hooks
+        """
+        hooks = []
+        for name, spec in sorted(specs.items()):
+            if not isinstance(spec, dict) or not spec.get("run"):
+                runez.abort("Hook '%s' in %s must have a 'run' command" % (name, origin))
+
+            unknown = sorted(set(spec) - SPEC_KEYS)
+            if unknown:
+                expected = ", ".join(sorted(SPEC_KEYS))
+                runez.abort("Hook '%s' in %s has unknown key '%s' (expecting: %s)" % (name, origin, unknown[0], expected))
+
+            hook = cls(name, **spec)
+            hook.folder = folder
+            hooks.append(hook)
+
+        return hooks
+
+    def triggered_by(self, changed):
+        """
+        Args:
+            changed (list[str]): Paths relative to ~ that were changed
+
+        Returns:
+            (list[str]): Paths from 'changed' that trigger this hook
+        """
+        return [x for x in changed if any(fnmatch.fnmatchcase(x, glob) for glob in self.paths)]
+
+    def execute(self):
+        if runez.DRYRUN:
+            print("Would run hook %s: %s" % (self.name, self.command))
+            return
+
+        # Own session, so that processes spawned by the hook get killed along with it on timeout
+        p = subprocess.Popen(  # nosec B602
+            self.command,
+            shell=True,
+            cwd=self.folder,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            start_new_session=True,
+        )
+        try:
+            stdout, _ = p.communicate(timeout=self.timeout)
+
+        except subprocess.TimeoutExpired:
+            self.kill(p)
+            raise Exception("timed out after %s" % runez.represented_duration(self.timeout))
+
+        if p.returncode:
+            output = stdout.decode("utf-8", errors="replace").strip().splitlines()
+            raise Exception("exit code %s%s" % (p.returncode, ": %s" % output[-1] if output else ""))
+
+    @staticmethod
+    def kill(p):
+        """Kill process 'p' and all processes in its group"""
+        try:
+            os.killpg(p.pid, signal.SIGKILL)
+
+        except ProcessLookupError:  # pragma: no cover, already exited
+            pass
+
+        p.communicate()
@@ -0,0 +1,93 @@
+"""
+Inter-process lock protecting the git store: gdot commands modifying the store wait for each other
+"""
+
+import fcntl
+import logging
+import os
+import time
+
+import runez
+
+
+LOG = logging.getLogger(__name__)
+
+
+class StoreLock:
+    """Exclusive inter-process lock, via flock() on a lock file, re-entrant within the same process"""
+
+    def __init__(self, path):
+        self.path = path
+        self._fh = None
+        self._depth = 0
+
+    def __repr__(self):
+        return runez.short(self.path)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *_):
+        self.release()
+
+    @property
+    def is_held(self):
+        return self._depth > 0
+
+    @property
+    def holder(self):
+        """Pid of process that last acquired the lock, if known"""
+        try:
+            with open(self.path) as fh:
+                return int(fh.read().strip() or 0) or None
+
+        except (OSError, ValueError):
+            return None
+
+    def acquire(self, timeout=None):
+        """
+        Args:
+            timeout (float | None): Max seconds to wait for lock (None: wait as long as needed, 0: don't wait at all)
+
+        Returns:
+            (bool): True if lock was acquired
+        """
+        if self._depth:
+            self._depth += 1
+            return True
+
+        runez.ensure_folder(os.path.dirname(self.path), logger=None)
+        fh = open(self.path, "a+")
+        deadline = None if timeout is None else time.monotonic() + timeout
+        waiting = False
+        while True:
+            try:
+                fcntl.flock(fh.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+
+            except BlockingIOError:
+                if deadline is not None and time.monotonic() >= deadline:
+                    fh.close()
+                    return False
+
+                if not waiting:
+                    waiting = True
+                    LOG.info("Waiting for other gdot process (pid %s) to release %s" % (self.holder, self))
+
+                time.sleep(0.05)
+
+        fh.truncate(0)
+        fh.write("%s\n" % os.getpid())
+        fh.flush()
+        self._fh = fh
+        self._depth = 1
+        return True
+
+    def release(self):
+        if self._depth:
+            self._depth -= 1
+            if not self._depth:
+                fcntl.flock(self._fh.fileno(), fcntl.LOCK_UN)
+                self._fh.close()
+                self._fh = None
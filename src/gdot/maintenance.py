@@ -0,0 +1,263 @@
+"""
+Incremental maintenance of the git store, so that git operations stay fast as auto-commits pile up
+
+Store health is tracked via: number of loose objects, number of packs, and time since last repack.
+When a threshold is crossed:
+- loose objects and small packs are rolled up via a geometric repack: packs are merged only when their sizes call for it,
+  so the cost stays proportional to what was added since last time, not to the size of the whole history
+- a multi-pack-index is written (object lookups stay fast across packs), and the commit-graph is updated incrementally
+- with older git versions (no geometric repack or split commit-graph), a plain 'repack -d' and 'commit-graph write' are done instead
+
+After commands that touched the store, a detached 'gdot gc --auto' is spawned (at most once per check interval),
+so interactive commands never wait on maintenance. Git's own auto-gc is turned off in stores attached by gdot.
+Maintenance does not take the store lock, as git supports repacking concurrently with other git commands.
+"""
+
+import os
+import re
+import subprocess  # nosec B404
+import sys
+import time
+
+import runez
+
+from .lock import StoreLock
+
+
+LOOSE_OBJECTS_THRESHOLD = 100  # Loose objects tolerated before repacking
+PACKS_THRESHOLD = 10  # Packs tolerated before repacking
+REPACK_MAX_AGE = 7 * 24 * 3600  # Max seconds between repacks (when there are loose objects)
+GIT_MIDX = (2, 34)  # git version with 'repack --geometric' and '--write-midx'
+GIT_SPLIT_GRAPH = (2, 27)  # git version with 'commit-graph write --split --changed-paths'
+
+
+class StoreHealth:
+    """Health metrics of a git store"""
+
+    def __init__(self, loose_objects=0, packs=0, since_repack=None, commit_graph=False, multi_pack_index=False):
+        """
+        Args:
+            loose_objects (int): Number of loose objects
+            packs (int): Number of packs
+            since_repack (float | None): Seconds since last repack (None if never repacked)
+            commit_graph (bool): True if store has a commit-graph
+            multi_pack_index (bool): True if store has a multi-pack-index
+        """
+        self.loose_objects = loose_objects
+        self.packs = packs
+        self.since_repack = since_repack
+        self.commit_graph = commit_graph
+        self.multi_pack_index = multi_pack_index
+
+    def __repr__(self):
+        return "%s, %s" % (runez.plural(self.loose_objects, "loose object"), runez.plural(self.packs, "pack"))
+
+    def reasons(self):
+        """
+        Returns:
+            (list[str]): Thresholds crossed (empty if store needs no maintenance)
+        """
+        reasons = []
+        if self.loose_objects > LOOSE_OBJECTS_THRESHOLD:
+            reasons.append(runez.plural(self.loose_objects, "loose object"))
+
+        if self.packs > PACKS_THRESHOLD:
+            reasons.append(runez.plural(self.packs, "pack"))
+
+        if self.since_repack is None:
+            if self.loose_objects:
+                reasons.append("never repacked")
+
+        elif self.loose_objects and self.since_repack > REPACK_MAX_AGE:
+            reasons.append("not repacked in %s" % runez.represented_duration(self.since_repack))
+
+        return reasons
+
+    def diagnostics(self):
+        yield "loose objects", self.loose_objects
+        yield "packs", self.packs
+        yield "last repack", "never" if self.since_repack is None else "%s ago" % runez.represented_duration(self.since_repack)
+        yield "commit-graph", "yes" if self.commit_graph else "no"
+        yield "multi-pack-index", "yes" if self.multi_pack_index else "no"
+
+
+class Maintenance:
+    """Incremental maintenance of the git store"""
+
+    def __init__(self, gdotx):
+        """
+        Args:
+            gdotx (gdot.GDotXBase): Store to maintain
+        """
+        self.gdotx = gdotx
+        self.state_path = gdotx.gv.cache_path("maintenance.json")
+        self.state = runez.read_json(self.state_path, default={})  # type: dict
+        self.lock = StoreLock(gdotx.store + ".gc.lock")  # Only one maintenance at a time, without blocking other commands
+
+    def __repr__(self):
+        return "maintenance %s" % runez.short(self.gdotx.store)
+
+    def save_state(self):
+        runez.save_json(self.state, self.state_path, logger=None)
+
+    def health(self, now=None):
+        """
+        Args:
+            now (float | None): Current time (default: time.time())
+
+        Returns:
+            (StoreHealth): Current health of the store
+        """
+        now = time.time() if now is None else now
+        r = self.gdotx.git("count-objects", "-v", dryrun=False, logger=None)
+        counts = {}
+        for line in r.output.splitlines():
+            key, _, value = line.partition(":")
+            counts[key.strip()] = runez.to_int(value.strip())
+
+        last_repack = self.state.get("last_repack")
+        objects = self.gdotx.store_path(".git", "objects")
+        return StoreHealth(
+            loose_objects=counts.get("count") or 0,
+            packs=counts.get("packs") or 0,
+            since_repack=None if last_repack is None else max(0, now - last_repack),
+            commit_graph=any(os.path.exists(os.path.join(objects, "info", x)) for x in ("commit-graphs", "commit-graph")),
+            multi_pack_index=os.path.exists(os.path.join(objects, "pack", "multi-pack-index")),
+        )
+
+    @runez.cached_property
+    def git_version(self):
+        """
+        Returns:
+            (tuple | None): Major and minor version of git (None if unknown)
+        """
+        r = runez.run("git", "--version", dryrun=False, fatal=False, logger=None)
+        m = re.search(r"(\d+)\.(\d+)", r.output or "") if r.succeeded else None
+        return m and (int(m.group(1)), int(m.group(2)))
+
+    def supports(self, version):
+        """True if git is at least 'version' (older or unknown git versions get only plain maintenance steps)"""
+        return bool(self.git_version) and self.git_version >= version
+
+    def steps(self, health):
+        """
+        Args:
+            health (StoreHealth): Current health of the store
+
+        Returns:
+            (list[tuple[str, list[str]]]): Name and git command of each maintenance step
+        """
+        if not self.supports(GIT_MIDX):
+            repack = ["repack", "-d", "-q"]
+            if health.packs > PACKS_THRESHOLD:
+                repack.insert(1, "-a")
+
+        elif self.gdotx.is_sparse:
+            # Geometric repack fails on partial clones (can't exclude promisor objects) with some git versions:
+            # pack loose objects incrementally instead, and roll packs up only when there are too many of them
+            repack = ["repack", "-d", "-q", "--write-midx"]
+            if health.packs > PACKS_THRESHOLD:
+                repack.insert(1, "-a")
+
+        else:
+            repack = ["repack", "-d", "-q", "--geometric=2", "--write-midx"]
+
+        graph = ["commit-graph", "write", "--reachable"]
+        if self.supports(GIT_SPLIT_GRAPH):
+            graph.extend(["--split", "--changed-paths"])
+
+        return [("repack", repack), ("commit-graph", graph)]
+
+    def run(self, health=None, now=None):
+        """
+        Args:
+            health (StoreHealth | None): Current health of the store (default: measured now)
+            now (float | None): Current time (default: time.time())
+
+        Returns:
+            (list[str]): Steps that were carried out
+        """
+        if not self.lock.acquire(timeout=0):
+            runez.abort("Another 'gdot gc' is already running")
+
+        try:
+            done = []
+            for name, args in self.steps(health or self.health(now=now)):
+                self.gdotx.git(*args, logger=None)
+                done.append(name)
+
+            if not runez.DRYRUN:
+                self.state["last_repack"] = time.time() if now is None else now
+                self.save_state()
+
+            return done
+
+        finally:
+            self.lock.release()
+
+    def auto(self, now=None):
+        """
+        Run maintenance if store health calls for it, and no other maintenance is running
+
+        Args:
+            now (float | None): Current time (default: time.time())
+
+        Returns:
+            (list[str] | None): Thresholds that were crossed (None if another maintenance was running)
+        """
+        if not self.lock.acquire(timeout=0):
+            return None
+
+        try:
+            now = time.time() if now is None else now
+            self.state = runez.read_json(self.state_path, default={})
+            self.state["checked_at"] = now
+            self.save_state()
+            health = self.health(now=now)
+            reasons = health.reasons()
+            if reasons:
+                self.run(health=health, now=now)
+
+            return reasons
+
+        finally:
+            self.lock.release()
+
+    def is_due(self, now=None):
+        """
+        Args:
+            now (float | None): Current time (default: time.time())
+
+        Returns:
+            (bool): True if last health check is older than GDEnv.maintenance_interval
+        """
+        interval = self.gdotx.gv.maintenance_interval
+        now = time.time() if now is None else now
+        return bool(interval) and not runez.DRYRUN and now - self.state.get("checked_at", 0) >= interval
+
+    def spawn_if_due(self, now=None):
+        """
+        Spawn a detached 'gdot gc --auto', if a health check is due
+
+        Args:
+            now (float | None): Current time (default: time.time())
+
+        Returns:
+            (bool): True if a background maintenance was spawned
+        """
+        now = time.time() if now is None else now
+        if not self.is_due(now=now):
+            return False
+
+        self.state["checked_at"] = now  # Avoid spawning again from concurrent commands, 'gc --auto' will record it again
+        self.save_state()
+        subprocess.Popen(  # nosec B603
+            [sys.executable, "-m", "gdot", "gc", "--auto"],
+            cwd=self.gdotx.store,
+            env=dict(os.environ, GDOT_GIT_STORE=self.gdotx.store),
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            start_new_session=True,
+        )
+        return True
@@ -0,0 +1,136 @@
+"""Talk to all git remotes of the store concurrently"""
+
+import asyncio
+import logging
+import os
+import time
+
+import runez
+
+
+LOG = logging.getLogger(__name__)
+DEFAULT_TIMEOUT = 60  # Seconds allowed, per remote, for a git push/fetch
+
+SHORTCUTS = {
+    "github": "git@github.com:%s/dotfiles.git",
+    "gitlab": "git@gitlab.com:%s/dotfiles.git",
+}
+
+
+def expanded_url(url):
+    """
+    Args:
+        url (str): Url as given by user, can be a shortcut such as 'github:USERID'
+
+    Returns:
+        (str): Full git url
+    """
+    name, _, userid = url.partition(":")
+    fmt = SHORTCUTS.get(name)
+    if fmt and userid and "/" not in userid:
+        return fmt % userid
+
+    return url
+
+
+def remote_name(url, taken):
+    """
+    Args:
+        url (str): Full git url
+        taken (list[str]): Remote names already in use
+
+    Returns:
+        (str): Name to use for a new remote pointing to 'url'
+    """
+    if not taken:
+        return "origin"
+
+    for name in SHORTCUTS:
+        if name in url and name not in taken:
+            return name
+
+    i = 1
+    while "mirror%s" % i in taken:
+        i += 1
+
+    return "mirror%s" % i
+
+
+class RemoteResult:
+    """Outcome of one git command against one remote"""
+
+    def __init__(self, remote, exit_code, output, elapsed, timed_out=False):
+        self.remote = remote
+        self.exit_code = exit_code
+        self.output = output
+        self.elapsed = elapsed
+        self.timed_out = timed_out
+
+    def __repr__(self):
+        if self.timed_out:
+            return "%s: %s after %s" % (self.remote, runez.red("timed out"), runez.represented_duration(self.elapsed))
+
+        if self.succeeded:
+            return "%s: %s in %s" % (self.remote, runez.green("OK"), runez.represented_duration(self.elapsed))
+
+        return "%s: %s (exit code %s) %s" % (self.remote, runez.red("failed"), self.exit_code, runez.first_line(self.output) or "")
+
+    @property
+    def succeeded(self):
+        return self.exit_code == 0
+
+
+class GitRemotes:
+    """Run a git command against several remotes at once, total time is the one of the slowest remote"""
+
+    def __init__(self, store, names, timeout=DEFAULT_TIMEOUT):
+        """
+        Args:
+            store (str): Path to local git store
+            names (list[str]): Remote names to talk to, first one is considered primary
+            timeout (float): Timeout in seconds, applied to each remote individually
+        """
+        self.store = store
+        self.names = names
+        self.timeout = timeout
+
+    def __repr__(self):
+        return ", ".join(self.names)
+
+    async def _run_one(self, remote, args):
+        args = [x.format(remote=remote) for x in args]
+        if runez.DRYRUN:
+            LOG.info("Would run: git %s" % runez.joined(args))
+            return RemoteResult(remote, 0, "", 0)
+
+        started = time.time()
+        env = dict(os.environ)
+        env["GIT_TERMINAL_PROMPT"] = "0"  # Never block on an interactive credentials prompt
+        proc = await asyncio.create_subprocess_exec(
+            "git", "-C", self.store, *args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT, env=env
+        )
+        try:
+            output, _ = await asyncio.wait_for(proc.communicate(), self.timeout)
+            return RemoteResult(remote, proc.returncode, runez.decode(output, strip=True), time.time() - started)
+
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+            return RemoteResult(remote, None, "", time.time() - started, timed_out=True)
+
+    async def _run_all(self, args):
+        return await asyncio.gather(*(self._run_one(name, args) for name in self.names))
+
+    def run(self, *args):
+        """
+        Args:
+            *args (str): git command to run, '{remote}' is replaced by each remote name
+
+        Returns:
+            (list[RemoteResult]): One result per remote, in same order as self.names
+        """
+        return asyncio.run(self._run_all(args))
+
+    @staticmethod
+    def summary(results):
+        return "\n".join(str(r) for r in results)
@@ -2,12 +2,16 @@
 """
 Standalone script used to render PS1 parts and shortened folder names for tmux window names and shell prompts.
 Must work fast, with system python, std libs only
+
+Commands accept --budget-ms=N: expensive segments are skipped once N milliseconds were spent rendering.
+Folders on remote/slow filesystems (nfs, sshfs, ...) get only cheap segments, see SHRINKY_FS_POLICY to tweak that.
+
+Heavier std libs (re, pathlib, subprocess...) are imported only by the code paths that need them, to keep cold start fast.
 """
 
 import os
-import re
 import sys
-from pathlib import Path
+import time
 
 
 class Logger:
@@ -42,7 +46,127 @@ class Logger:
         sys.exit(exit_code)
 
 
+class Budget:
+    """Optional time budget (via --budget-ms), expensive segments are skipped once it is spent"""
+
+    deadline = None  # type: float # time.monotonic() value past which expensive segments are skipped
+    skipped = []  # type: list[str]
+
+    @classmethod
+    def start(cls, budget_ms, folder=None):
+        """
+        Args:
+            budget_ms (float | None): Budget in milliseconds (None: no budget)
+            folder (str | None): Folder being rendered, only cheap segments are rendered if it is on a slow filesystem
+        """
+        cls.deadline = time.monotonic() + budget_ms / 1000 if budget_ms is not None else None
+        cls.skipped = []
+        if folder is not None:
+            fs_type = MountTable.fs_type(folder)
+            if FsPolicy.policy(fs_type) == "cheap":
+                Logger.debug("%s is on a '%s' filesystem, rendering cheap segments only", folder, fs_type)
+                cls.cheap_only()
+
+    @classmethod
+    def cheap_only(cls):
+        """Skip all expensive segments (used for folders on slow filesystems)"""
+        cls.deadline = float("-inf")
+
+    @classmethod
+    def allows(cls, what):
+        """Is there any budget left for expensive operation 'what'"""
+        if cls.deadline is None or time.monotonic() < cls.deadline:
+            return True
+
+        cls.skipped.append(what)
+        return False
+
+
+class MountTable:
+    """Filesystem type of mount points, parsed once from /proc/self/mountinfo (linux only)"""
+
+    mountinfo = "/proc/self/mountinfo"
+    _mounts = None  # type: list[tuple[str, str]] # (mount point, fs type), longest mount point first
+
+    @classmethod
+    def mounts(cls):
+        if cls._mounts is None:
+            cls._mounts = []
+            try:
+                with open(cls.mountinfo) as fh:
+                    for line in fh:
+                        # 36 35 98:0 /mnt1 /mnt2 rw,noatime master:1 - ext3 /dev/root rw,errors=continue
+                        fields, _, rest = line.partition(" - ")
+                        fields = fields.split()
+                        if len(fields) >= 5 and rest:
+                            mount_point = cls.unescaped(fields[4])
+                            cls._mounts.append((mount_point, rest.split()[0]))
+
+            except OSError:
+                pass
+
+            cls._mounts.sort(key=lambda x: len(x[0]), reverse=True)
+
+        return cls._mounts
+
+    @staticmethod
+    def unescaped(text):
+        """Mount point from mountinfo, where space, tab, newline and backslash are octal-escaped (eg: '\\040')"""
+        parts = text.split("\\")
+        result = [parts[0]]
+        for part in parts[1:]:
+            code = part[:3]
+            if len(code) == 3 and all(c in "01234567" for c in code):
+                result.append(chr(int(code, 8)) + part[3:])
+
+            else:
+                result.append("\\" + part)
+
+        return "".join(result)
+
+    @classmethod
+    def fs_type(cls, folder):
+        """Type of filesystem 'folder' is on (None if unknown), symlinks are followed"""
+        path = os.path.realpath(str(folder))
+        for mount_point, fs_type in cls.mounts():
+            if path == mount_point or path.startswith(mount_point.rstrip("/") + "/"):
+                return fs_type
+
+
+class FsPolicy:
+    """
+    Which filesystem types get only cheap segments rendered ('cheap'), or all segments ('full').
+    Defaults can be overridden via env var SHRINKY_FS_POLICY, example: SHRINKY_FS_POLICY=nfs=full,fuse.rclone=cheap
+    A policy for 'fuse' applies to all 'fuse.*' types that don't have their own policy.
+    """
+
+    env_var = "SHRINKY_FS_POLICY"
+    defaults = "9p=cheap,afs=cheap,ceph=cheap,cifs=cheap,fuse=cheap,glusterfs=cheap,nfs=cheap,nfs4=cheap,smb3=cheap,smbfs=cheap,sshfs=cheap"
+
+    @classmethod
+    def policies(cls):
+        result = {}
+        for spec in (cls.defaults, os.environ.get(cls.env_var)):
+            for item in (spec or "").split(","):
+                fs_type, _, policy = item.partition("=")
+                if fs_type and policy:
+                    result[fs_type.strip()] = policy.strip()
+
+        return result
+
+    @classmethod
+    def policy(cls, fs_type):
+        if fs_type:
+            policies = cls.policies()
+            return policies.get(fs_type) or policies.get(fs_type.partition(".")[0]) or "full"
+
+        return "full"
+
+
 def run_program(*args: str):
+    if not Budget.allows(args[0]):
+        return None
+
     import subprocess  # nosec B404
 
     Logger.debug("Running: %s", args)
@@ -52,6 +176,8 @@ def run_program(*args: str):
 
 
 def get_path(path):
+    from pathlib import Path
+
     if isinstance(path, Path):
         return path
 
@@ -64,7 +190,10 @@ def get_path(path):
     return Path(path or ".")
 
 
-def scm_root(folder: Path):
+def scm_root(folder):
+    if not Budget.allows("scm_root"):
+        return None
+
     if (folder / ".git").is_dir():
         return folder
 
@@ -151,23 +280,40 @@ class ColorSet:
     def __repr__(self):
         return self.name
 
+    def colored(self, text, color):
+        bit = self.bits.get(color)
+        return bit(text) if bit else text
+
 
-def shortened_path(prefix, parts, max_parts=6):
+def shortened_path(prefix, parts, max_parts=6, keep=None):
+    """
+    Args:
+        prefix (str): Prefix to show first (such as '~')
+        parts (list[str] | tuple[str]): Folder names, all but the last 2 get abbreviated to their first letter
+        max_parts (int): Maximum number of parts to show
+        keep (int | None): Index of a part to show in full regardless (such as a repo root)
+
+    Yields:
+        (str): Parts to join with '/'
+    """
     yield prefix
     if len(parts) > max_parts:
         yield "𓈓"
+        if keep is not None:
+            keep -= len(parts) - max_parts
+
         parts = parts[-max_parts:]
 
     pivot = len(parts) - 2
     for i, part in enumerate(parts):
-        if i < pivot:
+        if i < pivot and i != keep:
             yield part[0]
 
         else:
             yield part
 
 
-def folder_parts(folder: Path):
+def folder_parts(folder):
     try:
         return "~", folder.relative_to(get_path("~")).parts
 
@@ -175,9 +321,264 @@ def folder_parts(folder: Path):
         return "", folder.parts[1:]
 
 
+class RepoRoots:
+    """Repo root of folders seen so far, each folder (and each of its ancestors) is checked for a .git subfolder only once"""
+
+    def __init__(self):
+        self.by_folder = {"": None}  # type: dict[str, int] # Folder -> number of parts of its deepest repo root (if any)
+
+    def deepest(self, folder):
+        """
+        Args:
+            folder (str): Absolute path of a folder (without trailing '/')
+
+        Returns:
+            (int | None): Number of parts of the path of the deepest repo root containing 'folder', if any
+        """
+        if folder in self.by_folder:
+            return self.by_folder[folder]
+
+        parent = folder.rpartition("/")[0]
+        found = folder.count("/") if os.path.isdir(folder + "/.git") else self.deepest(parent)
+        self.by_folder[folder] = found
+        return found
+
+
+def shortened_paths(records, home):
+    """
+    Only folders containing the given paths are looked at (to find repo roots), the paths themselves are not.
+    All paths in the same folder share the same shortened prefix, which is computed once.
+
+    Args:
+        records (iterable[list[str]]): Batches of paths to shorten
+        home (str): Home folder, paths under it are shown with a '~' prefix
+
+    Yields:
+        (list[str]): Batches of corresponding shortened paths
+    """
+    roots = RepoRoots()
+    offset = len(home.strip("/").split("/"))
+    heads = {}  # type: dict[str, str] # Folder -> shortened form of its children, without their name
+    for batch in records:
+        result = []
+        for path in batch:
+            if not path.startswith("/") or path.endswith("/") or "/." in path or "//" in path:
+                path = os.path.abspath(path)
+
+            folder, _, name = path.rpartition("/")
+            head = heads.get(folder)
+            if head is None:
+                parts = folder[1:].split("/") if folder else []
+                keep = roots.deepest(folder)
+                if keep is not None:
+                    keep -= 1
+
+                prefix = ""
+                if folder == home or folder.startswith(home + "/"):
+                    prefix, parts = "~", parts[offset:]
+                    keep = keep - offset if keep is not None and keep >= offset else None
+
+                head = heads[folder] = "/".join(shortened_path(prefix, parts + [""], keep=keep))
+
+            result.append(head + name if path != home else "~")
+
+        yield result
+
+
+class Segment:
+    """
+    User provided prompt segment: a python file in CommandRenderer.segments_folder, with a 'render(renderer)' function.
+
+    The file declares its cache inputs in a header comment, read without importing the file, for example:
+        # shrinky: ttl=60 files=~/.kube/config env=KUBECONFIG color=cyan
+    Optional 'cwd' word makes the current folder part of the cache key.
+    Plugin is imported only when its cached value is missing, expired, or its inputs changed.
+    """
+
+    default_ttl = 60
+
+    def __init__(self, name, path):
+        self.name = name
+        self.path = path
+        self.ttl = self.default_ttl
+        self.files = []
+        self.env = []
+        self.cwd = False
+        self.color = None
+        self._parse_header()
+
+    def __repr__(self):
+        return self.name
+
+    def _parse_header(self):
+        with open(self.path) as fh:
+            for _ in range(10):
+                line = fh.readline()
+                if line.startswith("# shrinky:"):
+                    for word in line[10:].split():
+                        key, _, value = word.partition("=")
+                        if key == "ttl":
+                            self.ttl = float(value)
+
+                        elif key in ("files", "env"):
+                            getattr(self, key).extend(x for x in value.split(",") if x)
+
+                        elif key == "color":
+                            self.color = value
+
+                        elif key == "cwd":
+                            self.cwd = True
+
+                    return
+
+    def cache_key(self, renderer):
+        """Everything that, when changed, invalidates the cached value of this segment"""
+        key = [self._stat(self.path)]
+        key.extend(self._stat(os.path.expanduser(x)) for x in self.files)
+        key.extend(os.environ.get(x) for x in self.env)
+        if self.cwd:
+            key.append(str(renderer.current_folder()))
+
+        return key
+
+    @staticmethod
+    def _stat(path):
+        try:
+            st = os.stat(path)
+            return [st.st_size, st.st_mtime_ns]
+
+        except OSError:
+            return None
+
+    def computed(self, renderer):
+        import importlib.util
+
+        Logger.debug("Importing segment %s", self.path)
+        spec = importlib.util.spec_from_file_location("shrinky_segment_%s" % self.name, str(self.path))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module.render(renderer)
+
+
+class SegmentCache:
+    """Last rendered value of each segment, along with the inputs it was computed from"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.dirty = False
+        self.entries = {}
+        try:
+            import json
+
+            with open(path) as fh:
+                self.entries = json.load(fh)
+
+        except (OSError, ValueError):
+            pass
+
+    def get(self, segment, key, now):
+        entry = self.entries.get(segment.name)
+        if entry and entry["key"] == key and (not segment.ttl or now < entry["expires"]):
+            return entry
+
+    def set(self, segment, key, now, value):
+        self.entries[segment.name] = dict(key=key, expires=now + segment.ttl, value=value)
+        self.dirty = True
+
+    def save(self):
+        if self.dirty:
+            import json
+
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp = "%s.%s" % (self.path, os.getpid())
+            with open(tmp, "w") as fh:
+                json.dump(self.entries, fh)
+
+            os.replace(tmp, self.path)
+            self.dirty = False
+
+
 class CommandRenderer:
 
     flags = {}
+    segments = ""  # Comma separated names of user segments to render (via -e flag)
+    segments_folder = "~/.config/shrinky/segments"
+    segments_cache = "~/.cache/shrinky-segments.json"
+    budget_ms = None  # type: float # Budget for each render, for streaming commands (via --budget-ms)
+
+    def current_folder(self):
+        """Folder being rendered, if applicable"""
+        return None
+
+    def rendered_segments(self, colored):
+        """
+        Args:
+            colored (callable): Function to call with (text, color) to get a colored segment
+
+        Yields:
+            (str): Rendered user segments, as requested via -e flag
+        """
+        if not self.segments:
+            return
+
+        now = time.time()
+        folder = get_path(os.path.expanduser(self.segments_folder))
+        cache = SegmentCache(os.path.expanduser(self.segments_cache))
+        for name in self.segments.split(","):
+            path = folder / ("%s.py" % name)
+            if not name or not path.is_file():
+                Logger.debug("Segment '%s' not found", name)
+                continue
+
+            segment = Segment(name, path)
+            key = segment.cache_key(self)
+            entry = cache.get(segment, key, now)
+            if entry is None and not Budget.allows("segment %s" % name):
+                entry = cache.entries.get(name)  # Serve stale value, if any, rather than going over budget
+
+            if entry is None:
+                try:
+                    value = segment.computed(self)
+
+                except Exception as e:
+                    Logger.debug("Segment '%s' crashed: %s", name, e)
+                    value = None
+
+                cache.set(segment, key, now, value)
+
+            else:
+                value = entry["value"]
+
+            if value:
+                yield colored(value, segment.color)
+
+        cache.save()
+
+
+def folder_name(folder: str):
+    """Same as str(get_path(folder)), without importing pathlib: quotes, redundant slashes and '.' parts are removed"""
+    if folder.startswith('"') and folder.endswith('"'):
+        folder = folder.strip('"')
+
+    if folder == "~":
+        folder = os.path.expanduser("~")
+
+    root = ""
+    if folder.startswith("/"):
+        root = "//" if folder.startswith("//") and not folder.startswith("///") else "/"
+
+    return root + "/".join(x for x in folder.split("/") if x and x != ".") or "."
+
+
+def cleaned_path(path: str):
+    """Existing folders from PATH-style 'path', without duplicates (but keeping order)"""
+    seen = set()
+    for folder in path.split(os.pathsep):
+        folder = folder_name(folder)
+        if folder not in seen and os.path.isdir(folder):
+            yield folder
+
+        seen.add(folder)
 
 
 class PathCleaner(CommandRenderer):
@@ -187,21 +588,165 @@ class PathCleaner(CommandRenderer):
 
     def cmd_clean_path(self):
         """Remove duplicates in PATH (but keep order)"""
-        path = self.path or os.environ.get("PATH")
-        seen = set()
-        for folder in path.split(os.pathsep):
-            folder = get_path(folder)
-            if folder not in seen and folder.is_dir():
-                yield str(folder)
+        yield from cleaned_path(self.path or os.environ.get("PATH"))
+
+
+class EnvSnapshot(CommandRenderer):
+
+    flags = dict(o="output", t="tools", v="variables")
+    output = "~/.cache/shrinky-env.sh"
+    tools = "git,python3,tmux"
+    variables = "PATH,MANPATH"
+
+    def snapshot_key(self, inputs, folders):
+        import hashlib
+
+        h = hashlib.sha256()
+        for name, value in sorted(inputs.items()):
+            h.update(("%s=%s\n" % (name, value)).encode("utf-8"))
+
+        h.update(("tools=%s\n" % self.tools).encode("utf-8"))
+        for folder in folders:
+            try:
+                mtime = os.stat(folder).st_mtime_ns
+
+            except OSError:
+                mtime = None
+
+            h.update(("%s %s\n" % (folder, mtime)).encode("utf-8"))
+
+        return h.hexdigest()
+
+    @staticmethod
+    def referenced_folders(inputs):
+        """Folders referred to by the values of PATH-style variables 'inputs'"""
+        folders = []
+        for value in inputs.values():
+            for folder in value.split(os.pathsep):
+                if folder and folder not in folders:
+                    folders.append(folder)
+
+        return folders
+
+    def rendered_snapshot(self, path, keys, inputs, cleaned, folders):
+        """
+        Contents of sourceable snapshot, applied as-is as long as its inputs didn't change
 
-            seen.add(folder)
+        Shells that inherited the cleaned values (nested shells, tmux panes) find it up to date as well.
+        """
+        import re
+        import shlex
+        import shutil
+
+        checks = []
+        for name, value in sorted(inputs.items()):
+            check = '[ "${%s}" = %s ]' % (name, shlex.quote(value))
+            if cleaned[name] != value:
+                check = "{ %s || [ \"${%s}\" = %s ]; }" % (check, name, shlex.quote(cleaned[name]))
+
+            checks.append(check)
+
+        checks.extend("! [ %s -nt %s ]" % (shlex.quote(folder), shlex.quote(path)) for folder in folders)
+        regen = [sys.executable, os.path.abspath(__file__), "env_snapshot", "-o%s" % path, "-t%s" % self.tools, "-v%s" % self.variables]
+        lines = ["# Generated by shrinky env_snapshot, keys: %s" % " ".join(keys)]
+        lines.append("if [ -n \"${_shrinky_snapshot}\" ] || { %s; }; then" % " && ".join(checks))
+        lines.append("  unset _shrinky_snapshot")
+        for name, value in sorted(cleaned.items()):
+            if inputs[name]:
+                lines.append("  export %s=%s" % (name, shlex.quote(value)))
+
+        for tool in self.tools.split(","):
+            if tool:
+                var_name = "SHRINKY_%s" % re.sub(r"\W", "_", tool).upper()
+                location = shutil.which(tool, path=cleaned.get("PATH", ""))
+                lines.append("  export %s=%s" % (var_name, shlex.quote(location)) if location else "  unset %s" % var_name)
+
+        lines.append("else")
+        lines.append("  _shrinky_snapshot=1")
+        lines.append('  . "$(%s)"' % " ".join(shlex.quote(x) for x in regen))
+        lines.append("fi")
+        return "\n".join(lines) + "\n"
+
+    def cmd_env_snapshot(self):
+        """
+        Write a sourceable snapshot of cleaned PATH-style variables and tool locations (-t), show its path
+
+        Snapshot is regenerated only when its inputs change: the values of the variables (-v)
+        and the mtimes of the folders they refer to. Cleaned values (as exported by the snapshot) count as unchanged inputs.
+        New shells can simply source it, it re-invokes this command by itself when it becomes stale:
+            [ -f ~/.cache/shrinky-env.sh ] && . ~/.cache/shrinky-env.sh || . "$(shrinky env_snapshot)"
+        """
+        path = os.path.expanduser(self.output)
+        inputs = {name: os.environ.get(name, "") for name in self.variables.split(",") if name}
+        cleaned = {name: os.pathsep.join(cleaned_path(value)) if value else "" for name, value in inputs.items()}
+        folders = self.referenced_folders(inputs)
+        key = self.snapshot_key(inputs, folders)
+        try:
+            with open(path) as fh:
+                up_to_date = key in fh.readline().split()
+
+        except OSError:
+            up_to_date = False
+
+        if not up_to_date:
+            Logger.debug("Regenerating %s", path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = "%s.%s" % (path, os.getpid())
+            with open(tmp, "w") as fh:
+                keys = [key, self.snapshot_key(cleaned, self.referenced_folders(cleaned))]
+                fh.write(self.rendered_snapshot(path, keys, inputs, cleaned, folders))
+
+            os.replace(tmp, path)
+
+        yield path
+
+
+class PathShortener(CommandRenderer):
+
+    flags = dict(i="input", z="nul")
+    input = "-"  # File to read paths from ('-' for stdin)
+    nul = None  # Paths are NUL-delimited (instead of newline-delimited) when -z is given
+    chunk_size = 65536
+
+    def records(self, fd, delimiter):
+        """Yields batches of paths read from 'fd', as soon as they are available"""
+        pending = b""
+        while True:
+            chunk = os.read(fd, self.chunk_size)
+            if not chunk:
+                break
+
+            *records, pending = (pending + chunk).split(delimiter)
+            if records:
+                yield [os.fsdecode(x) for x in records if x]
+
+        if pending:
+            yield [os.fsdecode(pending)]
+
+    def cmd_shorten(self):
+        """
+        Shorten paths read from stdin (one per line, or NUL-delimited with -z), same as ps1 shows them
+
+        Repo roots are shown in full, output is written as input comes in, example:
+          fd --type d . ~ | shrinky.py shorten | fzf
+        """
+        delimiter = "\0" if self.nul is not None else "\n"
+        fd = 0 if self.input == "-" else os.open(os.path.expanduser(self.input), os.O_RDONLY)
+        try:
+            for batch in shortened_paths(self.records(fd, delimiter.encode()), os.path.expanduser("~")):
+                if batch:
+                    yield "".join(x + delimiter for x in batch)
+
+        finally:
+            if fd:
+                os.close(fd)
 
 
 class Ps1Renderer(CommandRenderer):
 
     dockerenv = "/.dockerenv"
     example = "ps1 -szsh -ozsimic,zoran -p.. -ufoo"
-    flags = dict(s="shell", o="owner", u="user", x="exit_code", p="pwd", v="venv", w="window")
+    flags = dict(e="segments", s="shell", o="owner", u="user", x="exit_code", p="pwd", v="venv", w="window")
 
     exit_code = "0"
     owner = ""
@@ -211,9 +756,14 @@ class Ps1Renderer(CommandRenderer):
     user = ""
     venv = ""
 
+    def current_folder(self):
+        return get_path(self.pwd)
+
     def cmd_ps1(self):
         """
         PS1 minimalistic prompt
+
+        User segments (from ~/.config/shrinky/segments/) can be added via -e, example: -ekube,aws
         """
         colors = ColorSet.ps1_for_shell(self.shell)
         if not colors:
@@ -226,6 +776,8 @@ class Ps1Renderer(CommandRenderer):
             yield "❕ "
 
         if self.venv:
+            import re
+
             venv = get_path(self.venv)
             activate = venv / "bin/activate"
             python = venv / "bin/python"
@@ -250,14 +802,19 @@ class Ps1Renderer(CommandRenderer):
                 venv_name = venv.name
 
             venv_name = capped_text(venv_name, 24)
-            py_version = capped_text(py_version, 5)
-            yield "(%s %s) " % (colors.cyan(venv_name), colors.blue(py_version))
+            if py_version:
+                yield "(%s %s) " % (colors.cyan(venv_name), colors.blue(capped_text(py_version, 5)))
+
+            else:
+                yield "(%s) " % colors.cyan(venv_name)  # Python version is unknown (or skipped, due to latency budget)
 
         if self.owner and self.user != "root":
             owners = self.owner.split(",")
             if self.user not in owners:
                 yield "%s@" % colors.blue(self.user)
 
+        yield from self.rendered_segments(lambda text, color: "%s " % colors.colored(text, color))
+
         if self.pwd:
             folder = get_path(self.pwd)
             prefix, parts = folder_parts(folder)
@@ -301,9 +858,13 @@ class TmuxRenderer(CommandRenderer):
 
     # Other icons: 🔀🧐🚨🚧📌🔧📄💡🍻🏷️💫🩹🎨
     branch_spec = "📌yellow+✨blue:master,main+🧐green:release,publish"
+    delimiter = "┆"
     path = ""
     window = ""
-    flags = dict(b="branch_spec", p="path", w="window")
+    flags = dict(b="branch_spec", e="segments", p="path", w="window")
+
+    def current_folder(self):
+        return get_path(self.path)
 
     @staticmethod
     def tmux_colored(text, fg: str, max_size: int):
@@ -364,9 +925,12 @@ class TmuxRenderer(CommandRenderer):
 
         Example:
           set -g status-right '#(/usr/bin/python3 shrinky.py tmux_status -p"#{pane_current_path}")'
+
+        User segments (from ~/.config/shrinky/segments/) can be added via -e, example: -ekube,battery
         """
         folder = get_path(self.path)
         yield self.rendered_branch(scm_root(folder))
+        yield from self.rendered_segments(lambda text, color: self.tmux_colored(text, color, 30))
         yield self.rendered_uptime()
 
     def cmd_tmux_short(self):
@@ -391,6 +955,162 @@ class TmuxRenderer(CommandRenderer):
         yield capped_text(folder, max_size=20)
 
 
+def tmux_quoted(text):
+    return "'%s'" % text.replace("'", "'\\''")
+
+
+class TmuxWatcher(CommandRenderer):
+
+    branch_spec = TmuxRenderer.branch_spec
+    refresh = 60  # Seconds between re-renders of all windows (status shows uptime and git branch, which change without a cd)
+    session = ""
+    socket = ""
+    flags = dict(b="branch_spec", e="segments", r="refresh", s="session", L="socket")
+    min_version = (3, 2)  # 'refresh-client -B' subscriptions appeared in tmux 3.2
+    subscription = "shrinky-path"
+    status_option = "@shrinky_status"
+
+    def __init__(self):
+        self.rendered = {}  # type: dict[str, tuple] # Window id -> (path, name, status) last pushed
+
+    def tmux_command(self, *args):
+        cmd = ["tmux"]
+        if self.socket:
+            cmd.extend(["-L", self.socket])
+
+        cmd.extend(args)
+        return cmd
+
+    def attach_command(self):
+        cmd = self.tmux_command("-C", "attach-session", "-f", "no-output,ignore-size")
+        if self.session:
+            cmd.extend(["-t", self.session])
+
+        return cmd
+
+    @staticmethod
+    def parsed_version(text):
+        """
+        Args:
+            text (str | None): Output of 'tmux -V', example: tmux 3.3a
+
+        Returns:
+            (tuple | None): Major and minor version (None if unknown, for example with dev builds: 'tmux master')
+        """
+        import re
+
+        m = re.search(r"(\d+)\.(\d+)", text or "")
+        return m and (int(m.group(1)), int(m.group(2)))
+
+    def subscribe_command(self):
+        # tmux checks subscriptions once per second, and notifies for each window initially, then when the value changes
+        return "refresh-client -B %s" % tmux_quoted("%s:@*:#{pane_current_path}" % self.subscription)
+
+    def window_commands(self, window_id, path, force=False):
+        """Commands updating name and status of window 'window_id', if its current 'path' changed (or when 'force' is True)"""
+        previous = self.rendered.get(window_id)
+        if not force and previous and previous[0] == path:
+            return
+
+        renderer = TmuxRenderer()
+        renderer.branch_spec = self.branch_spec
+        renderer.segments = self.segments
+        renderer.path = path
+        Budget.start(self.budget_ms, folder=renderer.current_folder())
+        name = "".join(x for x in renderer.cmd_tmux_short() if x)
+        status = TmuxRenderer.delimiter.join(x for x in renderer.cmd_tmux_status() if x)
+        if Budget.skipped:
+            Logger.debug("Window %s skipped: %s", window_id, ", ".join(Budget.skipped))
+
+        self.rendered[window_id] = (path, name, status)
+        if not previous or previous[1] != name:
+            yield "rename-window -t %s %s" % (window_id, tmux_quoted(name))
+
+        if not previous or previous[2] != status:
+            yield "set-option -w -t %s %s %s" % (window_id, self.status_option, tmux_quoted(status))
+
+    def refreshed(self):
+        """Commands updating windows whose name or status changed since they were last rendered"""
+        for window_id, previous in list(self.rendered.items()):
+            yield from self.window_commands(window_id, previous[0], force=True)
+
+    def handled(self, line):
+        """
+        Args:
+            line (str): Line received from tmux control mode
+
+        Yields:
+            (str): Commands to send back to tmux
+        """
+        if line.startswith("%session-changed "):  # Client is now attached
+            yield self.subscribe_command()
+
+        elif line.startswith("%%subscription-changed %s " % self.subscription):
+            # %subscription-changed name session-id window-id window-index pane-id ... : value
+            fields, _, path = line.partition(" : ")
+            yield from self.window_commands(fields.split()[3], path)
+
+        elif line.startswith(("%window-close ", "%unlinked-window-close ")):
+            self.rendered.pop(line.split()[1], None)
+
+    def cmd_tmux_watch(self):
+        """
+        Keep tmux window names and status up to date, as a tmux control mode client (instead of polling), requires tmux 3.2+
+
+        Windows are re-rendered when their current folder changes, and every -r seconds (default: 60), example:
+          set -g status-right '#{@shrinky_status}'
+          set-hook -g session-created 'run-shell -b "/usr/bin/python3 shrinky.py tmux_watch -s#{q:session_id}"'
+
+        With older tmux versions, use tmux_short and tmux_status via #() instead.
+        """
+        import select
+        import subprocess  # nosec B404
+
+        version = self.parsed_version(run_program(*self.tmux_command("-V")))
+        if version and version < self.min_version:
+            min_version = ".".join(str(x) for x in self.min_version)
+            Logger.fail("tmux_watch requires tmux %s+, use tmux_short and tmux_status via #() instead" % min_version)
+
+        cmd = self.attach_command()
+        Logger.debug("Running: %s", cmd)
+        p = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE)  # nosec B603
+        fd = p.stdout.fileno()
+        refresh = float(self.refresh)
+        next_refresh = time.monotonic() + refresh
+        pending = b""
+        try:
+            while True:
+                ready, _, _ = select.select([fd], [], [], max(0, next_refresh - time.monotonic()))
+                if not ready:
+                    self.sent(p, self.refreshed())
+                    next_refresh = time.monotonic() + refresh
+                    continue
+
+                chunk = os.read(fd, 65536)
+                if not chunk:
+                    break
+
+                *lines, pending = (pending + chunk).split(b"\n")
+                for line in lines:
+                    line = line.decode("utf-8", errors="replace")
+                    if line.startswith("%exit"):
+                        return
+
+                    self.sent(p, self.handled(line))
+
+        finally:
+            p.stdin.close()
+            p.wait()
+
+    @staticmethod
+    def sent(p, commands):
+        for command in commands:
+            Logger.debug("tmux: %s", command)
+            p.stdin.write(("%s\n" % command).encode("utf-8"))
+
+        p.stdin.flush()
+
+
 class CommandDef:
     def __init__(self, base_cls, name, delimiter):
         self.name = name
@@ -414,7 +1134,12 @@ class CommandDef:
 
     def run_with_args(self, args):
         instance = self.base_cls()
+        budget_ms = None
         for arg in args:
+            if arg.startswith("--budget-ms="):
+                budget_ms = float(arg[12:])
+                continue
+
             if not arg or len(arg) <= 1 or not arg.startswith("-"):
                 Logger.fail("Unrecognized argument '%s'" % arg)
 
@@ -427,7 +1152,27 @@ class CommandDef:
             setattr(instance, flag, value)
 
         func = self.get_func(instance=instance)
-        bits = list(func())
+        if self.delimiter is None:  # Streaming command: output is written as it gets yielded, budget applies to each render
+            instance.budget_ms = budget_ms
+            for bit in func() or ():
+                sys.stdout.write(bit)
+                sys.stdout.flush()
+
+            return
+
+        Budget.start(budget_ms, folder=instance.current_folder())
+        bits = []
+        started = time.monotonic()
+        for bit in func():
+            now = time.monotonic()
+            Logger.debug("%s segment #%s took %.1fms: %s", self, len(bits), (now - started) * 1000, bit)
+            bits.append(bit)
+            started = now
+
+        if Budget.skipped:
+            reason = "Budget of %gms spent" % budget_ms if budget_ms is not None else "Slow filesystem"
+            Logger.debug("%s, skipped: %s", reason, ", ".join(Budget.skipped))
+
         response = self.delimiter.join(x for x in bits if x)
         Logger.debug("%s %s -> %s", self, args, response)
         print(response)
@@ -514,8 +1259,11 @@ class CommandParser:
 def main(args=None):
     parser = CommandParser()
     parser.add_command(PathCleaner, delimiter=os.pathsep)
+    parser.add_command(EnvSnapshot)
+    parser.add_command(PathShortener, delimiter=None)
     parser.add_command(Ps1Renderer)
-    parser.add_command(TmuxRenderer, delimiter="┆")
+    parser.add_command(TmuxRenderer, delimiter=TmuxRenderer.delimiter)
+    parser.add_command(TmuxWatcher, delimiter=None)
     parser.run_args(args or sys.argv[1:])
 
 
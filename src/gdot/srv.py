@@ -1,8 +1,20 @@
+import contextlib
+import functools
+import json
 import os
+import re
 import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
 import runez
 
+from gdot.sync import SyncEngine
+
+
+DEFAULT_JOBS = 4  # Max number of services operated on concurrently
+DEFAULT_STATUS_TTL = 5  # Seconds during which container states are reused from cache
+
 
 def require_files(*paths):
     for path in paths:
@@ -16,16 +28,101 @@ def require_folders(*paths):
             return "Folder '%s' does not exist" % runez.short(path)
 
 
+def reported(func):
+    """Decorated DCService operation writes a run report to the service's history (unless nested in another operation)"""
+
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        if self.report is not None:
+            return func(self, *args, **kwargs)
+
+        self.report = RunReport(self.name, func.__name__)
+        try:
+            return func(self, *args, **kwargs)
+
+        except BaseException as e:
+            self.report.problem = "exit code %s" % e.code if isinstance(e, SystemExit) and isinstance(e.code, int) else str(e)
+            raise
+
+        finally:
+            report = self.report
+            self.report = None
+            report.save(self.history_path)
+
+    return wrapper
+
+
 class DCService(object):
-    def __init__(self, name):
+
+    srv_folder = "/srv"  # Where services get installed
+    state_folder = "~/.cache/gdot/srv"  # Local state, such as manifests of last sync
+
+    def __init__(self, name, repo=None):
         self.name = name
-        self.repo = os.getcwd()
+        self.repo = repo or os.getcwd()
         self.origin = os.path.join(self.repo, name)
         self.origin_docker_compose = os.path.join(self.origin, "docker-compose.yml")
         self.origin_root = os.path.join(self.origin, "root")
-        self.target = os.path.join("/srv", name)
+        self.origin_config = os.path.join(self.origin, "service.json")
+        self.target = os.path.join(self.srv_folder, name)
         self.target_docker_compose = os.path.join(self.target, "docker-compose.yml")
         self.target_root = os.path.join(self.target, "root")
+        self.report = None  # type: RunReport # Report of operation currently running
+
+    def __repr__(self):
+        return self.name
+
+    @property
+    def history_path(self):
+        return os.path.join(os.path.expanduser(self.state_folder), "history", "%s.jsonl" % self.name)
+
+    def history(self):
+        """
+        Returns:
+            (list[dict]): Past run reports, oldest first
+        """
+        result = []
+        if os.path.exists(self.history_path):
+            with open(self.history_path) as fh:
+                for line in fh:
+                    if line.strip():
+                        result.append(json.loads(line))
+
+        return result
+
+    def run(self, program, *args, fatal=True, **kwargs):
+        """Same as runez.run(), with wall time, exit code and output size recorded in current run report"""
+        started = time.time()
+        r = runez.run(program, *args, fatal=False, **kwargs)
+        if self.report is not None:
+            output_size = len(r.output or "") + len(r.error or "")
+            self.report.add_step(runez.joined(program, args), time.time() - started, exit_code=r.exit_code, output_size=output_size)
+
+        if fatal and r.failed:
+            runez.abort("%s failed: %s" % (runez.joined(program, args), r.full_output))
+
+        return r
+
+    @classmethod
+    def discover(cls, repo=None):
+        """All services found in 'repo' (folders with a docker-compose.yml), sorted by name"""
+        repo = repo or os.getcwd()
+        result = []
+        for name in sorted(os.listdir(repo)):
+            if os.path.isfile(os.path.join(repo, name, "docker-compose.yml")):
+                result.append(cls(name, repo=repo))
+
+        return result
+
+    @runez.cached_property
+    def config(self):
+        """Optional per-service settings, from '<name>/service.json'"""
+        return runez.read_json(self.origin_config, default={})
+
+    @property
+    def dependencies(self):
+        """Names of services that must be started before this one (and stopped after it)"""
+        return self.config.get("depends_on") or []
 
     def problem(self, require_installed):
         p = require_folders(self.origin, self.origin_root) or require_files(self.origin_docker_compose)
@@ -40,6 +137,49 @@ class DCService(object):
             sys.stderr.write("%s\n" % runez.red(problem))
             sys.exit(1)
 
+    @property
+    def project_name(self):
+        """docker-compose project name of this service: its folder name, normalized the same way docker-compose does"""
+        return re.sub(r"[^a-z0-9_-]", "", self.name.lower()).lstrip("_-")
+
+    def status(self, states):
+        """
+        Args:
+            states (ContainerStates): Container states of this host
+
+        Returns:
+            (dict): Status of this service
+        """
+        containers = None
+        if states.by_project is not None:
+            containers = states.by_project.get(self.project_name, [])
+
+        running = [c for c in containers or [] if c["state"] == "running"]
+        if containers is None:
+            state = "unknown"
+
+        elif not containers:
+            state = "down"
+
+        elif len(running) == len(containers):
+            state = "running"
+
+        else:
+            state = "degraded" if running else "stopped"
+
+        return dict(
+            name=self.name,
+            installed=os.path.isfile(self.target_docker_compose),
+            problem=self.problem(require_installed=True),
+            state=state,
+            containers=containers,
+        )
+
+    def compose(self, *args):
+        """Run docker-compose from this service's target folder (without changing cwd, so this is thread-safe)"""
+        return self.run("docker-compose", *args, cwd=self.target)
+
+    @reported
     def install(self):
         self.validate(require_installed=False)
         if os.path.isfile(self.target_docker_compose):
@@ -47,30 +187,302 @@ class DCService(object):
             return
 
         if not os.path.isdir(self.target):
-            runez.run("sudo", "mkdir", self.target)
-            runez.run("sudo", "chown", os.environ.get("USER"), self.target)
+            self.run("sudo", "mkdir", self.target)
+            self.run("sudo", "chown", os.environ.get("USER"), self.target)
 
-        runez.run("rsync", "-aHJ", "%s/" % self.origin, self.target)
+        self.synced(self.origin, self.target, "install")
 
+    @reported
     def start(self):
         self.validate()
-        with runez.CurrentFolder(self.target):
-            runez.run("docker-compose", "up", "-d")
+        self.compose("up", "-d")
 
+    @reported
     def stop(self):
         self.validate()
-        with runez.CurrentFolder(self.target):
-            runez.run("docker-compose", "stop")
+        self.compose("stop")
 
+    @reported
     def sync(self):
         self.validate()
-        runez.run("rsync", "-aHJ", "%s/" % self.target_root, self.origin_root)
+        self.synced(self.target_root, self.origin_root, "sync")
 
+    def synced(self, source, target, label):
+        """Same as 'rsync -aHJ source/ target', but much faster when nothing changed"""
+        manifest = os.path.join(os.path.expanduser(self.state_folder), "%s-%s.json" % (self.name, label))
+        started = time.time()
+        plan = SyncEngine(source, target, manifest_path=manifest).run()
+        if self.report is not None:
+            self.report.add_step(label, time.time() - started, changes=len(plan))
+
+        print(plan)
+        return plan
+
+    @reported
     def upgrade(self):
-        self.stop()
-        with runez.CurrentFolder(self.target):
-            runez.run("docker-compose", "pull")
-            runez.run("docker-compose", "prune", "-f")
+        """
+        Upgrade with minimal downtime:
+        - pull new images while service is still running, sync root dir at the same time
+        - only then recreate containers ('up -d' only restarts what changed)
+        - prune old images once service is back up
+        """
+        self.validate()
+        timer = PhaseTimer()
+        with timer.phase("prefetch"):
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                futures = [executor.submit(timer.timed, "pull", self.compose, "pull"), executor.submit(timer.timed, "sync", self.sync)]
+                for future in futures:
+                    future.result()
+
+        with timer.phase("restart"):
+            self.compose("up", "-d")
+
+        with timer.phase("prune"):
+            self.compose("prune", "-f")
+
+        self.report.phases = timer.phases
+        print("%s upgraded: %s, downtime: %s" % (self.name, timer, runez.represented_duration(timer.elapsed("restart"))))
+        return timer
+
+
+class PhaseTimer:
+    """Time spent in each phase of an operation"""
+
+    def __init__(self):
+        self.phases = []  # type: list[list] # Pairs of [phase name, elapsed seconds], in order of completion
+
+    def __repr__(self):
+        return ", ".join("%s %s" % (name, runez.represented_duration(elapsed)) for name, elapsed in self.phases)
+
+    def elapsed(self, name):
+        return sum(elapsed for n, elapsed in self.phases if n == name)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        started = time.time()
+        try:
+            yield
+
+        finally:
+            self.phases.append([name, time.time() - started])
+
+    def timed(self, name, func, *args):
+        with self.phase(name):
+            return func(*args)
+
+
+class RunReport:
+    """Timings of all steps (external commands, syncs) of one operation on a service"""
+
+    def __init__(self, service, operation):
+        self.service = service
+        self.operation = operation
+        self.started = time.time()
+        self.elapsed = None
+        self.problem = None
+        self.steps = []  # type: list[dict]
+        self.phases = None  # type: list[list]
+
+    def __repr__(self):
+        return "%s %s" % (self.operation, self.service)
+
+    def add_step(self, command, elapsed, **info):
+        self.steps.append(dict(command=command, elapsed=round(elapsed, 4), **info))
+
+    def as_dict(self):
+        result = dict(operation=self.operation, timestamp=round(self.started, 3), elapsed=self.elapsed, steps=self.steps)
+        if self.problem:
+            result["problem"] = self.problem
+
+        if self.phases:
+            result["phases"] = {name: round(elapsed, 4) for name, elapsed in self.phases}
+
+        return result
+
+    def save(self, path):
+        """Append this report, as one json line, to 'path'"""
+        self.elapsed = round(time.time() - self.started, 4)
+        if not runez.DRYRUN:
+            runez.ensure_folder(os.path.dirname(path), logger=None)
+            with open(path, "a") as fh:
+                fh.write("%s\n" % json.dumps(self.as_dict(), sort_keys=True))
+
+
+def step_trends(reports):
+    """
+    Args:
+        reports (list[dict]): Run reports, oldest first
+
+    Returns:
+        (list[list]): Per step command: [command, count, average, fastest, slowest, last] (in seconds)
+    """
+    by_command = {}
+    for report in reports:
+        for step in report.get("steps") or []:
+            by_command.setdefault(step["command"], []).append(step["elapsed"])
+
+    result = []
+    for command, timings in sorted(by_command.items()):
+        result.append([command, len(timings), sum(timings) / len(timings), min(timings), max(timings), timings[-1]])
+
+    return result
+
+
+class ContainerStates:
+    """State of all docker-compose containers on this host, via one single 'docker ps' call, cached briefly"""
+
+    fmt = '{{.Label "com.docker.compose.project"}}\t{{.Label "com.docker.compose.service"}}\t{{.State}}\t{{.Status}}'
+
+    def __init__(self, cache_path, ttl=DEFAULT_STATUS_TTL):
+        """
+        Args:
+            cache_path (str): Where to cache last 'docker ps' result
+            ttl (float): Cached result is reused if younger than this many seconds
+        """
+        self.cache_path = cache_path
+        self.ttl = ttl
+
+    def __repr__(self):
+        return runez.short(self.cache_path)
+
+    def _fetched(self):
+        r = runez.run("docker", "ps", "-a", "--filter", "label=com.docker.compose.project", "--format", self.fmt, fatal=False, logger=None)
+        if not r.succeeded:
+            return None
+
+        projects = {}
+        for line in r.output.splitlines():
+            project, service, state, status = (line.split("\t") + ["", "", "", ""])[:4]
+            projects.setdefault(project, []).append(dict(service=service, state=state, status=status))
+
+        return projects
+
+    @runez.cached_property
+    def by_project(self):
+        """
+        Returns:
+            (dict[str, list[dict]] | None): Containers per docker-compose project, None if docker is not available
+        """
+        cached = runez.read_json(self.cache_path)
+        if cached and self.ttl and 0 <= time.time() - cached.get("timestamp", 0) < self.ttl:
+            return cached.get("projects")
+
+        projects = self._fetched()
+        if projects is not None and self.ttl:
+            runez.save_json(dict(timestamp=time.time(), projects=projects), self.cache_path, logger=None, dryrun=False)
+
+        return projects
+
+
+class ServiceOutcome:
+    def __init__(self, service, problem=None, elapsed=None, skipped=False):
+        self.service = service
+        self.problem = problem
+        self.elapsed = elapsed
+        self.skipped = skipped
+
+    def __repr__(self):
+        if self.skipped:
+            return "%s: %s (%s)" % (self.service, runez.orange("skipped"), self.problem)
+
+        if self.problem:
+            return "%s: %s (%s)" % (self.service, runez.red("failed"), self.problem)
+
+        return "%s: %s in %s" % (self.service, runez.green("OK"), runez.represented_duration(self.elapsed))
+
+    @property
+    def succeeded(self):
+        return not self.problem
+
+
+class ServiceScheduler:
+    """Run an operation on several services, concurrently when their dependencies allow it"""
+
+    def __init__(self, services, jobs=DEFAULT_JOBS, kind="service"):
+        """
+        Args:
+            services (list[DCService]): Services to operate on
+            jobs (int): Max number of services operated on concurrently
+            kind (str): What is being scheduled, for reporting (eg: 'hook')
+        """
+        self.services = {s.name: s for s in services}
+        self.jobs = max(1, jobs or DEFAULT_JOBS)
+        self.kind = kind
+
+    def prerequisites(self, reverse):
+        """
+        Args:
+            reverse (bool): If True, use reverse dependency order (for shutdown)
+
+        Returns:
+            (dict[str, set[str]]): For each service name, names of services that must be done before it
+        """
+        result = {name: set() for name in self.services}
+        for name, service in self.services.items():
+            for dependency in service.dependencies:
+                if dependency in self.services:
+                    if reverse:
+                        result[dependency].add(name)
+
+                    else:
+                        result[name].add(dependency)
+
+        return result
+
+    @staticmethod
+    def _run_one(service, operation):
+        started = time.time()
+        try:
+            getattr(service, operation)()
+            return ServiceOutcome(service, elapsed=time.time() - started)
+
+        except BaseException as e:  # Includes SystemExit raised by validate() or runez.abort()
+            problem = "exit code %s" % e.code if isinstance(e, SystemExit) and isinstance(e.code, int) else str(e)
+            return ServiceOutcome(service, problem=problem or e.__class__.__name__)
+
+    def _schedule(self, pending, outcomes, running, submit):
+        """Submit all pending services that are ready to go, skip the ones with failed prerequisites"""
+        changed = True
+        while changed:
+            changed = False
+            for name in sorted(pending):
+                prerequisites = pending[name]
+                failed = [x for x in prerequisites if x in outcomes and not outcomes[x].succeeded]
+                if failed:
+                    del pending[name]
+                    outcomes[name] = ServiceOutcome(self.services[name], problem="%s failed" % ", ".join(sorted(failed)), skipped=True)
+                    changed = True
+
+                elif all(x in outcomes for x in prerequisites) and len(running) < self.jobs:
+                    del pending[name]
+                    running[submit(name)] = name
+
+    def run(self, operation, reverse=False):
+        """
+        Args:
+            operation (str): Name of DCService method to call (eg: 'start')
+            reverse (bool): If True, use reverse dependency order (for shutdown)
+
+        Returns:
+            (list[ServiceOutcome]): Outcome for each service, in order of completion
+        """
+        pending = self.prerequisites(reverse)
+        outcomes = {}  # type: dict[str, ServiceOutcome]
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            while pending or running:
+                self._schedule(pending, outcomes, running, lambda name: executor.submit(self._run_one, self.services[name], operation))
+                if not running:
+                    if pending:
+                        runez.abort("Circular dependency between %ss: %s" % (self.kind, ", ".join(sorted(pending))))
+
+                    break
+
+                names = ", ".join(sorted(running.values()))
+                runez.log.progress.show("%s %s (%s/%s done)" % (operation, names, len(outcomes), len(self.services)))
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    outcomes[name] = future.result()
 
-        self.sync()
-        self.start()
+        return list(outcomes.values())
@@ -0,0 +1,317 @@
+"""
+Built-in replacement for 'rsync -aHJ src/ dest'
+
+Semantics follow rsync: recursive, symlinks copied as symlinks (without their times, like -J),
+permissions and modification times preserved (folders included), hardlinked files remain hardlinked (-H),
+and files present only in destination are left alone (no --delete).
+
+A manifest of what was synced last time (path, size, mtime_ns, mode, inode, links, and size + mtime_ns of the
+destination) is kept per sync pair, so that entries that did not change since last sync on either side are skipped
+after a mere lstat() of the destination, without comparing them.
+"""
+
+import os
+import shutil
+import stat
+
+import runez
+
+
+def copy_file_data(source, target):
+    """Copy file content, in-kernel when possible (copy_file_range, then sendfile)"""
+    with open(source, "rb") as fsrc, open(target, "wb") as fdst:
+        remaining = os.fstat(fsrc.fileno()).st_size
+        for func in (getattr(os, "copy_file_range", None), getattr(os, "sendfile", None)):
+            if func is None:
+                continue
+
+            try:
+                while remaining > 0:
+                    if func is os.sendfile:
+                        n = func(fdst.fileno(), fsrc.fileno(), None, remaining)
+
+                    else:
+                        n = func(fsrc.fileno(), fdst.fileno(), remaining)
+
+                    if n == 0:
+                        break  # Not supported for this file (some filesystems report 0), carry on with next method
+
+                    remaining -= n
+
+                if remaining <= 0:
+                    return
+
+            except OSError:
+                continue
+
+        fsrc.seek(0)
+        fdst.seek(0)
+        fdst.truncate()
+        shutil.copyfileobj(fsrc, fdst)
+        if fdst.tell() != os.fstat(fsrc.fileno()).st_size:
+            raise OSError("Could not copy %s: size changed while copying" % runez.short(source))
+
+
+class SyncEntry:
+    """State of one source entry, as recorded in the manifest"""
+
+    def __init__(self, relative_path, st, link=None):
+        self.relative_path = relative_path
+        self.kind = "d" if stat.S_ISDIR(st.st_mode) else "l" if stat.S_ISLNK(st.st_mode) else "f"
+        self.size = st.st_size
+        self.mtime_ns = st.st_mtime_ns
+        self.mode = stat.S_IMODE(st.st_mode)
+        self.inode = [st.st_dev, st.st_ino]
+        self.links = st.st_nlink
+        self.link = link  # Symlink destination
+        self.target_state = None  # type: list # [size, mtime_ns] of destination entry, if it exists
+
+    def __repr__(self):
+        return self.relative_path
+
+    def as_record(self):
+        return [self.kind, self.size, self.mtime_ns, self.mode, self.inode, self.links, self.link, self.target_state]
+
+
+class SyncAction:
+    def __init__(self, action, entry, other=None):
+        """
+        Args:
+            action (str): One of: mkdir, copy, link (hardlink), symlink, chmod, touch
+            entry (SyncEntry): Source entry concerned
+            other (str | None): For hardlinks: relative path of the first file of the hardlink group
+        """
+        self.action = action
+        self.entry = entry
+        self.other = other
+
+    def __repr__(self):
+        if self.action == "link":
+            return "link %s => %s" % (self.entry, self.other)
+
+        if self.action == "symlink":
+            return "symlink %s -> %s" % (self.entry, self.entry.link)
+
+        return "%s %s" % (self.action, self.entry)
+
+
+class SyncPlan:
+    def __init__(self, engine):
+        self.engine = engine
+        self.actions = []  # type: list[SyncAction]
+        self.entries = []  # type: list[SyncEntry]
+        self.skipped = 0
+
+    def __repr__(self):
+        counts = {}
+        for action in self.actions:
+            counts[action.action] = counts.get(action.action, 0) + 1
+
+        text = ", ".join("%s %s" % (v, k) for k, v in sorted(counts.items()))
+        return "%s: %s, %s unchanged" % (self.engine, text or "nothing to do", self.skipped)
+
+    def __len__(self):
+        return len(self.actions)
+
+    @property
+    def records(self):
+        return {e.relative_path: e.as_record() for e in self.entries}
+
+
+class SyncEngine:
+    """Sync content of 'source' folder into 'target' folder, same as 'rsync -aHJ source/ target'"""
+
+    def __init__(self, source, target, manifest_path=None):
+        """
+        Args:
+            source (str): Folder to sync from
+            target (str): Folder to sync to
+            manifest_path (str | None): Where to keep record of last sync (if None: always compare with target)
+        """
+        self.source = source
+        self.target = target
+        self.manifest_path = manifest_path
+        self.manifest = runez.read_json(manifest_path, default={}) if manifest_path else {}  # type: dict[str, list]
+
+    def __repr__(self):
+        return "%s/ -> %s" % (runez.short(self.source), runez.short(self.target))
+
+    def scanned(self, folder=None, prefix=""):
+        """Yields SyncEntry for every entry under 'folder' (recursively, folders before their content)"""
+        with os.scandir(folder or self.source) as it:
+            for item in sorted(it, key=lambda x: x.name):
+                relative_path = prefix + item.name
+                st = item.stat(follow_symlinks=False)
+                link = os.readlink(item.path) if stat.S_ISLNK(st.st_mode) else None
+                entry = SyncEntry(relative_path, st, link=link)
+                yield entry
+                if entry.kind == "d":
+                    yield from self.scanned(item.path, prefix=relative_path + "/")
+
+    def _target_state(self, entry):
+        try:
+            return os.lstat(os.path.join(self.target, entry.relative_path))
+
+        except FileNotFoundError:
+            return None
+
+    @staticmethod
+    def _state_record(st):
+        return None if st is None else [st.st_size, st.st_mtime_ns]
+
+    def plan(self, full=False):
+        """
+        Args:
+            full (bool): If True, ignore manifest and compare every entry with target
+
+        Returns:
+            (SyncPlan): What needs to be done to bring target in sync
+        """
+        plan = SyncPlan(self)
+        hardlinks = {}  # type: dict[tuple, str] # First relative path seen for each (dev, inode) of a multi-link file
+        acted = set()  # Relative paths that need an action (hardlinks to them must then be re-checked)
+        for entry in self.scanned():
+            plan.entries.append(entry)
+            first = None
+            if entry.kind == "f" and entry.links > 1:
+                key = tuple(entry.inode)
+                first = hardlinks.get(key)
+                if first is None:
+                    hardlinks[key] = entry.relative_path
+
+            current = self._target_state(entry)
+            entry.target_state = self._state_record(current)
+            if not full and first not in acted and self.manifest.get(entry.relative_path) == entry.as_record():
+                plan.skipped += 1
+                continue
+
+            action = self._action(entry, current, first)
+            if action:
+                plan.actions.append(action)
+                acted.add(entry.relative_path)
+
+            else:
+                plan.skipped += 1
+
+        return plan
+
+    def _action(self, entry, current, first):
+        """Action needed for 'entry' given 'current' lstat of target (rsync quick-check: size + mtime)"""
+        if entry.kind == "d":
+            if current is None or not stat.S_ISDIR(current.st_mode):
+                return SyncAction("mkdir", entry)
+
+            if stat.S_IMODE(current.st_mode) != entry.mode:
+                return SyncAction("chmod", entry)
+
+            if current.st_mtime_ns != entry.mtime_ns:
+                return SyncAction("touch", entry)
+
+            return None
+
+        if entry.kind == "l":
+            target = os.path.join(self.target, entry.relative_path)
+            if current is None or not stat.S_ISLNK(current.st_mode) or os.readlink(target) != entry.link:
+                return SyncAction("symlink", entry)
+
+            return None
+
+        if first is not None:
+            first_target = os.path.join(self.target, first)
+            if current is None or not os.path.exists(first_target) or not os.path.samestat(os.stat(first_target), current):
+                return SyncAction("link", entry, other=first)
+
+            return None
+
+        if current is None or not stat.S_ISREG(current.st_mode) or current.st_size != entry.size:
+            return SyncAction("copy", entry)
+
+        if current.st_mtime_ns != entry.mtime_ns:
+            return SyncAction("copy", entry)
+
+        if stat.S_IMODE(current.st_mode) != entry.mode:
+            return SyncAction("chmod", entry)
+
+    def execute(self, plan):
+        """Carry out 'plan', then save manifest"""
+        touched_folders = set()
+        for action in plan.actions:
+            entry = action.entry
+            target = os.path.join(self.target, entry.relative_path)
+            touched_folders.add(os.path.dirname(entry.relative_path))
+            if action.action == "mkdir":
+                if os.path.lexists(target) and not os.path.isdir(target):
+                    os.unlink(target)
+
+                os.makedirs(target, exist_ok=True)
+                os.chmod(target, entry.mode)
+                touched_folders.add(entry.relative_path)
+
+            elif action.action == "chmod":
+                os.chmod(target, entry.mode)
+                if entry.kind == "d":
+                    touched_folders.add(entry.relative_path)
+
+            elif action.action == "touch":
+                touched_folders.add(entry.relative_path)
+
+            elif action.action == "symlink":
+                self._replace(target, lambda temp: os.symlink(entry.link, temp))
+
+            elif action.action == "link":
+                self._replace(target, lambda temp: os.link(os.path.join(self.target, action.other), temp))
+
+            else:
+                self._replace(target, lambda temp: self._copy(entry, temp))
+
+        # Restore folder mtimes last, as creating entries in them changed their mtime
+        by_path = {e.relative_path: e for e in plan.entries}
+        for relative_path in sorted(touched_folders, reverse=True):
+            entry = by_path.get(relative_path)
+            if entry is not None and entry.kind == "d":
+                os.utime(os.path.join(self.target, relative_path), ns=(entry.mtime_ns, entry.mtime_ns))
+
+        for entry in {a.entry for a in plan.actions} | {by_path[x] for x in touched_folders if x in by_path}:
+            entry.target_state = self._state_record(self._target_state(entry))
+
+        if self.manifest_path:
+            self.manifest = plan.records
+            runez.save_json(self.manifest, self.manifest_path, logger=None)
+
+    def _copy(self, entry, temp):
+        copy_file_data(os.path.join(self.source, entry.relative_path), temp)
+        os.chmod(temp, entry.mode)
+        os.utime(temp, ns=(entry.mtime_ns, entry.mtime_ns))
+
+    @staticmethod
+    def _replace(target, create):
+        """Create 'target' via a temp file in same folder + rename, like rsync does"""
+        folder, name = os.path.split(target)
+        temp = os.path.join(folder, ".%s.gdot-sync" % name)
+        if os.path.lexists(temp):
+            os.unlink(temp)
+
+        create(temp)
+        if os.path.isdir(target) and not os.path.islink(target):
+            runez.delete(target, logger=None)
+
+        os.replace(temp, target)
+
+    def run(self, full=False):
+        """
+        Args:
+            full (bool): If True, ignore manifest and compare every entry with target
+
+        Returns:
+            (SyncPlan): Plan that was executed (or only shown, in dryrun mode)
+        """
+        runez.ensure_folder(self.target, logger=None)
+        plan = self.plan(full=full)
+        if runez.DRYRUN:
+            for action in plan.actions:
+                print(action)
+
+        elif plan.actions or (self.manifest_path and plan.records != self.manifest):
+            self.execute(plan)
+
+        return plan
@@ -0,0 +1,153 @@
+"""
+Per-host/per-user templated dotfiles
+
+Templates live in the store's 'templates/' folder (mirroring the layout of ~),
+'{{keyword}}' markers are replaced by variables such as {{hostname}} or {{userid}}.
+
+Rendering is incremental: each output remembers its inputs (template digest + values of the variables it uses),
+and is re-rendered only when one of those inputs changed.
+"""
+
+import hashlib
+import os
+import re
+
+import runez
+
+
+MARKER = re.compile(r"\{\{\s*(\w+)\s*\}\}")
+
+
+def digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+class RenderPlan:
+    """Template compiled once into a list of (literal text, variable name) chunks"""
+
+    def __init__(self, chunks):
+        self.chunks = chunks  # type: list[list] # Pairs of literal text, variable name (None for trailing text)
+
+    @classmethod
+    def compiled(cls, text):
+        chunks = []
+        pos = 0
+        for m in MARKER.finditer(text):
+            chunks.append([text[pos:m.start()], m.group(1)])
+            pos = m.end()
+
+        chunks.append([text[pos:], None])
+        return cls(chunks)
+
+    @property
+    def variables(self):
+        return sorted(set(name for _, name in self.chunks if name))
+
+    def rendered(self, variables):
+        return "".join(text + (variables[name] if name else "") for text, name in self.chunks)
+
+
+class TemplateEngine:
+    def __init__(self, source, target, state_folder, variables):
+        """
+        Args:
+            source (str): Folder containing templates
+            target (str): Folder where to render the templates (typically ~)
+            state_folder (str): Local folder where to keep render records and compiled plans
+            variables (dict): Variables available to templates
+        """
+        self.source = source
+        self.target = target
+        self.state_folder = state_folder
+        self.variables = {k: str(v) for k, v in variables.items()}
+        self.records_path = os.path.join(state_folder, "rendered.json")
+        self.records = runez.read_json(self.records_path, default={})  # type: dict[str, dict]
+        self._plans = {}  # type: dict[str, RenderPlan]
+        self._pending_records = None  # type: dict[str, dict]
+
+    def __repr__(self):
+        return runez.short(self.source)
+
+    def templates(self):
+        """Relative paths of all templates, sorted"""
+        result = []
+        for root, dirs, files in os.walk(self.source):
+            for name in files:
+                result.append(os.path.relpath(os.path.join(root, name), self.source))
+
+        return sorted(result)
+
+    def plan(self, template_digest, content):
+        """Compiled plan for template with given digest, compiled once and then cached on disk"""
+        plan = self._plans.get(template_digest)
+        if plan is None:
+            path = os.path.join(self.state_folder, "plans", "%s.json" % template_digest)
+            chunks = runez.read_json(path)
+            if chunks is None:
+                plan = RenderPlan.compiled(content.decode("utf-8"))
+                runez.save_json(plan.chunks, path, logger=None)
+
+            else:
+                plan = RenderPlan(chunks)
+
+            self._plans[template_digest] = plan
+
+        return plan
+
+    def is_up_to_date(self, relative_path, record, st):
+        """Is output 'relative_path' up to date, given its last 'record' and current stat 'st' of its template"""
+        if not record or record.get("stat") != [st.st_size, st.st_mtime_ns]:
+            return False
+
+        if not os.path.exists(os.path.join(self.target, relative_path)):
+            return False
+
+        return all(self.variables.get(k) == v for k, v in record["variables"].items())
+
+    def render_all(self, transaction):
+        """
+        Args:
+            transaction (gdot.transaction.ApplyTransaction): Transaction to stage rendered outputs into
+
+        Returns:
+            (list[str]): Relative paths of outputs that were (re-)rendered
+        """
+        rendered = []
+        records = {}
+        for relative_path in self.templates():
+            source = os.path.join(self.source, relative_path)
+            st = os.stat(source)
+            record = self.records.get(relative_path)
+            if self.is_up_to_date(relative_path, record, st):
+                records[relative_path] = record
+                continue
+
+            with open(source, "rb") as fh:
+                content = fh.read()
+
+            template_digest = digest(content)
+            plan = self.plan(template_digest, content)
+            missing = [k for k in plan.variables if k not in self.variables]
+            if missing:
+                runez.abort("Template %s uses undefined variable(s): %s" % (runez.short(source), ", ".join(missing)))
+
+            used = {k: self.variables[k] for k in plan.variables}
+            target = os.path.join(self.target, relative_path)
+            if not record or record.get("digest") != template_digest or record.get("variables") != used or not os.path.exists(target):
+                with transaction.staged(target) as fh:
+                    fh.write(plan.rendered(self.variables).encode("utf-8"))
+
+                rendered.append(relative_path)
+
+            records[relative_path] = dict(stat=[st.st_size, st.st_mtime_ns], digest=template_digest, variables=used)
+
+        self._pending_records = records
+        return rendered
+
+    def save_records(self):
+        """Save render records, to be called once rendered outputs were committed"""
+        if self._pending_records is not None and self._pending_records != self.records and not runez.DRYRUN:
+            runez.save_json(self._pending_records, self.records_path, logger=None)
+            self.records = self._pending_records
+
+        self._pending_records = None
@@ -0,0 +1,188 @@
+"""
+Atomic, group-committed writing of many files
+
+All files are first staged into temp files next to their target (same filesystem), then:
+- file data is fsync-ed in one batch (instead of write + fsync per file)
+- journal is marked as committed
+- temp files are swapped in via os.replace(), followed by one fsync per parent folder
+
+The journal is append-only (one json line per staged file, then a final commit marker), and is fsync-ed only once.
+If interrupted, it allows to roll back (crash while staging) or roll forward (crash after commit marker).
+"""
+
+import contextlib
+import json
+import os
+import stat
+
+import runez
+
+
+COMMIT_MARKER = "committed"
+TEMP_SUFFIX = ".gdot-tmp"
+
+
+def fsync_path(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+
+    finally:
+        os.close(fd)
+
+
+def applied_mode(mode, existing):
+    """
+    Args:
+        mode (int): Desired permissions (eg: from the store)
+        existing (int): Permissions of existing target
+
+    Returns:
+        (int): Permissions to give to target: owner bits of 'mode' as-is, group/other bits never looser than 'existing'
+    """
+    return stat.S_IMODE(mode) & (stat.S_IMODE(existing) | stat.S_IRWXU)
+
+
+class ApplyTransaction:
+    def __init__(self, journal_path):
+        """
+        Args:
+            journal_path (str): Path to journal file, must be on local (non-roaming) storage
+        """
+        self.journal_path = os.path.abspath(journal_path)
+        self.entries = []  # type: list[list[str]] # Pairs of [temp file, target]
+        self.synced_folders = set()
+        self._journal = None
+
+    def __repr__(self):
+        return "%s in transaction" % runez.plural(self.entries, "file")
+
+    def __enter__(self):
+        self.recover()
+        if not runez.DRYRUN:
+            runez.ensure_folder(os.path.dirname(self.journal_path), logger=None)
+            self._journal = open(self.journal_path, "w")
+
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.commit()
+
+        else:
+            self.rollback()
+
+    @property
+    def changed(self):
+        """Targets written by this transaction"""
+        return [target for _, target in self.entries]
+
+    @contextlib.contextmanager
+    def staged(self, target, mode=None):
+        """
+        Args:
+            target (str): File to write (symlinks are followed, so their destination gets updated)
+            mode (int | None): Permissions to give to the file (default: keep permissions of existing target)
+                               owner bits are applied as-is, group/other bits of an existing target never get loosened
+
+        Yields:
+            File object (binary mode) to write content to
+        """
+        target = os.path.realpath(target)
+        temp = "%s%s" % (target, TEMP_SUFFIX)
+        if runez.DRYRUN:
+            runez.log.trace("Would write %s" % runez.short(target))
+            with open(os.devnull, "wb") as fh:
+                yield fh
+
+            return
+
+        self._ensure_folder(os.path.dirname(target))
+        self.entries.append([temp, target])
+        self._journal.write("%s\n" % json.dumps([temp, target]))
+        self._journal.flush()
+        with open(temp, "wb") as fh:
+            yield fh
+
+        try:
+            existing = stat.S_IMODE(os.stat(target).st_mode)
+            mode = existing if mode is None else applied_mode(mode, existing)
+
+        except FileNotFoundError:
+            pass
+
+        if mode is not None:
+            os.chmod(temp, mode)
+
+    def commit(self):
+        if runez.DRYRUN:
+            return
+
+        if self.entries:
+            for temp, _ in self.entries:
+                fsync_path(temp)
+
+            self._journal.write(COMMIT_MARKER)
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
+            fsync_path(os.path.dirname(self.journal_path))
+
+        self._close_journal()
+        self._roll_forward()
+
+    def rollback(self):
+        self._close_journal()
+        for temp, _ in self.entries:
+            if os.path.exists(temp):
+                os.unlink(temp)
+
+        runez.delete(self.journal_path, logger=None)
+
+    def recover(self):
+        """Finish, or undo, a previously interrupted transaction"""
+        if not os.path.exists(self.journal_path):
+            return
+
+        committed = False
+        with open(self.journal_path) as fh:
+            for line in fh:
+                if line == COMMIT_MARKER:
+                    committed = True
+
+                elif line.endswith("\n"):  # Partially written last line can be ignored
+                    self.entries.append(json.loads(line))
+
+        if committed:
+            runez.log.trace("Rolling forward interrupted transaction: %s" % self)
+            self._roll_forward()
+
+        else:
+            runez.log.trace("Rolling back interrupted transaction: %s" % self)
+            self.rollback()
+
+        self.entries = []
+
+    def _roll_forward(self):
+        folders = set(self.synced_folders)
+        for temp, target in self.entries:
+            if os.path.exists(temp):
+                os.replace(temp, target)
+
+            folders.add(os.path.dirname(target))
+
+        for folder in sorted(folders):
+            fsync_path(folder)
+
+        runez.delete(self.journal_path, logger=None)
+
+    def _ensure_folder(self, folder):
+        if not os.path.isdir(folder):
+            parent = os.path.dirname(folder)
+            self._ensure_folder(parent)
+            os.mkdir(folder)
+            self.synced_folders.add(parent)
+
+    def _close_journal(self):
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
@@ -1,5 +1,6 @@
 import os
 
+import pytest
 import runez
 from runez.conftest import cli
 
@@ -10,12 +11,25 @@ from gdot.commands import main
 def full_path(*relative_path):
     pwd = os.getcwd()
     assert "private" in pwd or "tmp" in pwd, "Test ran in non-temp folder"
-    relative = os.path.join(*relative_path)
+    relative = os.path.join("store", *relative_path)
     assert not os.path.isabs(relative), "Abs path not allowed: %s" % relative
     return os.path.join(pwd, relative)
 
 
+@pytest.fixture
+def home(cli, monkeypatch):
+    """Isolated ~ folder"""
+    path = os.path.abspath("home")
+    monkeypatch.setattr(GDEnv, "user_home", path)
+    for key in ("AUTHOR", "COMMITTER"):
+        monkeypatch.setenv("GIT_%s_NAME" % key, "tester")
+        monkeypatch.setenv("GIT_%s_EMAIL" % key, "tester@example.com")
+
+    return path
+
+
 cli.default_main = main
 GDEnv.userid = "tester"
+GDEnv.maintenance_interval = 0  # Don't spawn background 'gdot gc' from tests
 GDEnv.base_folder.path = runez.UNSET
 GDEnv.base_folder.full_path = full_path
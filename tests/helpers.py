@@ -0,0 +1,24 @@
+"""Helpers shared by tests"""
+
+import os
+
+import runez
+
+
+def git(*args):
+    return runez.run("git", "-c", "user.name=tester", "-c", "user.email=tester@example.com", *args, logger=None).output
+
+
+def bare_remote(name, seed=None):
+    """Local bare repo, optionally seeded with one commit containing file 'seed'"""
+    path = os.path.abspath("remotes/%s.git" % name)
+    git("init", "-q", "--bare", path)
+    if seed:
+        work = os.path.abspath("seed-%s" % name)
+        git("init", "-q", work)
+        runez.write(os.path.join(work, "seed"), seed, logger=None)
+        git("-C", work, "add", "seed")
+        git("-C", work, "commit", "-q", "-m", "seed")
+        git("-C", work, "push", "-q", path, "HEAD:main")
+
+    return path
@@ -0,0 +1,91 @@
+import os
+
+import runez
+from helpers import bare_remote, git
+
+from gdot import GDotXBase
+from gdot.autosync import AutoSync
+from gdot.lock import StoreLock
+
+
+def test_autosync(cli, home):
+    remote = bare_remote("r1")
+    bashrc = os.path.join(home, ".bashrc")
+    runez.write(bashrc, "echo hello", logger=None)
+    cli.run("attach", remote)
+    cli.run("add", bashrc)
+    cli.run("push")
+    assert cli.succeeded
+
+    cli.run("autosync", "--once")
+    assert cli.succeeded
+    assert "up to date" in cli.logged.stdout
+
+    gdotx = GDotXBase()
+    runez.delete(gdotx.gv.cache_path("autosync.json"), logger=None)  # Start from a clean state, with a fake clock
+    syncer = AutoSync(gdotx, debounce=30, max_delay=100, min_interval=60, max_interval=300)
+    assert syncer.tick(now=1000) == "up to date"
+    assert syncer.tick(now=1010) is None  # Next sync is due in 2 minutes, interval doubled while idle
+    assert syncer.next_sync == 1120
+
+    # Successive edits get coalesced in one commit, once they settle down
+    runez.write(bashrc, "echo hello\necho 1", logger=None)
+    assert syncer.tick(now=1020) == "waiting for 1 pending change to settle"
+    runez.write(bashrc, "echo hello\necho 1\necho 2", logger=None)
+    runez.write(os.path.join(home, ".bashrc"), "echo hello\necho 12", logger=None)
+    assert syncer.tick(now=1040) == "waiting for 1 pending change to settle"
+    assert syncer.tick(now=1069) == "waiting for 1 pending change to settle"
+    assert git("-C", remote, "log", "-1", "--format=%s", "main") == "Updated from %s" % gdotx.gv.hostname
+    assert syncer.tick(now=1070) == "synced"
+    assert git("-C", remote, "log", "-1", "--format=%s", "main") == "Auto-sync from %s: 1 file" % gdotx.gv.hostname
+    assert syncer.next_sync == 1130
+    assert "pending" not in syncer.state
+
+    # Busy lock: autosync does not wait
+    with StoreLock(gdotx.lock.path):
+        assert syncer.tick(now=1200).startswith("busy: another gdot process")
+
+    # Failures back off exponentially, up to max_interval
+    os.rename(remote, remote + ".moved")
+    assert syncer.tick(now=1200) == "sync failed (1 in a row), retrying in 1 minute"
+    assert syncer.tick(now=1259) is None
+    assert syncer.tick(now=1260) == "sync failed (2 in a row), retrying in 2 minutes"
+    assert syncer.tick(now=1380) == "sync failed (3 in a row), retrying in 4 minutes"
+    assert syncer.tick(now=1620) == "sync failed (4 in a row), retrying in 5 minutes"
+    assert syncer.state["failures"] == 4
+    assert syncer.state["error"]
+
+    os.rename(remote + ".moved", remote)
+    assert syncer.tick(now=1920) == "up to date"
+    assert "failures" not in syncer.state
+
+    # Files that never stop changing still get committed, after max_delay
+    for i in range(4):
+        runez.write(bashrc, "echo %s" % i, logger=None)
+        assert syncer.tick(now=2000 + 25 * i).startswith("waiting")
+
+    runez.write(bashrc, "echo last", logger=None)
+    assert syncer.tick(now=2100) == "synced"
+    assert list(runez.readlines(os.path.join("store", "home", ".bashrc"))) == ["echo last"]
+
+    # Remote side edits get pulled in
+    other = os.path.abspath("other")
+    git("clone", "-q", "-b", "main", remote, other)
+    runez.write(os.path.join(other, "home", ".bashrc"), "echo other", logger=None)
+    git("-C", other, "commit", "-q", "-a", "-m", "other")
+    git("-C", other, "push", "-q", "origin", "HEAD:main")
+    assert syncer.tick(now=2200) == "synced"
+    assert list(runez.readlines(bashrc)) == ["echo other"]
+
+    # Local and remote commits diverged: they get merged
+    runez.write(os.path.join(other, "vars", "default.json"), '{"email": "tester@example.com"}', logger=None)
+    git("-C", other, "add", ".")
+    git("-C", other, "commit", "-q", "-m", "vars")
+    git("-C", other, "push", "-q", "origin", "HEAD:main")
+    runez.write(bashrc, "echo mine", logger=None)
+    assert syncer.tick(now=2300).startswith("waiting")
+    assert syncer.tick(now=2330) == "synced"
+    assert git("-C", remote, "log", "-1", "--format=%s", "main") == "Merge remote-tracking branch 'origin/main'"
+    assert git("-C", remote, "log", "-1", "--format=%s", "main^1") == "Auto-sync from %s: 1 file" % gdotx.gv.hostname
+    assert git("-C", remote, "log", "-1", "--format=%s", "main^2") == "vars"
+    assert list(runez.readlines(bashrc)) == ["echo mine"]
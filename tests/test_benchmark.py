@@ -0,0 +1,132 @@
+"""
+End-to-end timing of gdot store operations, on a synthetic ~ at several scales
+
+Configurable via env vars:
+- GDOT_BENCHMARK_SCALES: comma separated number of files to run with (default: 50,400)
+- GDOT_BENCHMARK_FILE_SIZE: size in bytes of each synthetic file (default: 2048)
+- GDOT_BENCHMARK_BASELINE: json file where to record results, and compare them with previously recorded ones
+
+Growth across scales is checked only when GDOT_BENCHMARK_SCALES is given: timings at default scales are too small to be meaningful.
+"""
+
+import math
+import os
+import time
+
+import runez
+from helpers import bare_remote, git
+from runez.render import PrettyTable
+
+from gdot import __version__
+
+
+OPERATIONS = ["add", "status", "diff", "push", "attach", "pull"]
+MAX_EXPONENT = 1.5  # Time growing faster than n^1.5 across scales is flagged (O(n^2) would be ~2)
+
+
+def synthetic_home(home, count, size, modified=None):
+    """Create (or modify every 'modified'-th of) 'count' files of 'size' bytes under ~/bench/"""
+    for i in range(count):
+        if modified is None or i % modified == 0:
+            line = "%s line %s %s\n" % ("modified" if modified else "original", i, "x" * 40)
+            content = (line * (size // len(line) + 1))[:size]
+            runez.write(os.path.join(home, "bench", "d%s" % (i // 50), "f%s.txt" % i), content, logger=None)
+
+
+def timed(cli, timings, operation, *args):
+    started = time.perf_counter()
+    cli.run(operation, *args)
+    timings[operation] = time.perf_counter() - started
+    assert cli.succeeded, "gdot %s failed: %s" % (operation, cli.logged)
+
+
+def run_scale(cli, home, count, size):
+    """
+    Returns:
+        (dict[str, float]): Elapsed seconds per operation, with 'count' files of 'size' bytes
+    """
+    timings = {}
+    runez.delete(home, logger=None)
+    runez.delete("store", logger=None)
+    remote = bare_remote("r%s" % count)
+    synthetic_home(home, count, size)
+    cli.run("attach", remote)
+    assert cli.succeeded
+    timed(cli, timings, "add", os.path.join(home, "bench"))
+    synthetic_home(home, count, size, modified=10)
+    timed(cli, timings, "status")
+    assert cli.logged.stdout.contents().count("modified") == math.ceil(count / 10)
+    timed(cli, timings, "diff")
+    timed(cli, timings, "push")
+
+    # Simulate another machine attaching to the now populated remote
+    runez.delete(home, logger=None)
+    runez.delete("store", logger=None)
+    timed(cli, timings, "attach", remote)
+    assert sum(len(files) for _, _, files in os.walk(os.path.join(home, "bench"))) == count
+
+    # Simulate another machine pushing a change to 10% of the files
+    other = os.path.abspath("other%s" % count)
+    git("clone", "-q", "-b", "main", remote, other)
+    synthetic_home(os.path.join(other, "home"), count, size, modified=9)
+    git("-C", other, "commit", "-q", "-a", "-m", "other")
+    git("-C", other, "push", "-q", "origin", "HEAD:main")
+    timed(cli, timings, "pull")
+    return timings
+
+
+def growth_exponents(results):
+    """Exponent e such that time grows as n^e, between smallest and largest scale, per operation"""
+    small, large = min(results), max(results)
+    exponents = {}
+    for operation in OPERATIONS:
+        ratio = results[large][operation] / max(results[small][operation], 1e-6)
+        exponents[operation] = math.log(max(ratio, 1e-6)) / math.log(large / small)
+
+    return exponents
+
+
+def recorded(baseline_path, entry):
+    """Append 'entry' to json baseline, return previous comparable entry (same scales and file size), if any"""
+    history = runez.read_json(baseline_path, default=[])
+    previous = [x for x in history if x["scales"].keys() == entry["scales"].keys() and x["file_size"] == entry["file_size"]]
+    history.append(entry)
+    runez.save_json(history, baseline_path, logger=None)
+    return previous[-1] if previous else None
+
+
+def test_scaling(cli, home):
+    scales = [int(x) for x in os.environ.get("GDOT_BENCHMARK_SCALES", "50,400").split(",")]
+    size = int(os.environ.get("GDOT_BENCHMARK_FILE_SIZE", 2048))
+    results = {count: run_scale(cli, home, count, size) for count in sorted(scales)}
+    exponents = growth_exponents(results)
+    entry = dict(
+        timestamp=time.strftime("%Y-%m-%d %H:%M:%S"),
+        version=__version__,
+        file_size=size,
+        scales={str(k): v for k, v in results.items()},
+        exponents=exponents,
+    )
+    previous = None
+    baseline_path = os.environ.get("GDOT_BENCHMARK_BASELINE")
+    if baseline_path:
+        previous = recorded(baseline_path, entry)
+
+    table = PrettyTable(["operation"] + ["n=%s" % x for x in results] + ["exponent", "vs baseline"])
+    for operation in OPERATIONS:
+        row = [operation] + ["%.3fs" % results[count][operation] for count in results] + ["%.2f" % exponents[operation]]
+        if previous:
+            key = str(max(results))
+            row.append("%+.0f%%" % (100 * (results[max(results)][operation] / previous["scales"][key][operation] - 1)))
+
+        else:
+            row.append("-")
+
+        table.add_row(row)
+
+    print(table)
+    if "GDOT_BENCHMARK_SCALES" not in os.environ:
+        return
+
+    flagged = {k: round(v, 2) for k, v in exponents.items() if v > MAX_EXPONENT}
+    assert not flagged, "Super-linear growth detected: %s" % flagged
@@ -0,0 +1,27 @@
+import os
+import sys
+
+import runez
+
+from gdot.bundle import build_shrinky, shrinky_source
+
+
+def test_build_shrinky(cli):
+    target = build_shrinky(target="bundle/shrinky.pyc", python=sys.executable)
+    assert target == os.path.abspath("bundle/shrinky.pyc")
+    runez.ensure_folder("foo/bar", logger=None)
+    expected = runez.run(sys.executable, shrinky_source(), "clean_path", "-pfoo:baz:foo:foo/bar", logger=None).output
+    assert expected == "foo:foo/bar"
+    assert runez.run(sys.executable, "-S", target, "clean_path", "-pfoo:baz:foo:foo/bar", logger=None).output == expected
+
+    # Heavy std libs are not imported by commands that don't need them
+    r = runez.run(sys.executable, "-S", "-X", "importtime", target, "clean_path", logger=None)
+    imported = [line.rpartition("|")[2].strip() for line in r.error.splitlines()]
+    assert "re" not in imported
+    assert "pathlib" not in imported
+    assert "subprocess" not in imported
+
+    cli.run("shrinky", "--python", sys.executable, "--target", "installed/shrinky.pyc")
+    assert cli.succeeded
+    assert "Installed" in cli.logged.stdout
+    assert os.path.isfile("installed/shrinky.pyc")
@@ -0,0 +1,91 @@
+import io
+import os
+
+import runez
+
+from gdot.chunks import appended, chunked, ChunkManifest, ChunkStore, MAX_CHUNK, merged_appends, MIN_CHUNK
+
+
+def history(count, start=0):
+    return b"".join(b": 1700000000:0;echo command number %d\n" % i for i in range(start, start + count))
+
+
+def test_chunked():
+    assert list(chunked(io.BytesIO(b""))) == []
+    assert list(chunked(io.BytesIO(b"foo"))) == [b"foo"]
+
+    content = history(20000)
+    chunks = list(chunked(io.BytesIO(content)))
+    assert b"".join(chunks) == content
+    assert len(chunks) > 2
+    assert all(MIN_CHUNK <= len(c) <= MAX_CHUNK for c in chunks[:-1])
+
+    # Appending only changes the last chunk
+    appended = list(chunked(io.BytesIO(content + history(10, start=20000))))
+    assert appended[:-1] == chunks[:-1]
+
+    # Files without newlines are still chunked with bounded size
+    blob = b"x" * (MAX_CHUNK * 2 + 5)
+    assert [len(c) for c in chunked(io.BytesIO(blob))] == [MAX_CHUNK, MAX_CHUNK, 5]
+
+
+def test_store(cli):
+    runez.write("history", history(20000), logger=None)
+    store = ChunkStore("chunks")
+    manifest = store.store("history")
+    assert manifest.size == os.path.getsize("history")
+    assert manifest.digest == runez.checksum("history")
+    initial = sorted(store.all_digests())
+    assert initial == sorted(set(manifest.chunks))
+
+    manifest.save("history.gdot-chunks")
+    assert ChunkManifest.from_file("history.gdot-chunks") == manifest
+    assert ChunkManifest.from_file("history") is None
+
+    # Only new chunks get stored
+    with open("history", "ab") as fh:
+        fh.write(history(10, start=20000))
+
+    manifest2 = store.store("history")
+    assert manifest2 != manifest
+    assert len(set(store.all_digests()) - set(initial)) == 1
+
+    with open("restored", "wb") as fh:
+        store.restore(manifest2, fh)
+
+    assert runez.checksum("restored") == runez.checksum("history")
+
+    # A chunk truncated by an interrupted write gets rewritten, temp files are not seen as chunks
+    last = store.chunk_path(manifest2.chunks[-1])
+    with open(last, "r+b") as fh:
+        fh.truncate(10)
+
+    runez.touch(last + ".123.tmp", logger=None)
+    assert store.store("history") == manifest2
+    with open("restored", "wb") as fh:
+        store.restore(manifest2, fh)
+
+    assert runez.checksum("restored") == runez.checksum("history")
+    assert manifest2.chunks[-1] in store.all_digests()
+    assert len(list(store.all_digests())) == len(set(store.all_digests()))
+
+    store.prune(set(manifest2.chunks))
+    assert sorted(store.all_digests()) == sorted(set(manifest2.chunks))
+    assert not os.path.exists(last + ".123.tmp")
+
+
+def test_merged_appends():
+    base = history(100)
+    assert appended(base, base) == b""
+    assert appended(base, base + history(2, start=100)) == history(2, start=100)
+    assert appended(base, history(99)) is None
+    assert appended(b"", b"foo\n") == b"foo\n"
+
+    # Shells trim their history from the start
+    assert appended(base, history(50, start=50) + b"new\n") == b"new\n"
+    assert appended(base, b"unrelated\n") is None
+
+    ours = base + b"ours\n"
+    theirs = history(90, start=10) + b"theirs\n"
+    assert merged_appends(base, ours, theirs) == base + b"ours\ntheirs\n"
+    assert merged_appends(base, history(10), theirs) is None
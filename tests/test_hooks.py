@@ -0,0 +1,60 @@
+import json
+import os
+import time
+
+import pytest
+import runez
+
+from gdot.hooks import Hook
+from gdot.srv import ServiceScheduler
+
+
+def is_running(pid):
+    r = runez.run("ps", "-o", "stat=", "-p", str(pid), fatal=False, logger=None)
+    return r.succeeded and not r.output.startswith("Z")  # Zombies don't count (reaping orphans is up to init)
+
+
+def test_hooks(cli):
+    runez.write("hooks.json", json.dumps({"broken": {"paths": ["*"]}}), logger=None)
+    with pytest.raises(runez.system.AbortException):
+        Hook.loaded("hooks.json", ".")
+
+    runez.write("hooks.json", json.dumps({"tmux": {"paths": [".tmux.conf"], "run": "true", "timout": 5}}), logger=None)
+    with pytest.raises(runez.system.AbortException, match="Hook 'tmux' in hooks.json has unknown key 'timout'"):
+        Hook.loaded("hooks.json", ".")
+
+    spec = {
+        "fonts": {"paths": [".local/share/fonts/*"], "run": "echo fonts >> ran.txt"},
+        "tmux": {"paths": [".tmux.conf", ".config/tmux/*"], "run": "sleep 0.2; echo tmux >> ran.txt"},
+        "completions": {"paths": [".config/zsh/*"], "run": "echo completions >> ran.txt", "after": ["tmux"]},
+        "slow": {"paths": [".slow"], "run": "sleep 30 & echo $! > grandchild.pid; wait", "timeout": 0.5},
+        "failing": {"paths": [".failing"], "run": "echo oops; exit 3", "after": ["slow"]},
+    }
+    runez.write("hooks.json", json.dumps(spec), logger=None)
+    hooks = {h.name: h for h in Hook.loaded("hooks.json", os.getcwd())}
+    assert sorted(hooks) == ["completions", "failing", "fonts", "slow", "tmux"]
+    assert hooks["tmux"].triggered_by([".bashrc", ".config/tmux/theme.conf"]) == [".config/tmux/theme.conf"]
+    assert not hooks["fonts"].triggered_by([".bashrc"])
+
+    outcomes = ServiceScheduler([hooks["tmux"], hooks["completions"], hooks["fonts"]]).run("execute")
+    assert all(x.succeeded for x in outcomes)
+    assert list(runez.readlines("ran.txt")) == ["fonts", "tmux", "completions"]
+
+    outcomes = {str(x.service): str(x) for x in ServiceScheduler([hooks["slow"], hooks["failing"]]).run("execute")}
+    assert "timed out" in outcomes["slow"]
+    assert "skipped" in outcomes["failing"]
+    grandchild = int(list(runez.readlines("grandchild.pid"))[0])
+    for _ in range(50):
+        if not is_running(grandchild):
+            break
+
+        time.sleep(0.02)
+
+    assert not is_running(grandchild)  # Processes spawned by hook were killed as well
+
+    outcomes = ServiceScheduler([hooks["failing"]]).run("execute")
+    assert "exit code 3: oops" in str(outcomes[0])
+
+    hooks["tmux"].dependencies = ["completions"]
+    with pytest.raises(runez.system.AbortException, match="Circular dependency between hooks: completions, tmux"):
+        ServiceScheduler([hooks["tmux"], hooks["completions"]], kind="hook").run("execute")
@@ -0,0 +1,26 @@
+import os
+
+from gdot.lock import StoreLock
+
+
+def test_lock(cli):
+    lock = StoreLock(os.path.abspath("foo/store.lock"))
+    other = StoreLock(lock.path)  # Separate open file, just like another process would have
+    assert lock.acquire(timeout=0)
+    assert lock.acquire()  # Re-entrant
+    assert lock.holder == os.getpid()
+    assert not other.acquire(timeout=0)
+    assert not other.acquire(timeout=0.1)
+
+    lock.release()
+    assert lock.is_held
+    assert not other.acquire(timeout=0)
+
+    lock.release()
+    assert not lock.is_held
+    with other:
+        assert other.is_held
+        assert not lock.acquire(timeout=0)
+
+    assert lock.acquire(timeout=0)
+    lock.release()
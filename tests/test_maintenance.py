@@ -0,0 +1,118 @@
+import os
+import subprocess
+
+import runez
+from helpers import bare_remote
+
+from gdot import GDEnv, GDotXBase
+from gdot.lock import StoreLock
+from gdot.maintenance import Maintenance, StoreHealth
+
+
+def git_config(key):
+    return runez.run("git", "-C", "store", "config", key, logger=None).output
+
+
+def test_health():
+    assert StoreHealth().reasons() == []
+    assert StoreHealth(loose_objects=5).reasons() == ["never repacked"]
+    assert StoreHealth(loose_objects=5, since_repack=60).reasons() == []
+    assert StoreHealth(loose_objects=5, since_repack=8 * 24 * 3600).reasons() == ["not repacked in 1 week 1 day"]
+    assert StoreHealth(loose_objects=500, packs=20, since_repack=60).reasons() == ["500 loose objects", "20 packs"]
+    assert str(StoreHealth(loose_objects=1, packs=2)) == "1 loose object, 2 packs"
+
+
+def test_gc(cli, home):
+    cli.run("gc")
+    assert cli.failed
+    assert "not attached" in cli.logged
+
+    remote = bare_remote("r1", seed="hello")
+    for i in range(60):
+        runez.write(os.path.join(home, "notes", "n%s.txt" % i), "note %s" % i, logger=None)
+
+    cli.run("attach", remote)
+    cli.run("add", os.path.join(home, "notes"))
+    cli.run("push")
+    assert cli.succeeded
+    assert git_config("gc.auto") == "0"  # git's own auto-gc is off, maintenance is done by 'gdot gc'
+
+    maintenance = Maintenance(GDotXBase())
+    health = maintenance.health(now=1000)
+    assert health.loose_objects > 60
+    assert health.since_repack is None
+    assert not health.commit_graph
+    assert maintenance.auto(now=1000) == ["never repacked"]
+    health = maintenance.health(now=1010)
+    assert health.loose_objects == 0
+    assert health.since_repack == 10
+    assert health.commit_graph
+    assert health.multi_pack_index
+
+    # Nothing to do when store is healthy
+    assert maintenance.auto(now=1020) == []
+    assert maintenance.state == {"checked_at": 1020, "last_repack": 1000}
+
+    # Only one maintenance at a time, auto mode does not wait
+    with StoreLock(maintenance.lock.path):
+        assert maintenance.auto(now=1030) is None
+        cli.run("gc")
+        assert cli.failed
+        assert "Another 'gdot gc' is already running" in cli.logged
+
+    cli.run("gc")
+    assert cli.succeeded
+    assert "loose objects : 0" in cli.logged.stdout
+    assert "commit-graph : yes" in cli.logged.stdout
+    assert "Ran repack, commit-graph, now: 0 loose objects, " in cli.logged.stdout
+
+
+def test_background(cli, home, monkeypatch):
+    spawned = []
+    popen = subprocess.Popen
+
+    def recorded_popen(*args, **kwargs):
+        if args[0][1:3] == ["-m", "gdot"]:
+            spawned.append((args, kwargs))
+            return None
+
+        return popen(*args, **kwargs)
+
+    monkeypatch.setattr(GDEnv, "maintenance_interval", 3600)
+    monkeypatch.setattr(subprocess, "Popen", recorded_popen)
+    remote = bare_remote("r1", seed="hello")
+    cli.run("attach", "--full", remote)
+    assert cli.succeeded
+    assert len(spawned) == 1
+    args, kwargs = spawned[0]
+    assert args[0][-3:] == ["gdot", "gc", "--auto"]
+    assert kwargs["env"]["GDOT_GIT_STORE"] == os.path.abspath("store")
+    assert kwargs["start_new_session"]
+
+    # Checked at most once per interval, and only after commands that added objects to the store
+    cli.run("push")
+    cli.run("status")
+    assert len(spawned) == 1
+
+    maintenance = Maintenance(GDotXBase())
+    assert not maintenance.is_due()
+    assert maintenance.is_due(now=maintenance.state["checked_at"] + 3600)
+
+    # Full (non-partial) stores get a geometric repack
+    maintenance = Maintenance(GDotXBase())
+    assert maintenance.steps(maintenance.health())[0] == ("repack", ["repack", "-d", "-q", "--geometric=2", "--write-midx"])
+    cli.run("gc")
+    assert cli.succeeded
+    assert "Ran repack, commit-graph (never repacked), now: 0 loose objects, 1 pack" in cli.logged.stdout
+
+    # Older git versions get plain maintenance steps
+    maintenance = Maintenance(GDotXBase())
+    assert maintenance.git_version >= (2, 0)
+    maintenance.git_version = (2, 20)
+    steps = maintenance.steps(StoreHealth())
+    assert steps == [("repack", ["repack", "-d", "-q"]), ("commit-graph", ["commit-graph", "write", "--reachable"])]
+    assert maintenance.steps(StoreHealth(packs=20))[0] == ("repack", ["repack", "-a", "-d", "-q"])
+    maintenance.git_version = None
+    assert maintenance.steps(StoreHealth())[0] == ("repack", ["repack", "-d", "-q"])
+    maintenance.run()
+    assert maintenance.health().commit_graph
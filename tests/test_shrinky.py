@@ -14,6 +14,10 @@ def test_clean_path(cli):
     assert cli.succeeded
     assert cli.logged.stdout.contents() == "foo:foo/bar\n"
 
+    # Folders are normalized the same way as get_path() does, without importing pathlib
+    for folder in ("", '"foo"', "~", "~/foo", "foo/./bar/", "foo//bar", "foo/../foo", "/", "//foo", "///foo/", "./"):
+        assert gdot.shrinky.folder_name(folder) == str(gdot.shrinky.get_path(folder))
+
 
 def test_colors():
     x = gdot.shrinky.ColorSet.zsh_ps1_color_set()
@@ -73,7 +77,7 @@ def test_deep_ps1(cli, monkeypatch):
     runez.write("%s/bin/activate" % venv, '\nPS1="(some-very-long-venv-prompt) ${PS1:-}"')
     cli.run('ps1 -szsh -p"%s" -v"%s/.venv"' % (full_path, full_path), main=main)
     assert cli.succeeded
-    expected = "(%F{cyan}𓈓me-very-long-venv-prompt%f %F{blue}None%f) %F{yellow}/𓈓/f/b/b/e/more/tests%f%F{green}:%f \n"
+    expected = "(%F{cyan}𓈓me-very-long-venv-prompt%f) %F{yellow}/𓈓/f/b/b/e/more/tests%f%F{green}:%f \n"
     assert cli.logged.stdout.contents() == expected
 
     # Simulate docker
@@ -117,7 +121,7 @@ def test_ps1(cli):
     # A fictional venv
     cli.run("ps1", "-szsh", "-vfoo/bar/.venv", main=main)
     assert cli.succeeded
-    assert cli.logged.stdout.contents() == "(%F{cyan}bar%f %F{blue}None%f) %F{green}:%f \n"
+    assert cli.logged.stdout.contents() == "(%F{cyan}bar%f) %F{green}:%f \n"
 
     # Minimal args
     cli.run("ps1 -sbash", main=main)
@@ -143,3 +147,271 @@ def test_tmux(cli, monkeypatch):
     cli.run("tmux_status -p%s" % project_path, main=main)
     assert cli.succeeded
     assert "#[default]🔌" in cli.logged.stdout
+
+
+SAMPLE_SEGMENT = """# shrinky: ttl=60 files=%s env=SAMPLE_CONTEXT color=cyan
+import os
+
+
+def render(renderer):
+    with open("calls.txt", "a") as fh:
+        fh.write("x")
+
+    return "ctx:%%s" %% os.environ.get("SAMPLE_CONTEXT")
+"""
+
+
+def test_segments(cli, monkeypatch):
+    monkeypatch.setattr(gdot.shrinky.CommandRenderer, "segments_folder", os.path.abspath("segments"))
+    monkeypatch.setattr(gdot.shrinky.CommandRenderer, "segments_cache", os.path.abspath("cache/segments.json"))
+    monkeypatch.setattr(gdot.shrinky.TmuxRenderer, "rendered_uptime", lambda *_: None)
+    monkeypatch.setattr(gdot.shrinky.Ps1Renderer, "dockerenv", "/dev/null/not-docker")
+    monkeypatch.setenv("SAMPLE_CONTEXT", "prod")
+    runez.write("segments/sample.py", SAMPLE_SEGMENT % os.path.abspath("sample.cfg"), logger=None)
+    runez.write("segments/broken.py", "def render(renderer):\n    raise Exception('oops')\n", logger=None)
+    runez.write("sample.cfg", "v1", logger=None)
+
+    cli.run("tmux_status -p/ -esample,broken,not-there", main=main)
+    assert cli.succeeded
+    assert cli.logged.stdout.contents() == "#[fg=cyan]ctx:prod#[default]\n"
+
+    # Cached value is served as long as inputs don't change
+    cli.run("ps1 -szsh -esample", main=main)
+    assert cli.succeeded
+    assert cli.logged.stdout.contents() == "%F{cyan}ctx:prod%f %F{green}:%f \n"
+    assert list(runez.readlines("calls.txt")) == ["x"]
+
+    # Changing a declared input (file or env var) invalidates cache
+    runez.write("sample.cfg", "v2 changed", logger=None)
+    cli.run("tmux_status -p/ -esample", main=main)
+    assert list(runez.readlines("calls.txt")) == ["xx"]
+    monkeypatch.setenv("SAMPLE_CONTEXT", "dev")
+    cli.run("tmux_status -p/ -esample", main=main)
+    assert cli.logged.stdout.contents() == "#[fg=cyan]ctx:dev#[default]\n"
+    assert list(runez.readlines("calls.txt")) == ["xxx"]
+
+    # Expired TTL
+    cache = runez.read_json("cache/segments.json")
+    cache["sample"]["expires"] = 0
+    runez.save_json(cache, "cache/segments.json", logger=None)
+    cli.run("tmux_status -p/ -esample", main=main)
+    assert list(runez.readlines("calls.txt")) == ["xxxx"]
+
+
+def test_budget(cli, monkeypatch):
+    messages = []
+    monkeypatch.setattr(gdot.shrinky.Logger, "debug", lambda msg, *args: messages.append(msg % args))
+    runez.touch("project/.git/HEAD", logger=None)
+    runez.ensure_folder("project/tests", logger=None)
+    cli.run("tmux_status --budget-ms=0 -pproject/tests", main=main)
+    assert cli.succeeded
+    assert cli.logged.stdout.contents() == "\n"
+    assert "tmux_status segment #0 took" in messages[0]
+    assert messages[-2] == "Budget of 0ms spent, skipped: scm_root, uptime"
+
+    # Python version of venv in ps1 is skipped as well, rather than rendered as 'None'
+    monkeypatch.setattr(gdot.shrinky.Ps1Renderer, "dockerenv", "/dev/null/no-such-file")
+    runez.write("myenv/bin/python", "#!/bin/sh\necho Python 3.11.7", logger=None)
+    runez.make_executable("myenv/bin/python", logger=None)
+    cli.run("ps1 -szsh -vmyenv -p/tmp --budget-ms=0", main=main)
+    assert cli.succeeded
+    assert cli.logged.stdout.contents() == "(%F{cyan}myenv%f) %F{yellow}/tmp%f%F{green}:%f \n"
+    cli.run("ps1 -szsh -vmyenv -p/tmp --budget-ms=5000", main=main)
+    assert cli.succeeded
+    assert cli.logged.stdout.contents() == "(%F{cyan}myenv%f %F{blue}3.11%f) %F{yellow}/tmp%f%F{green}:%f \n"
+
+    # Generous budget: nothing skipped
+    cli.run("tmux_short --budget-ms=5000 -p%s" % os.path.abspath("project/tests"), main=main)
+    assert cli.succeeded
+    assert cli.logged.stdout.contents() == "project/tests\n"
+    assert not gdot.shrinky.Budget.skipped
+
+
+def test_slow_filesystem(cli, monkeypatch):
+    messages = []
+    monkeypatch.setattr(gdot.shrinky.Logger, "debug", lambda msg, *args: messages.append(msg % args))
+    project = os.path.realpath("project")  # Mount points in mountinfo are canonical paths
+    runez.touch("project/.git/HEAD", logger=None)
+    runez.write(
+        "mountinfo",
+        "22 1 8:1 / / rw,relatime shared:1 - ext4 /dev/sda1 rw\n"
+        "40 22 0:35 / %s rw,relatime shared:2 - nfs4 server:/export rw\n"
+        "41 22 0:36 / /mnt/my\\040drive rw - fuse.sshfs user@host: rw\n"
+        "42 22 0:37 / /mnt/tab\\011new\\012line\\134slash rw - cifs //host/share rw\n" % project,
+        logger=None,
+    )
+    monkeypatch.setattr(gdot.shrinky.MountTable, "mountinfo", "mountinfo")
+    monkeypatch.setattr(gdot.shrinky.MountTable, "_mounts", None)
+    assert gdot.shrinky.MountTable.fs_type("/usr") == "ext4"
+    assert gdot.shrinky.MountTable.fs_type("/mnt/my drive/foo") == "fuse.sshfs"
+    assert gdot.shrinky.MountTable.fs_type(project + "/tests") == "nfs4"
+    assert gdot.shrinky.MountTable.fs_type("/mnt/tab\tnew\nline\\slash/foo") == "cifs"
+    assert gdot.shrinky.MountTable.unescaped("a\\0b\\") == "a\\0b\\"
+    os.symlink(project, "link")
+    assert gdot.shrinky.MountTable.fs_type(os.path.abspath("link")) == "nfs4"  # Classified by where the symlink points to
+    assert gdot.shrinky.FsPolicy.policy("ext4") == "full"
+    assert gdot.shrinky.FsPolicy.policy("fuse.sshfs") == "cheap"
+    assert gdot.shrinky.FsPolicy.policy(None) == "full"
+
+    cli.run("tmux_status -p%s" % project, main=main)
+    assert cli.succeeded
+    assert "rendering cheap segments only" in messages[0]
+    assert "Slow filesystem, skipped: scm_root, uptime" in messages
+
+    # Policy can be overridden via env var
+    monkeypatch.setenv("SHRINKY_FS_POLICY", "nfs=full")
+    assert gdot.shrinky.FsPolicy.policy("nfs4") == "cheap"
+    assert gdot.shrinky.FsPolicy.policy("nfs") == "full"
+    monkeypatch.setenv("SHRINKY_FS_POLICY", "nfs4=full")
+    messages.clear()
+    cli.run("tmux_status -p%s" % project, main=main)
+    assert cli.succeeded
+    assert not any("cheap segments" in x for x in messages)
+
+
+def test_env_snapshot(cli, monkeypatch):
+    runez.ensure_folder("bin1", logger=None)
+    runez.write("bin2/mytool", "#!/bin/sh\n", logger=None)
+    os.chmod("bin2/mytool", 0o755)
+    bin1, bin2 = os.path.abspath("bin1"), os.path.abspath("bin2")
+    monkeypatch.setenv("PATH", os.pathsep.join([bin1, bin2, "/dev/null/missing", bin1, "/usr/bin", "/bin"]))
+    snapshot = os.path.abspath("snapshot.sh")
+    cli.run("env_snapshot -o%s -tmytool,no-such-tool -vPATH" % snapshot, main=main)
+    assert cli.succeeded
+    assert cli.logged.stdout.contents() == "%s\n" % snapshot
+    contents = list(runez.readlines(snapshot))
+    assert contents[0].startswith("# Generated by shrinky env_snapshot, keys: ")
+    assert "  export PATH=%s" % os.pathsep.join([bin1, bin2, "/usr/bin", "/bin"]) in contents
+    assert "  export SHRINKY_MYTOOL=%s/mytool" % bin2 in contents
+    assert "  unset SHRINKY_NO_SUCH_TOOL" in contents
+
+    # Sourcing the snapshot applies it, without invoking shrinky
+    r = runez.run("/bin/sh", "-c", ". %s; echo $PATH $SHRINKY_MYTOOL" % snapshot, fatal=False, logger=None)
+    assert r.output == "%s %s/mytool" % (os.pathsep.join([bin1, bin2, "/usr/bin", "/bin"]), bin2)
+
+    # Inputs did not change: snapshot is not rewritten
+    inode = os.stat(snapshot).st_ino
+    cli.run("env_snapshot -o%s -tmytool,no-such-tool -vPATH" % snapshot, main=main)
+    assert cli.succeeded
+    assert os.stat(snapshot).st_ino == inode
+
+    # Nested shells inherit the cleaned PATH: snapshot is up to date for them too
+    cleaned = os.pathsep.join([bin1, bin2, "/usr/bin", "/bin"])
+    probe = os.path.abspath("probe.sh")
+    runez.write(probe, "\n".join("  echo stale" if x.startswith('  . "$(') else x for x in contents), logger=None)
+    for value in (os.environ["PATH"], cleaned):
+        r = runez.run("/bin/sh", "-c", "PATH=%s; . %s; echo $PATH" % (value, probe), fatal=False, logger=None)
+        assert r.output == cleaned
+
+    r = runez.run("/bin/sh", "-c", "PATH=%s:/usr/bin; . %s" % (bin1, probe), fatal=False, logger=None)
+    assert r.output == "stale"
+
+    monkeypatch.setenv("PATH", cleaned)
+    cli.run("env_snapshot -o%s -tmytool,no-such-tool -vPATH" % snapshot, main=main)
+    assert cli.succeeded
+    assert os.stat(snapshot).st_ino == inode
+
+    # A new tool in one of the folders changes the key
+    runez.touch("bin1/mytool", logger=None)
+    cli.run("env_snapshot -o%s -tmytool,no-such-tool -vPATH" % snapshot, main=main)
+    assert cli.succeeded
+    assert os.stat(snapshot).st_ino != inode
+    assert "  unset SHRINKY_MYTOOL" not in runez.readlines(snapshot)
+
+
+def test_shorten(cli, monkeypatch):
+    home = os.path.abspath("home")
+    monkeypatch.setenv("HOME", home)
+    runez.touch("home/dev/github/myproject/.git/HEAD", logger=None)
+    runez.ensure_folder("home/dev/github/myproject/src/some/package/sub", logger=None)
+    paths = [
+        "/",
+        home,
+        home + "/foo",
+        home + "/dev/github/myproject/src/some/package/sub/file.py",
+        home + "/dev/github/myproject/src/some/package/other.py",
+        home + "/dev/github/other/src/some/package/other.py",
+        "/usr/local/lib/python3/site-packages",
+    ]
+    expected = [
+        "/",
+        "~",
+        "~/foo",
+        "~/𓈓/myproject/s/s/p/sub/file.py",
+        "~/𓈓/g/myproject/s/s/package/other.py",
+        "~/𓈓/g/o/s/s/package/other.py",
+        "/u/l/l/python3/site-packages",
+    ]
+    runez.write("paths.txt", "\n".join(paths) + "\n", logger=None)
+    cli.run("shorten -ipaths.txt", main=main)
+    assert cli.succeeded
+    assert cli.logged.stdout.contents() == "\n".join(expected) + "\n"
+
+    runez.write("paths.txt", "\0".join(paths), logger=None)
+    cli.run("shorten -z -ipaths.txt", main=main)
+    assert cli.succeeded
+    assert cli.logged.stdout.contents() == "\0".join(expected) + "\0"
+
+    # Each folder is looked at only once, and paths themselves are not looked at
+    shortened = list(gdot.shrinky.shortened_paths([paths[3:5], paths[3:4]], home))
+    assert shortened == [expected[3:5], expected[3:4]]
+    roots = gdot.shrinky.RepoRoots()
+    assert roots.deepest(home + "/dev/github/myproject/src") == home.count("/") + 3
+    assert home + "/dev/github/myproject/src/some/package/sub/file.py" not in roots.by_folder
+    assert roots.deepest(home + "/dev") is None
+
+
+def test_tmux_watch(cli, monkeypatch):
+    monkeypatch.setattr(gdot.shrinky.TmuxRenderer, "rendered_uptime", lambda *_: None)
+    runez.touch("project/.git/HEAD", logger=None)
+    runez.ensure_folder("project/docs", logger=None)
+    project = os.path.abspath("project")
+    watcher = gdot.shrinky.TmuxWatcher()
+    watcher.socket = "test"
+    assert watcher.attach_command() == ["tmux", "-L", "test", "-C", "attach-session", "-f", "no-output,ignore-size"]
+    assert not list(watcher.handled("%begin 1 2 1"))
+    assert list(watcher.handled("%session-changed $1 main")) == ["refresh-client -B 'shrinky-path:@*:#{pane_current_path}'"]
+    assert list(watcher.handled("%%subscription-changed shrinky-path $1 @1 0 - : %s/docs" % project)) == [
+        "rename-window -t @1 'project/docs'",
+        "set-option -w -t @1 @shrinky_status ''",
+    ]
+
+    # Nothing is pushed when folder did not change, or when only the status changed
+    assert not list(watcher.handled("%%subscription-changed shrinky-path $1 @1 0 - : %s/docs" % project))
+    monkeypatch.setattr(gdot.shrinky.TmuxRenderer, "rendered_uptime", lambda *_: "5m🔌")
+    runez.ensure_folder("project/docs/it's", logger=None)
+    assert list(watcher.handled("%%subscription-changed shrinky-path $1 @1 0 - : %s/docs/it's" % project)) == [
+        "rename-window -t @1 'project/it'\\''s'",
+        "set-option -w -t @1 @shrinky_status '5m🔌'",
+    ]
+    assert list(watcher.handled("%%subscription-changed shrinky-path $1 @1 0 - : %s/docs" % project)) == [
+        "rename-window -t @1 'project/docs'",
+    ]
+
+    # Periodic refresh pushes status of idle windows, only when it changed
+    assert not list(watcher.refreshed())
+    monkeypatch.setattr(gdot.shrinky.TmuxRenderer, "rendered_uptime", lambda *_: "6m🔌")
+    assert list(watcher.refreshed()) == ["set-option -w -t @1 @shrinky_status '6m🔌'"]
+
+    # Renders go through the same latency budget as other commands
+    monkeypatch.setattr(gdot.shrinky.TmuxRenderer, "rendered_branch", lambda _, folder: gdot.shrinky.run_program("echo", "main"))
+    assert list(watcher.refreshed()) == ["set-option -w -t @1 @shrinky_status 'main┆6m🔌'"]
+    watcher.budget_ms = 0
+    assert list(watcher.refreshed()) == ["rename-window -t @1 'docs'", "set-option -w -t @1 @shrinky_status '6m🔌'"]
+    assert "echo" in gdot.shrinky.Budget.skipped
+    watcher.budget_ms = None
+    assert list(watcher.refreshed()) == ["rename-window -t @1 'project/docs'", "set-option -w -t @1 @shrinky_status 'main┆6m🔌'"]
+
+    assert not list(watcher.handled("%window-close @1"))
+    assert not watcher.rendered
+    assert not list(watcher.handled("%output %1 foo"))
+
+    # tmux 3.2+ is required (for 'refresh-client -B')
+    assert gdot.shrinky.TmuxWatcher.parsed_version("tmux 3.3a") == (3, 3)
+    assert gdot.shrinky.TmuxWatcher.parsed_version("tmux next-3.4") == (3, 4)
+    assert gdot.shrinky.TmuxWatcher.parsed_version("tmux master") is None
+    assert gdot.shrinky.TmuxWatcher.parsed_version(None) is None
+    monkeypatch.setattr(gdot.shrinky, "run_program", lambda *_: "tmux 3.1c")
+    cli.run("tmux_watch", main=main)
+    assert cli.failed
+    assert "tmux_watch requires tmux 3.2+" in cli.logged.stderr
@@ -0,0 +1,208 @@
+import os
+import threading
+import time
+
+import pytest
+import runez
+
+from gdot.srv import DCService, ServiceScheduler
+
+
+class FakeService(DCService):
+    def __init__(self, name, journal, dependencies=None, fail=False, barrier=None):
+        super().__init__(name, repo=".")
+        self.journal = journal
+        self.config = dict(depends_on=dependencies or [])
+        self.fail = fail
+        self.barrier = barrier  # type: threading.Barrier # If given, wait for other services sharing it to be running too
+
+    def _record(self, operation):
+        self.journal.append("%s %s" % (operation, self.name))
+        if self.barrier is not None:
+            self.barrier.wait(timeout=10)  # Raises BrokenBarrierError if services sharing the barrier did not run concurrently
+
+        time.sleep(0.05)
+        if self.fail:
+            runez.abort("%s failed" % self.name)
+
+        self.journal.append("done %s" % self.name)
+
+    def start(self):
+        self._record("start")
+
+    def stop(self):
+        self._record("stop")
+
+
+def test_discover(cli):
+    runez.touch("a/docker-compose.yml", logger=None)
+    runez.touch("b/root/foo", logger=None)
+    runez.touch("c/docker-compose.yml", logger=None)
+    runez.write("c/service.json", '{"depends_on": ["a"]}', logger=None)
+    services = DCService.discover()
+    assert [s.name for s in services] == ["a", "c"]
+    assert services[0].dependencies == []
+    assert services[1].dependencies == ["a"]
+    assert services[1].problem(False) == "Folder 'c/root' does not exist"
+
+
+def test_scheduler():
+    journal = []
+    barrier = threading.Barrier(2)
+    services = [
+        FakeService("app", journal, dependencies=["db", "cache"]),
+        FakeService("cache", journal, barrier=barrier),
+        FakeService("db", journal, barrier=barrier),
+        FakeService("other", journal, dependencies=["not-selected"]),
+    ]
+    scheduler = ServiceScheduler(services, jobs=3)
+    outcomes = scheduler.run("start")
+    assert all(x.succeeded for x in outcomes)  # Independent services 'cache' and 'db' ran concurrently (they met at barrier)
+    assert journal.index("start app") > journal.index("done db")
+    assert journal.index("start app") > journal.index("done cache")
+
+    # Reverse order for shutdown
+    for service in services:
+        service.barrier = None
+
+    journal.clear()
+    outcomes = scheduler.run("stop", reverse=True)
+    assert all(x.succeeded for x in outcomes)
+    assert journal.index("stop db") > journal.index("done app")
+    assert journal.index("stop cache") > journal.index("done app")
+
+    # Max number of jobs is respected
+    journal.clear()
+    max_concurrent = [0]
+    lock = threading.Lock()
+    current = [0]
+
+    class Counting(FakeService):
+        def start(self):
+            with lock:
+                current[0] += 1
+                max_concurrent[0] = max(max_concurrent[0], current[0])
+
+            time.sleep(0.02)
+            with lock:
+                current[0] -= 1
+
+    ServiceScheduler([Counting("s%s" % i, journal) for i in range(6)], jobs=2).run("start")
+    assert max_concurrent[0] == 2
+
+
+def test_scheduler_failures():
+    journal = []
+    services = [
+        FakeService("a", journal, dependencies=["b"]),
+        FakeService("b", journal, dependencies=["c"]),
+        FakeService("c", journal, fail=True),
+        FakeService("d", journal),
+    ]
+    outcomes = {x.service.name: x for x in ServiceScheduler(services).run("start")}
+    assert str(outcomes["c"]).startswith("c: failed")
+    assert outcomes["b"].skipped
+    assert outcomes["a"].skipped
+    assert outcomes["d"].succeeded
+    assert "start a" not in journal
+
+    services = [FakeService("a", journal, dependencies=["b"]), FakeService("b", journal, dependencies=["a"])]
+    with pytest.raises(runez.system.AbortException, match="Circular dependency"):
+        ServiceScheduler(services).run("start")
+
+
+@pytest.fixture
+def fake_srv(cli, monkeypatch):
+    """Service 'svc' installed in a temp srv folder, with a stand-in docker-compose on PATH"""
+    monkeypatch.setattr(DCService, "srv_folder", os.path.abspath("srv"))
+    monkeypatch.setattr(DCService, "state_folder", os.path.abspath("state"))
+    runez.write("bin/docker-compose", FAKE_DOCKER_COMPOSE % ((os.path.abspath("docker-compose.log"),) * 2), logger=None)
+    runez.make_executable("bin/docker-compose", logger=None)
+    monkeypatch.setenv("PATH", "%s%s%s" % (os.path.abspath("bin"), os.pathsep, os.environ["PATH"]))
+    for folder in ("repo/svc", "srv/svc"):
+        runez.touch(os.path.join(folder, "docker-compose.yml"), logger=None)
+        runez.write(os.path.join(folder, "root/data.txt"), "data", logger=None)
+
+    return DCService("svc", repo=os.path.abspath("repo"))
+
+
+FAKE_DOCKER_COMPOSE = """#!/bin/sh
+echo "start $*" >> %s
+if [ "$1" = "pull" ]; then sleep 0.2; fi
+echo "end $*" >> %s
+"""
+
+
+def test_upgrade(fake_srv):
+    runez.write("srv/svc/root/data.txt", "new data", logger=None)
+    timer = fake_srv.upgrade()
+    assert [x[0] for x in timer.phases] == ["sync", "pull", "prefetch", "restart", "prune"]
+    log = list(runez.readlines("docker-compose.log"))
+    assert log == ["start pull", "end pull", "start up -d", "end up -d", "start prune -f", "end prune -f"]  # Restart after pull
+    assert list(runez.readlines("repo/svc/root/data.txt")) == ["new data"]
+
+    # Run report was written to service history
+    report = fake_srv.history()[-1]
+    assert report["operation"] == "upgrade"
+    commands = [x["command"] for x in report["steps"]]
+    assert commands == ["sync", "docker-compose pull", "docker-compose up -d", "docker-compose prune -f"]
+    assert report["steps"][1]["exit_code"] == 0
+    assert report["steps"][1]["elapsed"] >= 0.2
+    assert set(report["phases"]) == {"sync", "pull", "prefetch", "restart", "prune"}
+
+
+def test_history(cli, fake_srv):
+    fake_srv.start()
+    fake_srv.stop()
+    with pytest.raises(SystemExit):
+        DCService("not-there", repo="repo").start()
+
+    assert len(fake_srv.history()) == 2
+    assert DCService("not-there").history()[0]["problem"] == "exit code 1"
+
+    cli.run("srv", "history", "svc")
+    assert cli.succeeded
+    assert "docker-compose up -d" in cli.logged.stdout
+    assert "Average" in cli.logged.stdout
+
+    cli.run("srv", "history", "--json", "-l1", "svc")
+    assert cli.succeeded
+    assert '"operation": "stop"' in cli.logged.stdout
+    assert '"operation": "start"' not in cli.logged.stdout
+
+    cli.run("srv", "history", "foo")
+    assert cli.succeeded
+    assert "No history for foo" in cli.logged.stdout
+
+
+def test_status(cli, fake_srv):
+    runez.write("bin/docker", FAKE_DOCKER % os.path.abspath("docker.log"), logger=None)
+    runez.make_executable("bin/docker", logger=None)
+    runez.touch("repo/other/docker-compose.yml", logger=None)
+    runez.touch("repo/My.App/docker-compose.yml", logger=None)
+    assert DCService("My.App").project_name == "myapp"
+    assert DCService("_My-App_2").project_name == "my-app_2"
+    with runez.CurrentFolder("repo"):
+        cli.run("srv", "status")
+        assert cli.succeeded
+        lines = cli.logged.stdout.contents().splitlines()
+        assert lines[0].split() == ["Service", "Installed", "State", "Containers", "Problem"]
+        assert lines[1].split()[:3] == ["My.App", "no", "running"]
+        assert lines[2].split()[:3] == ["other", "no", "down"]
+        assert lines[3].split() == ["svc", "yes", "degraded", "1/2", "running", "-"]
+
+        # Container states were cached: docker not called again
+        cli.run("srv", "status", "--json")
+        assert cli.succeeded
+        assert '"state": "degraded"' in cli.logged.stdout
+        assert len(list(runez.readlines("../docker.log"))) == 1
+
+        cli.run("srv", "status", "--ttl", "0")
+        assert cli.succeeded
+        assert len(list(runez.readlines("../docker.log"))) == 2
+
+
+FAKE_DOCKER = """#!/bin/sh
+echo "$*" >> %s
+printf 'svc\\tweb\\trunning\\tUp 2 hours\\nsvc\\tdb\\texited\\tExited (0)\\nunrelated\\tfoo\\trunning\\tUp\\nmyapp\\tweb\\trunning\\tUp\\n'
+"""
@@ -0,0 +1,367 @@
+import json
+import os
+
+import runez
+from helpers import bare_remote, git
+
+from gdot import GDEnv, GDotXBase
+from gdot.chunks import ChunkStore
+from gdot.remotes import expanded_url, remote_name
+
+
+def test_urls():
+    assert expanded_url("github:tester") == "git@github.com:tester/dotfiles.git"
+    assert expanded_url("gitlab:tester") == "git@gitlab.com:tester/dotfiles.git"
+    assert expanded_url("foo:bar") == "foo:bar"
+    assert remote_name("git@github.com:tester/dotfiles.git", []) == "origin"
+    assert remote_name("git@github.com:tester/dotfiles.git", ["origin"]) == "github"
+    assert remote_name("/tmp/foo.git", ["origin"]) == "mirror1"
+    assert remote_name("/tmp/foo.git", ["origin", "mirror1"]) == "mirror2"
+
+
+def test_multiple_remotes(cli):
+    cli.run("push")
+    assert cli.failed
+    assert "not attached" in cli.logged
+
+    r1 = bare_remote("r1", seed="hello")
+    r2 = bare_remote("r2")
+    cli.run("attach", "--full", r1, r2)
+    assert cli.succeeded
+    assert "origin: OK" in cli.logged.stdout
+    assert "mirror1: OK" in cli.logged.stdout
+    assert list(runez.readlines("store/seed")) == ["hello"]
+
+    # Mirror gets populated on push
+    cli.run("push")
+    assert cli.succeeded
+    assert "mirror1: OK" in cli.logged.stdout
+    assert git("-C", r2, "log", "--format=%s", "main") == "seed"
+
+    # A broken mirror is reported, but does not prevent talking to the others
+    git("-C", "store", "remote", "add", "mirror2", os.path.abspath("no-such-remote"))
+    cli.run("pull", "--timeout", "30")
+    assert cli.succeeded
+    assert "origin: OK" in cli.logged.stdout
+    assert "mirror2: failed" in cli.logged.stdout
+
+
+def test_pull_renders_templates(cli, home):
+    work = os.path.abspath("work")
+    git("init", "-q", work)
+    runez.write(os.path.join(work, "templates/.config/foo.conf"), "user={{userid}} email={{email}}", logger=None)
+    runez.write(os.path.join(work, "vars/default.json"), '{"email": "tester@example.com"}', logger=None)
+    git("-C", work, "add", ".")
+    git("-C", work, "commit", "-q", "-m", "templates")
+    remote = bare_remote("r1")
+    git("-C", work, "push", "-q", remote, "HEAD:main")
+
+    cli.run("attach", remote)
+    assert cli.succeeded
+    assert "Rendered 1 template" in cli.logged.stdout
+    assert list(runez.readlines(os.path.join(home, ".config/foo.conf"))) == ["user=tester email=tester@example.com"]
+
+    cli.run("pull")
+    assert cli.succeeded
+    assert "Rendered" not in cli.logged.stdout
+
+
+def test_add_push_pull(cli, home, monkeypatch):
+    monkeypatch.setattr(GDEnv, "chunk_threshold", 1024)
+    remote = bare_remote("r1")
+    cli.run("attach", remote)
+    assert cli.succeeded
+
+    runez.write(os.path.join(home, ".bashrc"), "echo hello", logger=None)
+    runez.write(os.path.join(home, ".zsh_history"), "\n".join("ls %s" % i for i in range(1000)), logger=None)
+    cli.run("add", os.path.join(home, ".bashrc"))
+    assert cli.succeeded
+    cli.run("add", os.path.join(home, ".zsh_history"))
+    assert cli.succeeded
+    assert os.path.isfile("store/home/.bashrc")
+    assert os.path.isfile("store/home/.zsh_history.gdot-chunks")
+    assert not os.path.exists("store/home/.zsh_history")
+
+    cli.run("add", os.path.abspath("outside"))
+    assert cli.failed
+    assert "Only files under" in cli.logged
+
+    cli.run("list")
+    assert cli.succeeded
+    assert cli.logged.stdout.contents() == ".bashrc\n.zsh_history\n"
+
+    cli.run("push")
+    assert cli.succeeded
+    assert git("-C", remote, "log", "--format=%s", "main").startswith("Updated from")
+
+    # Simulate another machine pulling
+    expected = runez.checksum(os.path.join(home, ".zsh_history"))
+    runez.delete(home, logger=None)
+    runez.delete("store", logger=None)
+    cli.run("attach", remote)
+    assert cli.succeeded
+    assert list(runez.readlines(os.path.join(home, ".bashrc"))) == ["echo hello"]
+    assert runez.checksum(os.path.join(home, ".zsh_history")) == expected
+
+
+def test_status_diff(cli, home, monkeypatch):
+    monkeypatch.setattr(GDEnv, "chunk_threshold", 1024)
+    remote = bare_remote("r1")
+    runez.write(os.path.join(home, ".bashrc"), "echo hello", logger=None)
+    runez.write(os.path.join(home, ".zsh_history"), "\n".join("ls %s" % i for i in range(1000)), logger=None)
+    cli.run("attach", remote)
+    cli.run("add", os.path.join(home, ".bashrc"))
+    cli.run("add", os.path.join(home, ".zsh_history"))
+    assert cli.succeeded
+
+    cli.run("status")
+    assert cli.succeeded
+    assert cli.logged.stdout.contents() == "No changes\n"
+
+    runez.write(os.path.join(home, ".bashrc"), "echo hello\necho world", logger=None)
+    runez.write(os.path.join(home, ".zsh_history"), "ls", logger=None)
+    cli.run("status")
+    assert cli.succeeded
+    assert "modified  .bashrc" in cli.logged.stdout
+    assert "modified  .zsh_history" in cli.logged.stdout
+    cli.run("diff")
+    assert cli.succeeded
+    assert "+echo world" in cli.logged.stdout
+    assert "Binary files a/.zsh_history and b/.zsh_history differ" in cli.logged.stdout
+
+
+def test_partial_attach(cli, home):
+    work = os.path.abspath("work")
+    git("init", "-q", work)
+    runez.write(os.path.join(work, "tracked.json"), '[".bashrc"]', logger=None)
+    runez.write(os.path.join(work, "home/.bashrc"), "echo hello", logger=None)
+    runez.write(os.path.join(work, "home/.vimrc"), "set nu", logger=None)
+    runez.write(os.path.join(work, "vars/default.json"), "{}", logger=None)
+    runez.write(os.path.join(work, "vars/otherhost.json"), '{"foo": "bar"}', logger=None)
+    runez.write(os.path.join(work, "docs/big.txt"), "v1", logger=None)
+    git("-C", work, "add", ".")
+    git("-C", work, "commit", "-q", "-m", "v1")
+    runez.write(os.path.join(work, "docs/big.txt"), "v2", logger=None)
+    git("-C", work, "commit", "-q", "-a", "-m", "v2")
+    remote = bare_remote("r1")
+    git("-C", remote, "config", "uploadpack.allowFilter", "true")
+    git("-C", work, "push", "-q", remote, "HEAD:main")
+
+    cli.run("attach", remote)
+    assert cli.succeeded
+    assert sorted(GDotXBase().stored_files()) == [".bashrc"]
+    assert os.path.isfile("store/vars/default.json")
+    assert not os.path.exists("store/vars/otherhost.json")
+    assert not os.path.exists("store/docs")
+    assert list(runez.readlines(os.path.join(home, ".bashrc"))) == ["echo hello"]
+    assert not os.path.exists(os.path.join(home, ".vimrc"))
+
+    # Blobs of history, and of paths outside of sparse checkout, were not fetched
+    missing = git("-C", "store", "rev-list", "--objects", "--missing=print", "--all").splitlines()
+    assert len([x for x in missing if x.startswith("?")]) == 4
+
+    # Checkout widens as files get added
+    runez.write(os.path.join(home, ".vimrc"), "set nonu", logger=None)
+    cli.run("add", os.path.join(home, ".vimrc"))
+    assert cli.succeeded
+    assert sorted(GDotXBase().stored_files()) == [".bashrc", ".vimrc"]
+    assert "/home/.vimrc" in runez.readlines("store/.git/info/sparse-checkout")
+    cli.run("push")
+    assert cli.succeeded
+    assert git("-C", remote, "show", "main:home/.vimrc") == "set nonu"
+    assert git("-C", remote, "show", "main:docs/big.txt") == "v2"
+
+
+def test_pull_runs_hooks(cli, home):
+    work = os.path.abspath("work")
+    git("init", "-q", work)
+    hooks = {
+        "bash": {"paths": [".bashrc"], "run": "echo bash >> ran.txt"},
+        "vim": {"paths": [".vimrc", ".vim/*"], "run": "echo vim >> ran.txt"},
+    }
+    runez.write(os.path.join(work, "hooks.json"), json.dumps(hooks), logger=None)
+    runez.write(os.path.join(work, "tracked.json"), '[".bashrc", ".vimrc"]', logger=None)
+    runez.write(os.path.join(work, "home/.bashrc"), "echo hello", logger=None)
+    runez.write(os.path.join(work, "home/.vimrc"), "set nu", logger=None)
+    git("-C", work, "add", ".")
+    git("-C", work, "commit", "-q", "-m", "v1")
+    remote = bare_remote("r1")
+    git("-C", work, "push", "-q", remote, "HEAD:main")
+
+    cli.run("attach", remote)
+    assert cli.succeeded
+    assert "hook bash: OK" in cli.logged.stdout
+    assert "hook vim: OK" in cli.logged.stdout
+    ran = os.path.join(home, "ran.txt")
+    assert sorted(runez.readlines(ran)) == ["bash", "vim"]
+
+    # Only hooks whose files changed are triggered
+    runez.write(os.path.join(work, "home/.vimrc"), "set nonu", logger=None)
+    git("-C", work, "commit", "-q", "-a", "-m", "v2")
+    git("-C", work, "push", "-q", remote, "HEAD:main")
+    runez.delete(ran, logger=None)
+    cli.run("pull")
+    assert cli.succeeded
+    assert "hook bash" not in cli.logged.stdout
+    assert "hook vim: OK" in cli.logged.stdout
+    assert list(runez.readlines(ran)) == ["vim"]
+
+    cli.run("pull")
+    assert cli.succeeded
+    assert "hook" not in cli.logged.stdout
+
+    # Invalid hooks.json is refused before merging, nothing gets applied
+    runez.write(os.path.join(work, "home/.vimrc"), "set nu", logger=None)
+    runez.write(os.path.join(work, "hooks.json"), json.dumps({"vim": {"paths": [".vimrc"], "run": "true", "timout": 5}}), logger=None)
+    git("-C", work, "commit", "-q", "-a", "-m", "v3")
+    git("-C", work, "push", "-q", remote, "HEAD:main")
+    cli.run("pull")
+    assert cli.failed
+    assert "Hook 'vim' in hooks.json of origin/main has unknown key 'timout'" in cli.logged
+    assert list(runez.readlines(os.path.join(home, ".vimrc"))) == ["set nonu"]
+
+
+def test_pull_keeps_local_edits(cli, home):
+    remote = bare_remote("r1")
+    bashrc = os.path.join(home, ".bashrc")
+    runez.write(bashrc, "echo hello", logger=None)
+    cli.run("attach", remote)
+    cli.run("add", bashrc)
+    cli.run("push")
+    assert cli.succeeded
+
+    # Local edit is captured before pulling, not overwritten
+    runez.write(bashrc, "echo edited", logger=None)
+    cli.run("pull")
+    assert cli.succeeded
+    assert "Updated" not in cli.logged.stdout
+    assert list(runez.readlines(bashrc)) == ["echo edited"]
+    assert git("-C", "store", "log", "-1", "--format=%s").startswith("Local edits from")
+
+    # Only files that changed in the store are applied: files in ~ that were not touched remotely are left alone
+    other = os.path.abspath("other")
+    git("clone", "-q", "-b", "main", remote, other)
+    runez.write(os.path.join(other, "home", ".vimrc"), "set nu", logger=None)
+    runez.write(os.path.join(other, "tracked.json"), '[".bashrc", ".vimrc"]', logger=None)
+    git("-C", other, "add", ".")
+    git("-C", other, "commit", "-q", "-m", "vimrc")
+    git("-C", other, "push", "-q", "origin", "HEAD:main")
+    cli.run("pull")
+    assert cli.succeeded
+    assert "Updated 1 file" in cli.logged.stdout
+    assert list(runez.readlines(os.path.join(home, ".vimrc"))) == ["set nu"]
+    assert list(runez.readlines(bashrc)) == ["echo edited"]
+
+    # Files made executable on another host become executable here as well
+    git("-C", other, "pull", "-q", "origin", "main")
+    os.chmod(os.path.join(other, "home", ".vimrc"), 0o755)
+    git("-C", other, "commit", "-q", "-a", "-m", "+x")
+    git("-C", other, "push", "-q", "origin", "HEAD:main")
+    os.chmod(os.path.join(home, ".vimrc"), 0o600)
+    cli.run("pull")
+    assert cli.succeeded
+    assert os.stat(os.path.join(home, ".vimrc")).st_mode & 0o777 == 0o700
+
+
+def test_diverged_histories(cli, home, monkeypatch):
+    monkeypatch.setattr(GDEnv, "chunk_threshold", 1024)
+    remote = bare_remote("r1")
+    path = os.path.join(home, ".zsh_history")
+    lines = ["ls %s" % i for i in range(5000)]
+    runez.write(path, "\n".join(lines) + "\n", logger=None)
+    cli.run("attach", remote)
+    cli.run("add", path)
+    cli.run("push")
+    assert cli.succeeded
+
+    # Another host appends a line to its history, and pushes
+    other = os.path.abspath("other")
+    git("clone", "-q", "-b", "main", remote, other)
+    with open(os.path.join(other, "history"), "w") as fh:
+        fh.write("\n".join(lines + ["theirs"]) + "\n")
+
+    ChunkStore(os.path.join(other, "chunks")).store(os.path.join(other, "history")).save(
+        os.path.join(other, "home", ".zsh_history.gdot-chunks")
+    )
+    git("-C", other, "add", "chunks", "home")
+    git("-C", other, "commit", "-q", "-m", "theirs")
+    git("-C", other, "push", "-q", "origin", "HEAD:main")
+
+    # This host appended as well: its push is rejected, but pull merges both appends
+    with open(path, "a") as fh:
+        fh.write("ours\n")
+
+    cli.run("push")
+    assert cli.failed
+    cli.run("pull")
+    assert cli.succeeded
+    assert list(runez.readlines(path))[-3:] == ["ls 4999", "ours", "theirs"]
+    cli.run("push")
+    assert cli.succeeded
+    cli.run("status")
+    assert cli.logged.stdout.contents() == "No changes\n"
+
+    # Conflicts that can't be resolved abort the merge, leaving the store as it was
+    runez.write(os.path.join(home, ".bashrc"), "echo mine", logger=None)
+    cli.run("add", os.path.join(home, ".bashrc"))
+    cli.run("push")
+    git("-C", other, "pull", "-q", "origin", "main")
+    runez.write(os.path.join(other, "home", ".bashrc"), "echo theirs", logger=None)
+    git("-C", other, "commit", "-q", "-a", "-m", "theirs")
+    git("-C", other, "push", "-q", "origin", "HEAD:main")
+    runez.write(os.path.join(home, ".bashrc"), "echo mine again", logger=None)
+    cli.run("pull")
+    assert cli.failed
+    assert "Could not merge origin/main: home/.bashrc" in cli.logged
+    assert not os.path.exists("store/.git/MERGE_HEAD")
+    assert list(runez.readlines(os.path.join(home, ".bashrc"))) == ["echo mine again"]
+
+
+def test_concurrent_adds(cli, home, monkeypatch):
+    remote = bare_remote("r1")
+    runez.write(os.path.join(home, ".bashrc"), "echo hello", logger=None)
+    cli.run("attach", remote)
+    cli.run("add", os.path.join(home, ".bashrc"))
+    cli.run("push")
+    assert cli.succeeded
+
+    # Another host adds a file and pushes
+    runez.ensure_folder("host2", logger=None)
+    monkeypatch.chdir("host2")
+    monkeypatch.setattr(GDEnv, "user_home", os.path.abspath("home"))
+    runez.write(os.path.join(GDEnv.user_home, ".vimrc"), "set nu", logger=None)
+    cli.run("attach", remote)
+    cli.run("add", os.path.join(GDEnv.user_home, ".vimrc"))
+    cli.run("push")
+    assert cli.succeeded
+
+    # This host adds a different file: pull right after 'add' commits it, and merges both tracked.json
+    monkeypatch.chdir("..")
+    monkeypatch.setattr(GDEnv, "user_home", home)
+    runez.write(os.path.join(home, ".tmux.conf"), "set -g mouse on", logger=None)
+    cli.run("add", os.path.join(home, ".tmux.conf"))
+    cli.run("pull")
+    assert cli.succeeded
+    assert list(runez.readlines(os.path.join(home, ".vimrc"))) == ["set nu"]
+    assert GDotXBase().tracked() == [".bashrc", ".tmux.conf", ".vimrc"]
+    cli.run("push")
+    assert cli.succeeded
+
+    # Both hosts added a file before syncing: push is rejected, pull merges both
+    runez.write(os.path.join(home, ".inputrc"), "set bell-style none", logger=None)
+    cli.run("add", os.path.join(home, ".inputrc"))
+    cli.run("push")
+    assert cli.succeeded
+    monkeypatch.chdir("host2")
+    monkeypatch.setattr(GDEnv, "user_home", os.path.abspath("home"))
+    runez.write(os.path.join(GDEnv.user_home, ".gitconfig"), "[user]", logger=None)
+    cli.run("add", os.path.join(GDEnv.user_home, ".gitconfig"))
+    cli.run("push")
+    assert cli.failed
+    cli.run("pull")
+    assert cli.succeeded
+    assert GDotXBase().tracked() == [".bashrc", ".gitconfig", ".inputrc", ".tmux.conf", ".vimrc"]
+    assert list(runez.readlines(os.path.join(GDEnv.user_home, ".inputrc"))) == ["set bell-style none"]
+    cli.run("push")
+    assert cli.succeeded
+    assert json.loads(git("-C", remote, "show", "main:tracked.json")) == [".bashrc", ".gitconfig", ".inputrc", ".tmux.conf", ".vimrc"]
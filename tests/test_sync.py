@@ -0,0 +1,95 @@
+import os
+
+import runez
+
+from gdot.sync import copy_file_data, SyncEngine
+
+
+def sample_tree():
+    runez.write("src/a.txt", "a", logger=None)
+    runez.write("src/sub/b.txt", "b" * 100000, logger=None)
+    runez.write("src/sub/deeper/c.txt", "c", logger=None)
+    os.link("src/a.txt", "src/sub/a-hardlink.txt")
+    os.symlink("../a.txt", "src/sub/a-symlink")
+    os.chmod("src/sub/deeper/c.txt", 0o600)
+    os.utime("src/sub/deeper", ns=(1_600_000_000_000_000_000, 1_600_000_000_000_000_000))
+
+
+def test_copy_file_data(cli):
+    runez.write("foo", "x" * 100000, logger=None)
+    copy_file_data("foo", "bar")
+    assert runez.checksum("foo") == runez.checksum("bar")
+
+    runez.write("empty", "", logger=None)
+    copy_file_data("empty", "empty2")
+    assert os.path.getsize("empty2") == 0
+
+
+def test_copy_file_data_fallback(cli, monkeypatch):
+    # Kernel copy functions that stop short (return 0 before EOF) don't truncate the copy
+    monkeypatch.setattr(os, "copy_file_range", lambda src, dst, count: os.write(dst, os.read(src, min(count, 10))) if count > 99990 else 0)
+    monkeypatch.setattr(os, "sendfile", lambda *_: 0)
+    runez.write("foo", "x" * 100000, logger=None)
+    copy_file_data("foo", "bar")
+    assert runez.checksum("foo") == runez.checksum("bar")
+
+
+def test_sync(cli):
+    sample_tree()
+    runez.write("dest/only-in-dest", "kept", logger=None)
+    engine = SyncEngine("src", "dest", manifest_path="manifest.json")
+    plan = engine.run()
+    assert str(plan) == "src/ -> dest: 3 copy, 1 link, 2 mkdir, 1 symlink, 0 unchanged"
+    assert os.path.exists("dest/only-in-dest")  # Same as rsync without --delete
+    for path in ("a.txt", "sub/b.txt", "sub/deeper/c.txt", "sub", "sub/deeper"):
+        s = os.stat(os.path.join("src", path))
+        d = os.stat(os.path.join("dest", path))
+        assert s.st_mtime_ns == d.st_mtime_ns
+        assert s.st_mode == d.st_mode
+
+    assert os.path.samefile("dest/a.txt", "dest/sub/a-hardlink.txt")
+    assert os.readlink("dest/sub/a-symlink") == "../a.txt"
+    assert runez.checksum("dest/sub/b.txt") == runez.checksum("src/sub/b.txt")
+
+    # Nothing changed: all skipped via manifest
+    engine = SyncEngine("src", "dest", manifest_path="manifest.json")
+    assert str(engine.run()) == "src/ -> dest: nothing to do, 7 unchanged"
+
+    # Without manifest, target is compared with source (rsync quick-check)
+    assert str(SyncEngine("src", "dest").run()) == "src/ -> dest: nothing to do, 7 unchanged"
+    assert str(engine.run(full=True)) == "src/ -> dest: nothing to do, 7 unchanged"
+
+    # Only changed file gets copied
+    runez.write("src/sub/deeper/c.txt", "cc", logger=None)
+    engine = SyncEngine("src", "dest", manifest_path="manifest.json")
+    assert str(engine.run()) == "src/ -> dest: 1 copy, 6 unchanged"
+    assert list(runez.readlines("dest/sub/deeper/c.txt")) == ["cc"]
+    assert os.stat("src/sub/deeper").st_mtime_ns == os.stat("dest/sub/deeper").st_mtime_ns
+
+    # Changes on the destination side get repaired as well
+    os.remove("dest/a.txt")
+    runez.write("dest/sub/b.txt", "modified in dest", logger=None)
+    assert str(engine.run()) == "src/ -> dest: 2 copy, 1 link, 4 unchanged"
+    assert runez.checksum("dest/sub/b.txt") == runez.checksum("src/sub/b.txt")
+    assert os.path.samefile("dest/a.txt", "dest/sub/a-hardlink.txt")
+    assert list(runez.readlines("dest/a.txt")) == ["a"]
+    assert str(engine.run()) == "src/ -> dest: nothing to do, 7 unchanged"
+
+    # Removing a file in source only updates the folder's mtime (nothing gets deleted in target)
+    os.remove("src/sub/deeper/c.txt")
+    assert str(engine.run()) == "src/ -> dest: 1 touch, 5 unchanged"
+    assert os.path.exists("dest/sub/deeper/c.txt")
+    assert os.stat("src/sub/deeper").st_mtime_ns == os.stat("dest/sub/deeper").st_mtime_ns
+
+
+def test_dryrun(cli, capsys):
+    sample_tree()
+    with runez.OverrideDryrun(True):
+        plan = SyncEngine("src", "dest", manifest_path="manifest.json").run()
+
+    assert len(plan) == 7
+    output = capsys.readouterr().out
+    assert "link sub/a-hardlink.txt => a.txt" in output
+    assert "symlink sub/a-symlink -> ../a.txt" in output
+    assert not os.path.exists("dest")
+    assert not os.path.exists("manifest.json")
@@ -0,0 +1,54 @@
+import os
+
+import pytest
+import runez
+
+from gdot.templates import RenderPlan, TemplateEngine
+from gdot.transaction import ApplyTransaction
+
+
+def test_plan():
+    plan = RenderPlan.compiled("a={{ a }} b={{b}} ${HOME} {c}")
+    assert plan.variables == ["a", "b"]
+    assert plan.rendered(dict(a="1", b="2")) == "a=1 b=2 ${HOME} {c}"
+
+    plan = RenderPlan.compiled("")
+    assert plan.variables == []
+    assert plan.rendered({}) == ""
+
+
+def rendered(engine):
+    with ApplyTransaction("state/journal") as tx:
+        result = engine.render_all(tx)
+
+    engine.save_records()
+    return result
+
+
+def test_incremental(cli):
+    runez.write("templates/.gitconfig", "[user]\n  email = {{email}}\n", logger=None)
+    runez.write("templates/.config/foo.conf", "host={{hostname}}\n", logger=None)
+    engine = TemplateEngine("templates", "home", "state", dict(email="a@example.com", hostname="h1"))
+    assert rendered(engine) == [".config/foo.conf", ".gitconfig"]
+    assert list(runez.readlines("home/.gitconfig")) == ["[user]", "  email = a@example.com"]
+    assert list(runez.readlines("home/.config/foo.conf")) == ["host=h1"]
+    assert len(os.listdir("state/plans")) == 2
+
+    # Nothing changed: nothing re-rendered
+    engine = TemplateEngine("templates", "home", "state", dict(email="a@example.com", hostname="h1"))
+    assert rendered(engine) == []
+
+    # Only outputs using a changed variable get re-rendered
+    engine = TemplateEngine("templates", "home", "state", dict(email="a@example.com", hostname="h2"))
+    assert rendered(engine) == [".config/foo.conf"]
+    assert list(runez.readlines("home/.config/foo.conf")) == ["host=h2"]
+
+    # Deleted output gets re-rendered
+    os.remove("home/.gitconfig")
+    assert rendered(engine) == [".gitconfig"]
+
+    # Undefined variable
+    runez.write("templates/bad", "{{foo}}", logger=None)
+    engine = TemplateEngine("templates", "home", "state", dict(email="a@example.com", hostname="h2"))
+    with pytest.raises(runez.system.AbortException, match="undefined variable"):
+        rendered(engine)
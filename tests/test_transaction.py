@@ -0,0 +1,100 @@
+import json
+import os
+
+import pytest
+import runez
+
+from gdot.transaction import ApplyTransaction, COMMIT_MARKER, TEMP_SUFFIX
+
+
+def test_commit(cli):
+    runez.write("a", "old a", logger=None)
+    runez.write("real-b", "old b", logger=None)
+    runez.symlink("real-b", "b", logger=None)
+    with ApplyTransaction("journal") as tx:
+        with tx.staged("a") as fh:
+            fh.write(b"new a")
+
+        with tx.staged("b", mode=0o600) as fh:
+            fh.write(b"new b")
+
+        with tx.staged("sub/folder/c") as fh:
+            fh.write(b"c")
+
+        assert os.path.exists("journal")
+        assert list(runez.readlines("a")) == ["old a"]
+
+    assert str(tx) == "3 files in transaction"
+    assert list(runez.readlines("a")) == ["new a"]
+    assert list(runez.readlines("real-b")) == ["new b"]
+    assert os.path.islink("b")  # Symlinks are preserved, their destination is updated
+    assert os.stat("real-b").st_mode & 0o777 == 0o600
+    assert list(runez.readlines("sub/folder/c")) == ["c"]
+    assert not os.path.exists("journal")
+    assert not [x for x in os.listdir(".") if x.endswith(TEMP_SUFFIX)]
+
+    # Permissions of existing targets are kept, given owner bits are applied (+x propagates), group/other bits are never loosened
+    os.chmod("a", 0o600)
+    os.chmod("real-b", 0o600)
+    with ApplyTransaction("journal") as tx:
+        with tx.staged("a") as fh:
+            fh.write(b"a2")
+
+        with tx.staged("real-b", mode=0o755) as fh:
+            fh.write(b"b2")
+
+    assert os.stat("a").st_mode & 0o777 == 0o600
+    assert os.stat("real-b").st_mode & 0o777 == 0o700
+
+    os.chmod("a", 0o644)
+    with ApplyTransaction("journal") as tx:
+        with tx.staged("a", mode=0o755) as fh:
+            fh.write(b"a3")
+
+        with tx.staged("real-b", mode=0o600) as fh:
+            fh.write(b"b3")
+
+    assert os.stat("a").st_mode & 0o777 == 0o744
+    assert os.stat("real-b").st_mode & 0o777 == 0o600
+
+
+def test_rollback(cli):
+    runez.write("a", "old a", logger=None)
+    with pytest.raises(ValueError):
+        with ApplyTransaction("journal") as tx:
+            with tx.staged("a") as fh:
+                fh.write(b"new a")
+
+            raise ValueError("oops")
+
+    assert list(runez.readlines("a")) == ["old a"]
+    assert not os.path.exists("journal")
+    assert not os.path.exists("a%s" % TEMP_SUFFIX)
+
+
+def simulated_crash(committed):
+    """Journal + temp files as left behind by an interrupted transaction"""
+    runez.write("a", "old a", logger=None)
+    temp = os.path.abspath("a%s" % TEMP_SUFFIX)
+    runez.write(temp, "new a", logger=None)
+    journal = "%s\n" % json.dumps([temp, os.path.abspath("a")])
+    if committed:
+        journal += COMMIT_MARKER
+
+    else:
+        journal += '["partial'
+
+    runez.write("journal", journal, logger=None)
+
+
+def test_recover(cli):
+    simulated_crash(committed=True)
+    ApplyTransaction("journal").recover()
+    assert list(runez.readlines("a")) == ["new a"]
+    assert not os.path.exists("journal")
+
+    simulated_crash(committed=False)
+    ApplyTransaction("journal").recover()
+    assert list(runez.readlines("a")) == ["old a"]
+    assert not os.path.exists("a%s" % TEMP_SUFFIX)
+    assert not os.path.exists("journal")